@@ -0,0 +1,362 @@
+"""Throughput and latency benchmarks of the ingest and render paths, no hardware needed.
+
+Traffic is replayed into a virtual port, a Linux pseudo-terminal pair or
+pyserial's loop:// URL, and received by the core pipeline, the headless front
+end or the Tk GUI (under a virtual X display). Results are printed as JSON so
+runs can be compared commit to commit:
+
+    python sermon_bench.py --modes core headless --duration 5 --output bench.json
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from sermon_core import ChunkQueue, OutputFormatter, PtyPort, Scrollback, SerialConnection, RX, DEFAULT_FRAME_RATE
+from sermon_stats import LatencyWindow
+
+BENCH_PROFILE = {'name': 'bench', 'baud_rate': 921600, 'data_bits': 8, 'stop_bits': 1, 'parity': 'N'}
+# Latency samples kept per case, enough for the percentiles of a few seconds of traffic
+LATENCY_SAMPLES = 1 << 16
+# How long to wait for the receiver to catch up once the traffic stops
+DRAIN_TIMEOUT = 2.0  # in s
+WRITE_BLOCK = 1024
+
+
+def bursty_binary(rng):
+    """Random binary bursts of 8 KiB, paced only by the port."""
+    return bytes(rng.getrandbits(8) for _ in range(8192)), None
+
+
+def long_lines(rng):
+    """4000 character text lines at 921600 baud."""
+    return ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789 ') for _ in range(4000)).encode() + b'\n', 921600
+
+
+def text_921600(rng):
+    """Log like 80 character lines sent continuously at 921600 baud."""
+    line = f'[{rng.randrange(1 << 20):08d}] sensor={rng.random():.6f} state=ok ' + 'x' * 40
+    return line[:79].encode() + b'\n', 921600
+
+
+PATTERNS = {
+    'bursty-binary': bursty_binary,
+    'long-lines': long_lines,
+    'text-921600': text_921600,
+}
+FORMATS = ('txt', 'hex', 'bytes')
+MODES = ('core', 'headless', 'gui')
+PORTS = ('pty', 'loop')
+
+
+def rss_bytes(pid='self') -> int:
+    """Resident memory of a process, None where /proc isn't available."""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+class LatencyTracker:
+    """Match rendered byte offsets against the time each block was written."""
+
+    def __init__(self):
+        self.marks = collections.deque()
+        self.rendered_bytes = 0
+        self.latency = LatencyWindow(LATENCY_SAMPLES)
+
+    def sent(self, end_offset: int):
+        # Called from the writer thread
+        self.marks.append((end_offset, time.monotonic_ns()))
+
+    def rendered(self, size: int):
+        self.rendered_bytes += size
+        now = time.monotonic_ns()
+        while self.marks and self.marks[0][0] <= self.rendered_bytes:
+            _, sent_at = self.marks.popleft()
+            self.latency.add((now - sent_at) / 1e6)
+
+
+class TrafficWriter(threading.Thread):
+    """Write a traffic pattern into a virtual port for a given duration, paced to its baud rate."""
+
+    def __init__(self, write, pattern: str, duration: float, tracker: LatencyTracker = None, seed: int = 0):
+        super(TrafficWriter, self).__init__(name='traffic-writer', daemon=True)
+        self.write = write
+        self.pattern = PATTERNS[pattern]
+        self.duration = duration
+        self.tracker = tracker
+        self.rng = random.Random(seed)
+        self.sent_bytes = 0
+        # Generating random data is slower than the ports, prepare a few blocks up front
+        self.blocks = [self.pattern(self.rng) for _ in range(16)]
+
+    def run(self):
+        start = time.monotonic()
+        index = 0
+        while time.monotonic() - start < self.duration:
+            block, baudrate = self.blocks[index % len(self.blocks)]
+            index += 1
+            for offset in range(0, len(block), WRITE_BLOCK):
+                part = block[offset:offset + WRITE_BLOCK]
+                self.write(part)
+                self.sent_bytes += len(part)
+                if self.tracker is not None:
+                    self.tracker.sent(self.sent_bytes)
+                if baudrate is not None:
+                    # 10 bits per byte on the wire, sleep until the line would have caught up
+                    ahead = self.sent_bytes * 10 / baudrate - (time.monotonic() - start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+
+def wait_until(condition, timeout: float):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def result(mode, port, pattern, output_format, duration, sent, received, tracker, rss_before, rss_after, **extra):
+    p50, p99 = tracker.latency.percentiles(50, 99) if tracker is not None else (None, None)
+    res = {
+        'mode': mode,
+        'port': port,
+        'pattern': pattern,
+        'format': output_format,
+        'duration_s': duration,
+        'sent_bytes': sent,
+        'received_bytes': received,
+        'dropped_bytes': max(0, sent - received),
+        'throughput_bps': received / duration if duration else None,
+        'latency_p50_ms': p50,
+        'latency_p99_ms': p99,
+        'rss_growth_bytes': rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+    }
+    res.update(extra)
+    return res
+
+
+def run_core(port_kind: str, pattern: str, output_format: str, duration: float) -> dict:
+    """Drive SerialConnection and the render path the GUI uses, with a thread standing in for Tk."""
+    tracker = LatencyTracker()
+    rx_queue = ChunkQueue()
+    formatter = OutputFormatter(output_format)
+    scrollback = Scrollback()
+    wake = threading.Event()
+    done = threading.Event()
+    interval = 1 / DEFAULT_FRAME_RATE
+
+    pty_port = PtyPort() if port_kind == 'pty' else None
+    connection = SerialConnection(pty_port.name if pty_port else 'loop://', BENCH_PROFILE)
+
+    def on_data(data, timestamp):
+        if rx_queue.put(data):
+            wake.set()
+
+    def render():
+        rendered_chars = 0
+        while not done.is_set():
+            if not wake.wait(0.1):
+                continue
+            wake.clear()
+            # Same coalescing as the GUI, one update a frame after the first pending chunk
+            time.sleep(interval)
+            data = rx_queue.drain()
+            rendered_chars += len(formatter.format_rx(data))
+            scrollback.append(RX, data)
+            tracker.rendered(len(data))
+
+    connection.add_listener(on_data)
+    rss_before = rss_bytes()
+    connection.start()
+    renderer = threading.Thread(target=render, daemon=True)
+    renderer.start()
+    writer = TrafficWriter(pty_port.write if pty_port else connection.ser.write, pattern, duration, tracker)
+    start = time.monotonic()
+    writer.start()
+    writer.join()
+    wait_until(lambda: tracker.rendered_bytes >= writer.sent_bytes, DRAIN_TIMEOUT)
+    elapsed = time.monotonic() - start
+    done.set()
+    renderer.join()
+    rss_after = rss_bytes()
+    connection.close()
+    if pty_port is not None:
+        pty_port.close()
+    return result('core', port_kind, pattern, output_format, elapsed, writer.sent_bytes, tracker.rendered_bytes,
+                  tracker, rss_before, rss_after)
+
+
+def run_headless(port_kind: str, pattern: str, output_format: str, duration: float) -> dict:
+    """Run serial_mon.py --headless as a subprocess on a pty and read back its stats lines."""
+    if port_kind != 'pty':
+        return {'mode': 'headless', 'port': port_kind, 'pattern': pattern, 'format': output_format,
+                'skipped': 'the headless process can only share a pty with the benchmark'}
+    pty_port = PtyPort()
+    stats_f = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+    stats_f.close()
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable, os.path.join(here, 'serial_mon.py'), '--headless', pty_port.name,
+                             '--format', output_format, '--output', os.devnull,
+                             '--stats-file', stats_f.name, '--stats-interval', '0.1'],
+                            cwd=here, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def last_stats():
+        with open(stats_f.name) as f:
+            lines = f.read().splitlines()
+        return json.loads(lines[-1]) if lines else None
+
+    wait_until(lambda: last_stats() is not None, 5.0)
+    rss_before = rss_bytes(proc.pid)
+    writer = TrafficWriter(pty_port.write, pattern, duration)
+    start = time.monotonic()
+    writer.start()
+    writer.join()
+    wait_until(lambda: (last_stats() or {}).get('rx_bytes', 0) >= writer.sent_bytes, DRAIN_TIMEOUT)
+    elapsed = time.monotonic() - start
+    rss_after = rss_bytes(proc.pid)
+    stats = last_stats() or {}
+    proc.terminate()
+    proc.wait()
+    pty_port.close()
+    os.unlink(stats_f.name)
+    # Latency here is read to written out, measured by the headless process itself
+    res = result('headless', port_kind, pattern, output_format, elapsed, writer.sent_bytes,
+                 stats.get('rx_bytes', 0), None, rss_before, rss_after)
+    res['latency_p50_ms'] = stats.get('latency_p50_ms')
+    res['latency_p99_ms'] = stats.get('latency_p99_ms')
+    return res
+
+
+def run_gui(port_kind: str, pattern: str, output_format: str, duration: float) -> dict:
+    """Connect the Tk GUI to a virtual port and measure input to widget latency."""
+    if not os.environ.get('DISPLAY'):
+        return {'mode': 'gui', 'port': port_kind, 'pattern': pattern, 'format': output_format,
+                'skipped': 'no display, pass --xvfb or set DISPLAY'}
+    import sermon_gui
+
+    tracker = LatencyTracker()
+    pty_port = PtyPort() if port_kind == 'pty' else None
+    port_name = pty_port.name if pty_port else 'loop://'
+
+    app = sermon_gui.SerialMon()
+    app.output_format_var.set(output_format)
+    app.current_settings.set('custom')
+    app.handle_setting_change()
+    app.device_select.set(port_name)
+    app.handle_device_connection()
+    view = app.view_for_port(port_name)
+    append = view.append
+
+    def tracked_append(direction, data, source=None):
+        append(direction, data, source)
+        tracker.rendered(len(data))
+
+    view.append = tracked_append
+    rss_before = rss_bytes()
+    writer = TrafficWriter(pty_port.write if pty_port else view.connection.ser.write, pattern, duration, tracker)
+    start = time.monotonic()
+    writer.start()
+
+    def check_done():
+        if (not writer.is_alive() and tracker.rendered_bytes >= writer.sent_bytes) \
+                or time.monotonic() - start > duration + DRAIN_TIMEOUT:
+            app.quit()
+        else:
+            app.after(50, check_done)
+
+    app.after(50, check_done)
+    app.mainloop()
+    elapsed = time.monotonic() - start
+    rss_after = rss_bytes()
+    stats = view.connection.stats.snapshot()
+    view.connection.close()
+    # Skip handle_close, it would write the benchmark profile back to preferences.yaml
+    app.destroy()
+    if pty_port is not None:
+        pty_port.close()
+    return result('gui', port_kind, pattern, output_format, elapsed, writer.sent_bytes, tracker.rendered_bytes,
+                  tracker, rss_before, rss_after, read_to_render_p99_ms=stats['latency_p99_ms'])
+
+
+RUNNERS = {
+    'core': run_core,
+    'headless': run_headless,
+    'gui': run_gui,
+}
+
+
+def start_xvfb():
+    xvfb = shutil.which('Xvfb')
+    if xvfb is None:
+        print('Xvfb not found, GUI cases will be skipped', file=sys.stderr)
+        return None
+    display = ':97'
+    proc = subprocess.Popen([xvfb, display, '-screen', '0', '1280x1024x24'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.environ['DISPLAY'] = display
+    time.sleep(0.5)
+    return proc
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark sermon on virtual serial ports')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=['core', 'headless'])
+    parser.add_argument('--ports', nargs='+', choices=PORTS, default=['pty'])
+    parser.add_argument('--patterns', nargs='+', choices=list(PATTERNS), default=list(PATTERNS))
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=list(FORMATS))
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds of traffic per case')
+    parser.add_argument('--xvfb', action='store_true', help='run the GUI cases on a private Xvfb display')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    if 'pty' in args.ports and os.name != 'posix':
+        parser.error('pty ports are only available on POSIX systems')
+
+    xvfb = start_xvfb() if args.xvfb and 'gui' in args.modes else None
+    results = []
+    try:
+        for mode in args.modes:
+            for port_kind in args.ports:
+                for pattern in args.patterns:
+                    for output_format in args.formats:
+                        print(f'{mode} {port_kind} {pattern} {output_format}', file=sys.stderr)
+                        results.append(RUNNERS[mode](port_kind, pattern, output_format, args.duration))
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    out_str = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out_str + '\n')
+    else:
+        print(out_str)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
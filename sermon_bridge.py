@@ -0,0 +1,245 @@
+import collections
+import os
+import selectors
+import socket
+import sys
+import threading
+
+DEFAULT_BRIDGE_ADDRESS = '127.0.0.1:7000'
+# Received data queued for a client that isn't reading, past this the slow client policy applies
+DEFAULT_CLIENT_BUFFER = 1024 * 1024
+# What happens to a client whose buffer is full: it misses data, or it is disconnected
+SLOW_CLIENT_POLICIES = ('drop', 'disconnect')
+# Who may write to the port: nobody, the longest connected client, or every client
+WRITER_POLICIES = ('none', 'first', 'all')
+RECV_SIZE = 4096
+
+
+def parse_address(address: str):
+    """Return (family, address) for unix:PATH, HOST:PORT or PORT, hosts default to localhost."""
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET, (host.strip('[]') or '127.0.0.1', int(port))
+
+
+class BridgeClient:
+    """One socket subscribed to a bridge, its pending data is only touched under the bridge lock."""
+
+    def __init__(self, sock, name: str):
+        self.sock = sock
+        self.name = name
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.sent_bytes = 0
+        self.dropped_bytes = 0
+        # Received from the client but not written to the port
+        self.refused_bytes = 0
+        self.events = selectors.EVENT_READ
+        self.closing = False
+
+
+class SerialBridge:
+    """Serve the data received on a connection to many socket clients.
+
+    Clients attach and detach at any time on a TCP or Unix socket and get
+    everything received from then on. Chunks are queued per client from the
+    read thread and sent from the bridge thread, a client that doesn't keep up
+    with client_buffer bytes queued misses data or is disconnected, so it never
+    holds up the port or the other clients. What clients send is written to
+    the port if the writer policy allows it.
+    """
+
+    def __init__(self, connection, address: str = DEFAULT_BRIDGE_ADDRESS,
+                 client_buffer: int = DEFAULT_CLIENT_BUFFER, slow_clients: str = 'drop', writers: str = 'none'):
+        if slow_clients not in SLOW_CLIENT_POLICIES:
+            raise ValueError(f'unknown slow client policy {slow_clients}')
+        if writers not in WRITER_POLICIES:
+            raise ValueError(f'unknown writer policy {writers}')
+        self.connection = connection
+        self.address = address
+        self.client_buffer = client_buffer
+        self.slow_clients = slow_clients
+        self.writers = writers
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._server = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Listen on address, raises OSError if it can't be bound."""
+        family, address = parse_address(self.address)
+        self._server = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if family == socket.AF_UNIX:
+                # Left behind by a bridge that wasn't stopped
+                if os.path.exists(address):
+                    os.unlink(address)
+            else:
+                self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._server.bind(address)
+            self._server.listen()
+        except OSError:
+            self._server.close()
+            raise
+        self._server.setblocking(False)
+        self._selector.register(self._server, selectors.EVENT_READ, None)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self.connection.add_listener(self.on_serial_data)
+        self._thread = threading.Thread(target=self._run, name=f'bridge-{self.address}', daemon=True)
+        self._thread.start()
+        print(f'Serving {self.connection.port} on {self.address}', file=sys.stderr)
+
+    def stop(self):
+        self.connection.remove_listener(self.on_serial_data)
+        self._stop_event.set()
+        self._wakeup_w.send(b'\0')
+        if self._thread is not None:
+            self._thread.join()
+        for client in list(self._clients.values()):
+            self._close_client(client)
+        self._selector.close()
+        self._server.close()
+        if self._server.family == socket.AF_UNIX:
+            try:
+                os.unlink(parse_address(self.address)[1])
+            except OSError:
+                pass
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        print(f'Stopped serving {self.connection.port} on {self.address}', file=sys.stderr)
+
+    def set_connection(self, connection):
+        """Serve another connection to the same clients, e.g. once a lost device is reopened."""
+        self.connection.remove_listener(self.on_serial_data)
+        self.connection = connection
+        connection.add_listener(self.on_serial_data)
+
+    @property
+    def clients(self) -> list:
+        with self._lock:
+            return [{'name': client.name, 'sent_bytes': client.sent_bytes, 'pending_bytes': client.pending_bytes,
+                     'dropped_bytes': client.dropped_bytes, 'refused_bytes': client.refused_bytes,
+                     'writer': self._may_write(client)}
+                    for client in self._clients.values()]
+
+    def on_serial_data(self, data: bytes, timestamp: int):
+        # Called from the read thread, only queues the chunk
+        wake = False
+        with self._lock:
+            for client in self._clients.values():
+                if client.closing:
+                    continue
+                if client.pending_bytes + len(data) > self.client_buffer:
+                    if self.slow_clients == 'disconnect':
+                        client.closing = True
+                        wake = True
+                    else:
+                        client.dropped_bytes += len(data)
+                    continue
+                wake |= not client.pending
+                client.pending.append(data)
+                client.pending_bytes += len(data)
+        # The bridge thread only needs to start watching for writability once
+        if wake:
+            self._wakeup_w.send(b'\0')
+
+    def _may_write(self, client: BridgeClient) -> bool:
+        if self.writers == 'all':
+            return True
+        if self.writers == 'first':
+            # Clients are kept in connection order
+            return next(iter(self._clients.values()), None) is client
+        return False
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            for key, events in self._selector.select():
+                if key.fileobj is self._wakeup_r:
+                    self._wakeup_r.recv(4096)
+                elif key.fileobj is self._server:
+                    self._accept()
+                else:
+                    client = key.data
+                    if events & selectors.EVENT_READ:
+                        self._receive(client)
+                    if events & selectors.EVENT_WRITE and not client.closing:
+                        self._flush(client)
+            with self._lock:
+                clients = list(self._clients.values())
+            for client in clients:
+                if client.closing:
+                    self._close_client(client)
+                    continue
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.pending else 0)
+                if events != client.events:
+                    client.events = events
+                    self._selector.modify(client.sock, events, client)
+
+    def _accept(self):
+        try:
+            sock, address = self._server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        client = BridgeClient(sock, f'{address[0]}:{address[1]}' if isinstance(address, tuple) else 'unix')
+        with self._lock:
+            self._clients[sock] = client
+        self._selector.register(sock, client.events, client)
+        print(f'Bridge client {client.name} connected to {self.connection.port}', file=sys.stderr)
+
+    def _receive(self, client: BridgeClient):
+        try:
+            data = client.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            client.closing = True
+            return
+        with self._lock:
+            may_write = self._may_write(client)
+        # Never wait on the port here, a full send queue refuses the data like a client without write access
+        if not may_write or self.connection.send(data) is None:
+            client.refused_bytes += len(data)
+
+    def _flush(self, client: BridgeClient):
+        with self._lock:
+            if len(client.pending) > 1:
+                # One send for everything queued since the last one
+                data = b''.join(client.pending)
+                client.pending.clear()
+                client.pending.append(data)
+            data = client.pending[0] if client.pending else b''
+        if not data:
+            return
+        try:
+            sent = client.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            client.closing = True
+            return
+        with self._lock:
+            client.sent_bytes += sent
+            client.pending_bytes -= sent
+            if sent < len(data):
+                client.pending[0] = data[sent:]
+            else:
+                client.pending.popleft()
+
+    def _close_client(self, client: BridgeClient):
+        with self._lock:
+            self._clients.pop(client.sock, None)
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        print(f'Bridge client {client.name} disconnected from {self.connection.port}, '
+              f'{client.sent_bytes} bytes sent, {client.dropped_bytes} dropped', file=sys.stderr)
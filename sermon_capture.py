@@ -0,0 +1,236 @@
+import gzip
+import queue
+import struct
+import sys
+import threading
+import time
+
+from sermon_core import OutputFormatter, DEFAULT_ENCODING, DEFAULT_DECODE_ERRORS
+
+# Capture file layout:
+#   header: magic, wall clock and monotonic time in ns when the file was opened
+#   records: monotonic timestamp in ns, direction, payload length, payload
+CAPTURE_MAGIC = b'SERMCAP1'
+CAPTURE_HEADER = struct.Struct('<8sqq')
+RECORD_HEADER = struct.Struct('<qBI')
+CAPTURE_EXTENSION = '.smcap'
+
+# Chunks waiting for the writer thread, past this new chunks are dropped
+DEFAULT_QUEUE_CHUNKS = 4096
+DEFAULT_FLUSH_INTERVAL = 0.5  # in s
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class CaptureWriter:
+    """Stream received and sent chunks to disk from a dedicated writer thread.
+
+    write() never blocks, it only queues the chunk. When the disk can't keep up
+    and the queue is full the chunk is dropped and counted in dropped_bytes, so
+    a slow disk never stalls the serial read. A failed write, e.g. a full disk,
+    stops the recording: the error is kept in error and every later chunk is
+    counted as dropped.
+    """
+
+    def __init__(self, base_path: str, max_file_bytes: int = None, max_file_seconds: float = None,
+                 compress: bool = False, queue_chunks: int = DEFAULT_QUEUE_CHUNKS):
+        # Strip the extension, rotated files are numbered after the base name
+        if base_path.endswith(CAPTURE_EXTENSION):
+            base_path = base_path[:-len(CAPTURE_EXTENSION)]
+        self.base_path = base_path
+        self.max_file_bytes = max_file_bytes
+        self.max_file_seconds = max_file_seconds
+        self.compress = compress
+        self.file_index = 0
+        self.current_path = None
+        self.written_bytes = 0
+        self.dropped_bytes = 0
+        self.dropped_chunks = 0
+        self.error = None
+        self._file = None
+        self._file_bytes = 0
+        self._file_opened = 0.0
+        self._queue = queue.Queue(queue_chunks)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='capture-writer', daemon=True)
+
+    def start(self):
+        """Open the first file, an OSError is raised as is with nothing left open."""
+        try:
+            self._open_next()
+        except OSError:
+            try:
+                self._close_file()
+            except OSError:
+                pass
+            raise
+        self._thread.start()
+
+    def close(self) -> OSError:
+        """Write out what is queued and close the file, returns the error that stopped the recording if any."""
+        self._stop_event.set()
+        self._thread.join()
+        self._write_batch(self._drain())
+        try:
+            self._close_file()
+        except OSError as e:
+            self._fail(e)
+        return self.error
+
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        """Counters for a stats snapshot, chunks waiting for the disk and bytes it couldn't keep up with."""
+        return {'capture_backlog': self.backlog, 'capture_dropped_bytes': self.dropped_bytes,
+                'capture_error': str(self.error) if self.error is not None else None}
+
+    def write(self, direction: int, data: bytes, timestamp: int = None) -> bool:
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        if self.error is not None:
+            self._drop([(timestamp, direction, data)])
+            return False
+        try:
+            self._queue.put_nowait((timestamp, direction, data))
+        except queue.Full:
+            self.dropped_chunks += 1
+            self.dropped_bytes += len(data)
+            return False
+        return True
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def _run(self):
+        while not self._stop_event.is_set() and self.error is None:
+            try:
+                first = self._queue.get(timeout=DEFAULT_FLUSH_INTERVAL)
+            except queue.Empty:
+                try:
+                    self._rotate_if_needed()
+                except OSError as e:
+                    self._fail(e)
+                continue
+            batch = [first]
+            batch.extend(self._drain())
+            self._write_batch(batch)
+            if self.error is None:
+                try:
+                    self._file.flush()
+                except OSError as e:
+                    self._fail(e)
+        # Whatever was queued before the error can't be written any more
+        if self.error is not None:
+            self._drop(self._drain())
+
+    def _write_batch(self, batch):
+        if self.error is not None:
+            self._drop(batch)
+            return
+        for index, (timestamp, direction, data) in enumerate(batch):
+            try:
+                self._rotate_if_needed()
+                self._file.write(RECORD_HEADER.pack(timestamp, direction, len(data)))
+                self._file.write(data)
+            except OSError as e:
+                # A record cut short is skipped by read_capture
+                self._fail(e)
+                self._drop(batch[index:])
+                return
+            self._file_bytes += RECORD_HEADER.size + len(data)
+            self.written_bytes += len(data)
+
+    def _fail(self, error: OSError):
+        if self.error is None:
+            self.error = error
+            print(f'Recording to {self.current_path} stopped: {error}', file=sys.stderr)
+
+    def _drop(self, batch):
+        for _, _, data in batch:
+            self.dropped_chunks += 1
+            self.dropped_bytes += len(data)
+
+    def _rotate_if_needed(self):
+        if self.max_file_bytes is not None and self._file_bytes >= self.max_file_bytes:
+            self._open_next()
+        elif self.max_file_seconds is not None and time.monotonic() - self._file_opened >= self.max_file_seconds:
+            self._open_next()
+
+    def _open_next(self):
+        self._close_file()
+        path = f'{self.base_path}-{self.file_index:03d}{CAPTURE_EXTENSION}'
+        if self.compress:
+            path += '.gz'
+            # Favour speed, the writer has to keep up with the port
+            self._file = gzip.open(path, 'wb', compresslevel=1)
+        else:
+            self._file = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self._file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, time.time_ns(), time.monotonic_ns()))
+        print(f'Recording to {path}', file=sys.stderr)
+        self.current_path = path
+        self.file_index += 1
+        self._file_bytes = CAPTURE_HEADER.size
+        self._file_opened = time.monotonic()
+
+    def _close_file(self):
+        f = self._file
+        self._file = None
+        if f is not None:
+            f.close()
+
+
+def open_capture(path: str):
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_capture(path: str):
+    """Yield (timestamp_ns, direction, data) for every record in a capture file."""
+    with open_capture(path) as f:
+        magic, _, _ = CAPTURE_HEADER.unpack(f.read(CAPTURE_HEADER.size))
+        if magic != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not a sermon capture')
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                # End of file, or a record cut short by a crash
+                return
+            timestamp, direction, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield timestamp, direction, data
+
+
+def export_text(path: str, out_path: str, output_format: str = 'txt', encoding: str = DEFAULT_ENCODING,
+                errors: str = DEFAULT_DECODE_ERRORS):
+    """Render a capture as plain text, the same way the output pane shows it."""
+    formatter = OutputFormatter(output_format, encoding, errors)
+    with open(out_path, 'w') as out_f:
+        for _, direction, data in read_capture(path):
+            out_f.write(formatter.format(direction, data))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Export a sermon capture file as plain text')
+    parser.add_argument('capture')
+    parser.add_argument('output')
+    parser.add_argument('--format', choices=['txt', 'hex', 'bytes'], default='txt')
+    parser.add_argument('--encoding', default=DEFAULT_ENCODING)
+    args = parser.parse_args()
+    export_text(args.capture, args.output, args.format, args.encoding)
+
+
+if __name__ == '__main__':
+    main()
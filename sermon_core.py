@@ -0,0 +1,1067 @@
+import array
+import bisect
+import codecs
+import collections
+import json
+import os
+import platform
+import queue
+import re
+import selectors
+import socket
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+import serial
+
+from sermon_stats import ConnectionStats
+
+PREFERENCES_PATH = 'preferences.yaml'
+SCHEMA_PATH = 'preferences-schema.yaml'
+# Validated preferences of the last load, so unchanged files skip YAML parsing and validation
+PREFERENCES_CACHE_PATH = '.preferences-cache.json'
+
+# Upper bound for a single read, whatever is waiting in the OS buffer past this
+# is picked up on the next iteration.
+DEFAULT_CHUNK_SIZE = 4096
+# How long a read blocks waiting for the first byte, this only bounds how fast
+# the engine notices a stop request, data is returned as soon as it arrives.
+DEFAULT_READ_TIMEOUT = 0.1
+# Sends waiting for the writer thread, past this send() reports the queue is full
+DEFAULT_SEND_QUEUE = 256
+# A file is written in blocks of this size, so progress, pacing and cancelling work per block
+DEFAULT_SEND_CHUNK_SIZE = 256
+
+SEND_INPUT_FORMATS = ('text', 'hex', 'escaped')
+FLOW_CONTROLS = ('none', 'rtscts', 'xonxoff')
+
+# Direction of a stored chunk
+RX = 0
+TX = 1
+
+OUTPUT_FORMATS = ('txt', 'hex', 'bytes')
+DEFAULT_ENCODING = 'utf-8'
+DEFAULT_DECODE_ERRORS = 'replace'
+
+# Per line timestamps shown in front of the output
+TIMESTAMP_MODES = ('none', 'absolute', 'delta')
+
+DEFAULT_SCROLLBACK_LINES = 10000
+DEFAULT_SCROLLBACK_BYTES = 16 * 1024 * 1024
+# Characters kept in the output widget, whatever the line count
+DEFAULT_SCROLLBACK_CHARS = 4 * 1024 * 1024
+# Rendered lines are broken past this length, so a device that never sends a newline
+# still gives the widget lines to trim and doesn't make every insert slower
+MAX_LINE_CHARS = 4096
+DEFAULT_FRAME_RATE = 30
+
+# Per byte renderings, indexed by the byte value so whole chunks are formatted
+# with a single join instead of per character string building. A received
+# newline also breaks the line in hex and bytes mode so the scrollback can be
+# trimmed by lines in every format.
+HEX_TABLE = tuple(f'0x{i:02x}' + ('\n' if i == 0x0a else ' ') for i in range(256))
+BYTES_TABLE = tuple(f'{bytes([i])!r}' + ('\n' if i == 0x0a else ' ') for i in range(256))
+
+
+def format_bytes(data: bytes, output_format: str, encoding: str = DEFAULT_ENCODING,
+                 errors: str = DEFAULT_DECODE_ERRORS) -> str:
+    """Render a complete chunk of bytes, without carrying state between calls."""
+    if output_format == 'hex':
+        return ''.join(map(HEX_TABLE.__getitem__, data))
+    if output_format == 'bytes':
+        return ''.join(map(BYTES_TABLE.__getitem__, data))
+    return data.decode(encoding, errors)
+
+
+class OutputFormatter:
+    """Turn the raw received stream into display text for one output format.
+
+    Text mode goes through an incremental decoder, so a multi-byte character
+    split across two reads is rendered once both halves have arrived.
+    """
+
+    def __init__(self, output_format: str = 'txt', encoding: str = DEFAULT_ENCODING,
+                 errors: str = DEFAULT_DECODE_ERRORS):
+        self.output_format = output_format
+        self.encoding = encoding
+        self.errors = errors
+        self.reset()
+
+    def reset(self):
+        self._decoder = codecs.getincrementaldecoder(self.encoding)(self.errors)
+
+    def format_rx(self, data: bytes) -> str:
+        if self.output_format == 'txt':
+            return self._decoder.decode(data)
+        return format_bytes(data, self.output_format)
+
+    def format_tx(self, data: bytes) -> str:
+        return ('\n--> ' + format_bytes(data, self.output_format, self.encoding, self.errors) + '\n<-- '
+                + format_bytes(b'\n', self.output_format, self.encoding, self.errors))
+
+    def format(self, direction: int, data: bytes, source: str = None) -> str:
+        if direction == TX:
+            return self.format_tx(data)
+        return self.format_rx(data)
+
+    def render(self, segments) -> str:
+        """Render a sequence of (direction, data, source) segments from scratch."""
+        self.reset()
+        return ''.join([self.format(direction, data) for direction, data, _ in segments])
+
+    def copy(self):
+        return OutputFormatter(self.output_format, self.encoding, self.errors)
+
+
+class Timeline:
+    """Arrival time of every received chunk, kept in two parallel array('q').
+
+    offsets holds the stream offset of the first byte of each chunk and times
+    the monotonic ns at which the read thread got it, 16 bytes per chunk
+    however long the session runs.
+    """
+
+    def __init__(self):
+        self.offsets = array.array('q')
+        self.times = array.array('q')
+        self.size = 0
+        # Turns monotonic stamps into wall clock time for display
+        self.wall_offset_ns = time.time_ns() - time.monotonic_ns()
+
+    def add(self, length: int, timestamp: int = None):
+        # times first, so a reader on another thread never finds an offset without its time
+        self.times.append(time.monotonic_ns() if timestamp is None else timestamp)
+        self.offsets.append(self.size)
+        self.size += length
+
+    def time_at(self, offset: int) -> int:
+        """Monotonic ns at which the byte at offset arrived, None if nothing was stamped before it."""
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        if index < 0:
+            return None
+        return self.times[index]
+
+
+class TimestampFormatter:
+    """Wrap a formatter to prefix every output line with the arrival time of its first byte.
+
+    offset is the stream offset of the next received byte, set it to where a
+    re-render starts before calling render().
+    """
+
+    def __init__(self, formatter, timeline: Timeline, mode: str = 'absolute'):
+        self.formatter = formatter
+        self.timeline = timeline
+        self.mode = mode
+        self.offset = 0
+        self.reset()
+
+    @property
+    def output_format(self) -> str:
+        return self.formatter.output_format
+
+    @output_format.setter
+    def output_format(self, output_format: str):
+        self.formatter.output_format = output_format
+
+    @property
+    def encoding(self) -> str:
+        return self.formatter.encoding
+
+    @property
+    def errors(self) -> str:
+        return self.formatter.errors
+
+    def reset(self):
+        self.formatter.reset()
+        self._line_start = True
+        self._last_time = None
+
+    def stamp(self, offset: int) -> str:
+        timestamp = self.timeline.time_at(offset)
+        if timestamp is None:
+            return ''
+        if self.mode == 'delta':
+            delta = timestamp - self._last_time if self._last_time is not None else 0
+            self._last_time = timestamp
+            return f'+{delta / 1e9:.6f} '
+        wall = timestamp + self.timeline.wall_offset_ns
+        return time.strftime('%H:%M:%S', time.localtime(wall // 1000000000)) + f'.{wall % 1000000000 // 1000:06d} '
+
+    def format_rx(self, data: bytes) -> str:
+        out_str = self.formatter.format_rx(data)
+        start = self.offset
+        self.offset += len(data)
+        if not out_str:
+            return out_str
+        lines = out_str.split('\n')
+        line_offsets = [start]
+        pos = data.find(b'\n')
+        while pos != -1:
+            line_offsets.append(start + pos + 1)
+            pos = data.find(b'\n', pos + 1)
+        if len(line_offsets) != len(lines):
+            # Rows that don't follow the received newlines, e.g. frames, get the time of the last byte
+            line_offsets = [self.offset - 1] * len(lines)
+        parts = []
+        for i, line in enumerate(lines):
+            if i:
+                parts.append('\n')
+                self._line_start = True
+            if line and self._line_start:
+                parts.append(self.stamp(line_offsets[i]))
+                self._line_start = False
+            parts.append(line)
+        self._line_start = out_str.endswith('\n')
+        return ''.join(parts)
+
+    def format_tx(self, data: bytes) -> str:
+        out_str = self.formatter.format_tx(data)
+        self._line_start = out_str.endswith('\n')
+        return out_str
+
+    def format(self, direction: int, data: bytes, source: str = None) -> str:
+        if direction == TX:
+            return self.format_tx(data)
+        return self.format_rx(data)
+
+    def render(self, segments) -> str:
+        self.reset()
+        return ''.join([self.format(direction, data) for direction, data, _ in segments])
+
+    def copy(self):
+        return TimestampFormatter(self.formatter.copy(), self.timeline, self.mode)
+
+
+class MergedFormatter:
+    """Render chunks from several ports as one stream, tagging every change of port.
+
+    Each port keeps its own incremental decoder so interleaved chunks don't
+    corrupt each other's multi-byte characters.
+    """
+
+    def __init__(self, output_format: str = 'txt', encoding: str = DEFAULT_ENCODING,
+                 errors: str = DEFAULT_DECODE_ERRORS):
+        self._output_format = output_format
+        self.encoding = encoding
+        self.errors = errors
+        self.formatters = {}
+        self.last_source = None
+
+    @property
+    def output_format(self) -> str:
+        return self._output_format
+
+    @output_format.setter
+    def output_format(self, output_format: str):
+        self._output_format = output_format
+        for formatter in self.formatters.values():
+            formatter.output_format = output_format
+
+    def reset(self):
+        for formatter in self.formatters.values():
+            formatter.reset()
+        self.last_source = None
+
+    def format(self, direction: int, data: bytes, source: str = None) -> str:
+        formatter = self.formatters.get(source)
+        if formatter is None:
+            formatter = OutputFormatter(self._output_format, self.encoding, self.errors)
+            self.formatters[source] = formatter
+        out_str = formatter.format(direction, data)
+        if source != self.last_source:
+            self.last_source = source
+            out_str = f'\n[{source}] ' + out_str
+        return out_str
+
+    def render(self, segments) -> str:
+        self.reset()
+        return ''.join([self.format(direction, data, source) for direction, data, source in segments])
+
+    def copy(self):
+        return MergedFormatter(self._output_format, self.encoding, self.errors)
+
+
+# Bytes that continue a UTF-8 character, every other byte starts one
+UTF8_CONTINUATION_BYTES = bytes(range(0x80, 0xc0))
+
+
+def char_count(data: bytes, encoding: str = DEFAULT_ENCODING) -> int:
+    """Number of characters data decodes to, counted without decoding for UTF-8."""
+    if codecs.lookup(encoding).name == 'utf-8':
+        return len(data.translate(None, UTF8_CONTINUATION_BYTES))
+    return len(data.decode(encoding, 'replace'))
+
+
+class Scrollback:
+    """Bounded raw store of everything received and sent, kept as bytes.
+
+    Chunks are kept in a ring, once either limit is exceeded the oldest ones
+    are dropped, so memory stays flat however long the session runs.
+    """
+
+    def __init__(self, max_lines: int = DEFAULT_SCROLLBACK_LINES, max_bytes: int = DEFAULT_SCROLLBACK_BYTES):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self._segments = collections.deque()
+        self.size = 0
+        self.lines = 0
+        # Received bytes ever appended, the stream offset matching a Timeline
+        self.rx_bytes = 0
+
+    def append(self, direction: int, data: bytes, source: str = None):
+        # A sent chunk is rendered on its own lines
+        lines = data.count(b'\n') + (2 if direction == TX else 0)
+        self._segments.append((direction, data, lines, source, self.rx_bytes))
+        if direction == RX:
+            self.rx_bytes += len(data)
+        self.size += len(data)
+        self.lines += lines
+        while len(self._segments) > 1 and (self.size > self.max_bytes or self.lines > self.max_lines):
+            _, old_data, old_lines, _, _ = self._segments.popleft()
+            self.size -= len(old_data)
+            self.lines -= old_lines
+
+    def clear(self):
+        self._segments.clear()
+        self.size = 0
+        self.lines = 0
+
+    def segments(self, max_lines: int = None, max_chars: int = None, encoding: str = DEFAULT_ENCODING):
+        """Return the stored (direction, data, source) segments, or only the newest ones covering max_lines
+        and max_chars characters of text in encoding."""
+        if max_lines is None and max_chars is None:
+            return [(direction, data, source) for direction, data, _, source, _ in self._segments]
+        tail = []
+        lines = 0
+        chars = 0
+        for direction, data, seg_lines, source, _ in reversed(self._segments):
+            tail.append((direction, data, source))
+            lines += seg_lines
+            if max_chars is not None:
+                chars += char_count(data, encoding)
+            if (max_lines is not None and lines > max_lines) or (max_chars is not None and chars > max_chars):
+                break
+        tail.reverse()
+        return tail
+
+    def rx_offset(self, count: int) -> int:
+        """Stream offset of the received data at the start of the newest count segments."""
+        if not count:
+            return self.rx_bytes
+        return self._segments[-count][4]
+
+
+def wrap_lines(text: str, column: int = 0, width: int = MAX_LINE_CHARS):
+    """Break the lines of text longer than width, column being the length of the line text continues.
+
+    Returns the text and the length of its last line, to continue from with the next text.
+    """
+    if column + len(text) <= width:
+        # Nothing in it can be too long, the usual case for a received chunk
+        newline = text.rfind('\n')
+        return text, column + len(text) if newline < 0 else len(text) - newline - 1
+    lines = text.split('\n')
+    pieces = []
+    end = column
+    for index, line in enumerate(lines):
+        start = column if index == 0 else 0
+        if start + len(line) > width:
+            split = width - start
+            parts = [line[:split]] + [line[pos:pos + width] for pos in range(split, len(line), width)]
+            line = '\n'.join(parts)
+            end = len(parts[-1])
+        else:
+            end = start + len(line)
+        pieces.append(line)
+    return '\n'.join(pieces), end
+
+
+class ChunkQueue:
+    """Hand off received chunks from the read thread to a consumer.
+
+    put() returns True only for the chunk that finds the queue idle, so the
+    producer schedules at most one pending consumer update at a time no matter
+    how many chunks arrive before the consumer gets to drain().
+    """
+
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._lock = threading.Lock()
+        self._pending = False
+        self.backlog = 0
+        # Monotonic ns when the oldest queued chunk arrived, and the same for the last drain
+        self._oldest = 0
+        self.drained_since = 0
+
+    def put(self, data: bytes, source: str = None) -> bool:
+        with self._lock:
+            if not self._chunks:
+                self._oldest = time.monotonic_ns()
+            self._chunks.append((source, data))
+            self.backlog += len(data)
+            if self._pending:
+                return False
+            self._pending = True
+            return True
+
+    def _take(self):
+        with self._lock:
+            chunks = self._chunks
+            self._chunks = collections.deque()
+            self.drained_since = self._oldest
+            self.backlog = 0
+            self._pending = False
+        return chunks
+
+    def drain(self) -> bytes:
+        return b''.join([data for _, data in self._take()])
+
+    def drain_sourced(self):
+        """Drain as a list of (source, data), joining consecutive chunks of the same source."""
+        drained = []
+        for source, data in self._take():
+            if drained and drained[-1][0] == source:
+                drained[-1][1].append(data)
+            else:
+                drained.append((source, [data]))
+        return [(source, b''.join(chunks)) for source, chunks in drained]
+
+
+class ReadEngine:
+    """Read a serial port in bulk on a background thread.
+
+    Each iteration reads whatever the port has in_waiting, up to chunk_size,
+    and hands the raw bytes to on_data. When the port is idle the read blocks
+    in the driver for up to timeout instead of spinning.
+    """
+
+    def __init__(self, ser, on_data, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 timeout: float = DEFAULT_READ_TIMEOUT, on_error=None):
+        self.ser = ser
+        self.on_data = on_data
+        self.on_error = on_error
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.ser.timeout = self.timeout
+        self._stop_event.clear()
+        # A thread cannot be restarted once finished, so build a new one each time.
+        # Daemon so it dies if the main process terminates.
+        self._thread = threading.Thread(target=self._run, name=f'read-{self.ser.port}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(self.timeout * 10)
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        print('Start reading thread', file=sys.stderr)
+        while not self._stop_event.is_set():
+            try:
+                # With nothing waiting this blocks for the first byte (or timeout),
+                # otherwise it returns immediately with everything already buffered.
+                waiting = self.ser.in_waiting
+                data = self.ser.read(min(max(waiting, 1), self.chunk_size))
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                # Closing the port under a blocked read lands here as well
+                if not self._stop_event.is_set():
+                    print(f'Read error on {self.ser.port}: {e}', file=sys.stderr)
+                    if self.on_error is not None:
+                        self.on_error(e)
+                break
+            if data:
+                try:
+                    self.on_data(data)
+                except Exception as e:
+                    print(f'Error handling data from {self.ser.port}: {e!r}', file=sys.stderr)
+                    if self.on_error is not None:
+                        self.on_error(e)
+                    break
+        print('Reading thread finished', file=sys.stderr)
+
+
+class FileTransfer:
+    """A file streamed to a port by a WriteEngine, its progress can be read from any thread."""
+
+    def __init__(self, path: str, chunk_size: int = DEFAULT_SEND_CHUNK_SIZE, interval: float = 0.0,
+                 flow_control: str = 'none'):
+        self.path = path
+        self.total = os.path.getsize(path)
+        self.chunk_size = chunk_size
+        self.interval = interval
+        self.flow_control = flow_control
+        self.sent = 0
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.cancelled = False
+        self.done_event = threading.Event()
+
+    def cancel(self):
+        self.cancelled = True
+
+    @property
+    def done(self) -> bool:
+        return self.done_event.is_set()
+
+    @property
+    def throughput(self) -> float:
+        """Achieved rate in bytes/s."""
+        if self.started is None:
+            return 0.0
+        end = self.finished if self.finished is not None else time.monotonic()
+        return self.sent / max(end - self.started, 1e-9)
+
+
+class WriteEngine:
+    """Write to a serial port from a background thread.
+
+    Sends are queued in a bounded queue so the caller never waits on a slow
+    or flow controlled device. Every block actually written is passed to
+    on_write from the writer thread.
+    """
+
+    def __init__(self, ser, on_write=None, max_queue: int = DEFAULT_SEND_QUEUE, on_error=None):
+        self.ser = ser
+        self.on_write = on_write
+        self.on_error = on_error
+        self._queue = queue.Queue(max_queue)
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=f'write-{self.ser.port}', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 1.0):
+        self._stop_event.set()
+        # Drop whatever is still queued so the wake up fits
+        self._discard()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # Refilled meanwhile, the thread checks the stop event after its current job
+            pass
+        if self._thread is not None and self._thread is not threading.current_thread():
+            # A write blocked by flow control only returns once the port is closed
+            self._thread.join(timeout)
+        self._thread = None
+        self._discard()
+
+    def _discard(self):
+        # Queued transfers that will never run are finished as cancelled, so nobody waits on them
+        try:
+            while True:
+                job = self._queue.get_nowait()
+                if isinstance(job, FileTransfer):
+                    job.cancel()
+                    job.done_event.set()
+        except queue.Empty:
+            pass
+
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize()
+
+    def write(self, data: bytes, block: bool = False) -> bool:
+        """Queue data to be written in a single write, returns False if the queue is full."""
+        return self._put(data, block)
+
+    def send_file(self, transfer: FileTransfer, block: bool = False) -> bool:
+        return self._put(transfer, block)
+
+    def _put(self, job, block: bool) -> bool:
+        if self._stop_event.is_set():
+            return False
+        try:
+            self._queue.put(job, block)
+        except queue.Full:
+            return False
+        return True
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            job = self._queue.get()
+            if job is None:
+                break
+            try:
+                if isinstance(job, FileTransfer):
+                    self._send_file(job)
+                else:
+                    self._write(job)
+            except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                if not self._stop_event.is_set():
+                    print(f'Write error on {self.ser.port}: {e}', file=sys.stderr)
+                    if self.on_error is not None:
+                        self.on_error(e)
+                break
+        self._discard()
+
+    def _write(self, data: bytes):
+        self.ser.write(data)
+        if self.on_write is not None:
+            self.on_write(data)
+
+    def _send_file(self, transfer: FileTransfer):
+        try:
+            f = open(transfer.path, 'rb')
+        except OSError as e:
+            transfer.error = e
+            transfer.done_event.set()
+            return
+        saved_flow_control = (self.ser.rtscts, self.ser.xonxoff)
+        try:
+            if transfer.flow_control == 'rtscts':
+                self.ser.rtscts = True
+            elif transfer.flow_control == 'xonxoff':
+                self.ser.xonxoff = True
+            with f:
+                transfer.started = time.monotonic()
+                for block in iter(lambda: f.read(transfer.chunk_size), b''):
+                    if transfer.cancelled or self._stop_event.is_set():
+                        break
+                    self._write(block)
+                    transfer.sent += len(block)
+                    if transfer.interval:
+                        self._stop_event.wait(transfer.interval)
+        except (serial.SerialException, OSError) as e:
+            # Still reported through on_error by the caller
+            transfer.error = e
+            raise
+        finally:
+            transfer.finished = time.monotonic()
+            transfer.done_event.set()
+            if self.ser.is_open:
+                self.ser.rtscts, self.ser.xonxoff = saved_flow_control
+
+
+class PortLoop:
+    """Service the reads of many open ports from a single thread.
+
+    Ports backed by a file descriptor are multiplexed with a selector and read
+    without blocking once they are ready, so idle ports cost nothing and N ports
+    need one thread. Ports that can't be selected on (Windows, most URL
+    handlers) fall back to their own ReadEngine blocking in the driver.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        # Registrations are applied on the loop thread, the socket pair wakes it up
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, None)
+        self._calls = collections.deque()
+        self._engines = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def selectable(ser) -> bool:
+        if os.name != 'posix':
+            return False
+        try:
+            return ser.fileno() is not None
+        except (AttributeError, NotImplementedError, OSError):
+            return False
+
+    def add(self, connection):
+        ser = connection.ser
+        if not self.selectable(ser):
+            engine = ReadEngine(ser, connection.feed, chunk_size=connection.chunk_size, on_error=connection.fail)
+            self._engines[connection] = engine
+            engine.start()
+            return
+        # Reads only happen once the selector reports data, never block in them
+        ser.timeout = 0
+        self._call_soon(lambda: self._selector.register(ser.fileno(), selectors.EVENT_READ, connection))
+
+    def remove(self, connection):
+        engine = self._engines.pop(connection, None)
+        if engine is not None:
+            engine.stop()
+            return
+        if threading.current_thread() is self._thread:
+            self._unregister(connection)
+            return
+        done = threading.Event()
+
+        def unregister():
+            self._unregister(connection)
+            done.set()
+
+        self._call_soon(unregister)
+        done.wait(1)
+
+    def _unregister(self, connection):
+        try:
+            self._selector.unregister(connection.ser.fileno())
+        except (KeyError, ValueError, OSError, serial.SerialException):
+            # Already dropped after a read error
+            pass
+
+    def _call_soon(self, call):
+        self._calls.append(call)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='port-loop', daemon=True)
+                self._thread.start()
+        self._wakeup_w.send(b'\0')
+
+    def _run(self):
+        print('Start port loop', file=sys.stderr)
+        while True:
+            for key, _ in self._selector.select():
+                connection = key.data
+                if connection is None:
+                    self._wakeup_r.recv(4096)
+                    while self._calls:
+                        try:
+                            self._calls.popleft()()
+                        except Exception as e:
+                            # e.g. registering a port closed before the call ran
+                            print(f'Port loop call failed: {e!r}', file=sys.stderr)
+                    continue
+                ser = connection.ser
+                try:
+                    # With timeout 0 this returns what is buffered up to chunk_size without
+                    # blocking, in_waiting isn't needed (and socket:// only reports 0 or 1)
+                    data = ser.read(connection.chunk_size)
+                except (serial.SerialException, OSError, TypeError, AttributeError) as e:
+                    # A port that disappears reports ready but returns no data
+                    print(f'Read error on {connection.port}: {e}', file=sys.stderr)
+                    self._drop(connection, e)
+                    continue
+                if data:
+                    try:
+                        connection.feed(data)
+                    except Exception as e:
+                        # A failing listener only takes its own port down, never the loop
+                        print(f'Error handling data from {connection.port}: {e!r}', file=sys.stderr)
+                        self._drop(connection, e)
+
+    def _drop(self, connection, error):
+        self._unregister(connection)
+        try:
+            connection.fail(error)
+        except Exception as e:
+            print(f'Error reporting the failure of {connection.port}: {e!r}', file=sys.stderr)
+
+
+_default_loop = None
+_default_loop_lock = threading.Lock()
+
+
+def default_loop() -> PortLoop:
+    """The PortLoop shared by every connection of the process."""
+    global _default_loop
+    with _default_loop_lock:
+        if _default_loop is None:
+            _default_loop = PortLoop()
+        return _default_loop
+
+
+def parse_send_input(text: str, input_format: str = 'text', encoding: str = DEFAULT_ENCODING) -> bytes:
+    """Turn what was typed to be sent into bytes, raises ValueError on malformed input.
+
+    hex takes pairs of digits optionally separated by spaces, commas or
+    colons and prefixed with 0x, escaped takes Python style escapes such as
+    \\r, \\n, \\t and \\x00.
+    """
+    if input_format == 'hex':
+        return bytes.fromhex(re.sub(r'0[xX]|[\s,:]', '', text))
+    if input_format == 'escaped':
+        return codecs.escape_decode(text.encode(encoding))[0]
+    return text.encode(encoding)
+
+
+# Compiled schema validators by (path, mtime, size)
+_validators = {}
+
+
+def file_key(path: str) -> list:
+    info = os.stat(path)
+    return [info.st_mtime_ns, info.st_size]
+
+
+def file_mode(path: str) -> int:
+    """Permission bits of path, or what open() would give a new file under the current umask."""
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def write_atomic(path: str, text: str):
+    """Replace path with text in one step, a crash mid-write leaves the old file in place."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file as 0600, keep the mode the file had
+        os.chmod(tmp_path, file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def preferences_validator(schema_path: str = SCHEMA_PATH):
+    """The schema compiled into a validator, once per process and schema version."""
+    key = (schema_path, *file_key(schema_path))
+    validator = _validators.get(key)
+    if validator is None:
+        # Both are slow to import and only needed when the preferences changed
+        import yaml
+        from jsonschema.validators import validator_for
+        with open(schema_path, 'r') as f:
+            schema = yaml.safe_load(f)
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+        _validators[key] = validator
+    return validator
+
+
+def read_preferences_cache(cache_path: str, key: list) -> dict:
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('key') != key:
+        return None
+    return cache.get('preferences')
+
+
+def write_preferences_cache(cache_path: str, key: list, preferences: dict):
+    try:
+        write_atomic(cache_path, json.dumps({'key': key, 'preferences': preferences}))
+    except (OSError, TypeError, ValueError) as e:
+        # Only costs the next start a full load
+        print(f'Could not cache preferences: {e}', file=sys.stderr)
+
+
+def load_preferences(path: str = PREFERENCES_PATH, schema_path: str = SCHEMA_PATH,
+                     cache_path: str = PREFERENCES_CACHE_PATH) -> dict:
+    """Load the preferences and validate them against the schema.
+
+    The validated result is cached keyed on the mtime and size of both files,
+    an unchanged setup loads from the cache without parsing YAML at all.
+    """
+    key = [file_key(path), file_key(schema_path)]
+    preferences = read_preferences_cache(cache_path, key)
+    if preferences is not None:
+        return preferences
+
+    import yaml
+    with open(path, 'r') as f:
+        preferences = yaml.safe_load(f)
+    # Profiles and sections are all checked in one pass of the compiled schema
+    preferences_validator(schema_path).validate(preferences)
+    write_preferences_cache(cache_path, key, preferences)
+    return preferences
+
+
+def save_preferences(preferences: dict, path: str = PREFERENCES_PATH, schema_path: str = SCHEMA_PATH,
+                     cache_path: str = PREFERENCES_CACHE_PATH):
+    import yaml
+    from jsonschema.exceptions import ValidationError
+    text = yaml.dump(preferences)
+    try:
+        with open(path, 'r') as f:
+            unchanged = f.read() == text
+    except OSError:
+        unchanged = False
+    if not unchanged:
+        write_atomic(path, text)
+    # Keep the cache warm for the next start, as long as what was saved would load
+    try:
+        preferences_validator(schema_path).validate(preferences)
+    except ValidationError as e:
+        print(f'Saved preferences do not match the schema: {e.message}', file=sys.stderr)
+        return
+    write_preferences_cache(cache_path, [file_key(path), file_key(schema_path)], preferences)
+
+
+def list_devices():
+    serial_devs = []
+    system_platform = platform.system()
+
+    # For some reason that I ignore, serial.tools.list_ports takes forever to run
+    # in Win 11, so fetch the com ports from the winreg entry instead.
+    if system_platform == 'Windows':
+        import winreg
+        # This can drop an exception maybe
+        try:
+            key = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, 'HARDWARE\\DEVICEMAP\\SERIALCOMM')
+        except:
+            print("No serial ports found", file=sys.stderr)
+            return serial_devs
+
+        i = 0
+        # iter over the possible values
+        while True:
+            try:
+                serial_devs.append(winreg.EnumValue(key, i)[1])
+                i += 1
+            except:
+                # end of entries
+                break
+
+    # For Linux and Mac serial.tools works just fine
+    if system_platform == 'Linux' or system_platform == 'Darwin':
+        from serial.tools import list_ports
+        ports = list(list_ports.comports(True))
+
+        for port in ports:
+            serial_devs.append(port.device)
+
+    return serial_devs
+
+
+def open_serial(port: str, profile: dict):
+    """Open a port, or a pyserial URL such as loop://, with the settings of a connection profile.
+
+    replay://PATH[?speed=N|max] plays a capture file back as a port.
+    """
+    if port.startswith('replay://'):
+        # Imported here, sermon_replay builds on this module
+        from sermon_replay import ReplaySerial
+        return ReplaySerial(port,
+                            baudrate=int(profile['baud_rate']),
+                            bytesize=int(profile['data_bits']),
+                            parity=profile['parity'],
+                            stopbits=float(profile['stop_bits']))
+    return serial.serial_for_url(port,
+                                 baudrate=int(profile['baud_rate']),
+                                 bytesize=int(profile['data_bits']),
+                                 parity=profile['parity'],
+                                 stopbits=float(profile['stop_bits']))
+
+
+class PtyPort:
+    """A virtual port on a pseudo-terminal pair (POSIX only), the port is opened by name and its
+    traffic is written to and read from the master side, e.g. by a benchmark or a fake device."""
+
+    def __init__(self):
+        import pty
+        import tty
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+
+    def write(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class SerialConnection:
+    """An open port serviced by a PortLoop, shared by the GUI and headless front ends.
+
+    Received chunks are passed to every listener on the loop thread, which
+    services all the open ports, as listener(data, timestamp) with the
+    monotonic ns the chunk was read at, the same stamp the stats and triggers
+    get. Listeners must only queue the data and never block.
+    """
+
+    def __init__(self, port: str, profile: dict, chunk_size: int = DEFAULT_CHUNK_SIZE, loop: PortLoop = None):
+        self.port = port
+        self.profile = profile
+        self.chunk_size = chunk_size
+        self.loop = loop if loop is not None else default_loop()
+        self.ser = open_serial(port, profile)
+        self.stats = ConnectionStats(port, self.ser)
+        self.listeners = []
+        self.tx_listeners = []
+        self.on_error = None
+        # TriggerEngine matching every chunk before the listeners see it
+        self.triggers = None
+        self.writer = WriteEngine(self.ser, on_write=self.on_write, on_error=self.fail)
+
+    def start(self):
+        self.writer.start()
+        self.loop.add(self)
+
+    def close(self):
+        self.loop.remove(self)
+        self.writer.stop()
+        self.ser.close()
+
+    @property
+    def is_open(self) -> bool:
+        return self.ser.is_open
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        # A new list rather than remove(), the loop thread may be iterating over the current one
+        self.listeners = [other for other in self.listeners if other != listener]
+
+    def add_tx_listener(self, listener):
+        """listener is called from the writer thread with every block written to the port."""
+        self.tx_listeners.append(listener)
+
+    def send(self, data: bytes, cr: bool = False, lf: bool = False, block: bool = False) -> bytes:
+        """Queue data with the selected line terminator as a single write.
+
+        Returns what will be written, or None if the send queue is full and block is False.
+        """
+        if cr:
+            data += serial.CR
+        if lf:
+            data += serial.LF
+        if not self.writer.write(data, block):
+            return None
+        return data
+
+    def send_file(self, path: str, chunk_size: int = DEFAULT_SEND_CHUNK_SIZE, interval: float = 0.0,
+                  flow_control: str = 'none') -> FileTransfer:
+        """Queue a file to be streamed to the port, returns the transfer or None if the send queue is full."""
+        transfer = FileTransfer(path, chunk_size, interval, flow_control)
+        if not self.writer.send_file(transfer):
+            return None
+        return transfer
+
+    def on_write(self, data: bytes):
+        self.stats.on_tx(data)
+        for listener in self.tx_listeners:
+            listener(data)
+
+    def feed(self, data: bytes):
+        timestamp = time.monotonic_ns()
+        self.stats.on_rx(data, timestamp)
+        triggers = self.triggers
+        if triggers is not None:
+            triggers.feed(data, timestamp)
+        for listener in self.listeners:
+            listener(data, timestamp)
+
+    def fail(self, error):
+        if self.on_error is not None:
+            self.on_error(error)
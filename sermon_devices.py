@@ -0,0 +1,242 @@
+import glob
+import os
+import platform
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+
+from sermon_core import list_devices
+
+BY_ID_PATH = '/dev/serial/by-id'
+WATCH_PATHS = ('/dev', BY_ID_PATH)
+# Device nodes worth a rescan when they come and go in /dev
+DEVICE_PREFIXES = (b'tty', b'cu.', b'rfcomm', b'serial')
+DEFAULT_POLL_INTERVAL = 1.0  # in s
+# With inotify a full rescan only guards against missed events
+INOTIFY_RESCAN_INTERVAL = 30.0  # in s
+# udev adds the by-id links and permissions right after the node, let it settle before scanning
+SETTLE_TIME = 0.02  # in s
+# A node that just showed up may not be openable yet, how often and how long to retry
+RECONNECT_RETRY_INTERVAL = 0.05  # in s
+RECONNECT_RETRIES = 20
+
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ATTRIB = 0x004
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def open_inotify(paths):
+    """Set up an inotify fd for created and removed entries in paths.
+
+    Returns (fd, add_watches) where add_watches() (re)adds the paths that exist
+    and returns {wd: path}, or None where inotify isn't available.
+    """
+    if platform.system() != 'Linux':
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    def add_watches():
+        watches = {}
+        for path in paths:
+            if os.path.isdir(path):
+                wd = libc.inotify_add_watch(fd, path.encode(), IN_CREATE | IN_DELETE | IN_ATTRIB
+                                            | IN_MOVED_FROM | IN_MOVED_TO)
+                if wd >= 0:
+                    watches[wd] = path
+        return watches
+
+    return fd, add_watches
+
+
+def scan_devices() -> dict:
+    """Return {device: identity} for the available ports.
+
+    The identity holds what survives a re-enumeration: the USB serial number,
+    vid and pid and the /dev/serial/by-id link where there is one.
+    """
+    if platform.system() not in ('Linux', 'Darwin'):
+        # list_ports is too slow on Windows, COM port names are stable there anyway
+        return {device: {'port': device} for device in list_devices()}
+    from serial.tools import list_ports
+    by_id = {}
+    for link in glob.glob(os.path.join(BY_ID_PATH, '*')):
+        by_id[os.path.realpath(link)] = link
+    devices = {}
+    for info in list_ports.comports(True):
+        identity = {'port': info.device}
+        if info.serial_number:
+            identity['serial_number'] = info.serial_number
+            identity['vid'] = info.vid
+            identity['pid'] = info.pid
+        link = by_id.get(os.path.realpath(info.device))
+        if link is not None:
+            identity['by_id'] = link
+        devices[info.device] = identity
+    return devices
+
+
+class DeviceWatcher:
+    """Keep the list of serial devices up to date from a background thread.
+
+    On Linux /dev and /dev/serial/by-id are watched with inotify so a device
+    is picked up as soon as udev creates it, elsewhere the ports are polled
+    every poll_interval. on_change is called from the watcher thread with
+    the new device list whenever it changes.
+    """
+
+    def __init__(self, on_change=None, poll_interval: float = DEFAULT_POLL_INTERVAL, paths=WATCH_PATHS,
+                 scan=scan_devices):
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.paths = paths
+        self.scan = scan
+        self.identities = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._refresh_event = threading.Event()
+        self._stop_event = threading.Event()
+        # select() only takes sockets on Windows
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._thread = None
+
+    @property
+    def devices(self) -> list:
+        with self._lock:
+            return list(self.identities)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='device-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        with self._changed:
+            self._changed.notify_all()
+        self._wake_w.send(b'\0')
+        if self._thread is not None:
+            self._thread.join()
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def refresh(self):
+        """Rescan right away, without waiting for an event or the next poll."""
+        self._refresh_event.set()
+        self._wake_w.send(b'\0')
+
+    def identity(self, port: str) -> dict:
+        """What identifies port across re-enumeration, from the last scan."""
+        with self._lock:
+            identity = self.identities.get(port)
+            if identity is None:
+                # Opened through a by-id link or another alias of the node
+                real_port = os.path.realpath(port)
+                for device, candidate in self.identities.items():
+                    if candidate.get('by_id') == port or os.path.realpath(device) == real_port:
+                        identity = candidate
+                        break
+        return dict(identity) if identity is not None else {'port': port}
+
+    def find(self, identity: dict) -> str:
+        """Return the current device matching identity, None if it isn't there."""
+        with self._lock:
+            return self._find(identity)
+
+    def wait_for(self, identity: dict, timeout: float = None) -> str:
+        """Block until a device matching identity is present, None on timeout or stop."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._changed:
+            while not self._stop_event.is_set():
+                device = self._find(identity)
+                if device is not None:
+                    return device
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+        return None
+
+    def _find(self, identity: dict) -> str:
+        for device, candidate in self.identities.items():
+            if 'serial_number' in identity:
+                if (candidate.get('serial_number') == identity['serial_number']
+                        and candidate.get('vid') == identity['vid'] and candidate.get('pid') == identity['pid']):
+                    return device
+            elif 'by_id' in identity:
+                if candidate.get('by_id') == identity['by_id']:
+                    return device
+            elif device == identity['port']:
+                return device
+        return None
+
+    def _update(self):
+        try:
+            identities = self.scan()
+        except OSError as e:
+            print(f'Device scan failed: {e}', file=sys.stderr)
+            return
+        with self._changed:
+            changed = identities != self.identities
+            self.identities = identities
+            self._changed.notify_all()
+        if changed and self.on_change is not None:
+            self.on_change(list(identities))
+
+    def _run(self):
+        inotify = open_inotify(self.paths)
+        if inotify is not None:
+            inotify_fd, add_watches = inotify
+            watches = add_watches()
+            print(f'Watching {", ".join(watches.values())} for devices', file=sys.stderr)
+        else:
+            inotify_fd = None
+            print(f'Polling for devices every {self.poll_interval} s', file=sys.stderr)
+        fds = [self._wake_r] + ([inotify_fd] if inotify_fd is not None else [])
+        interval = self.poll_interval if inotify_fd is None else INOTIFY_RESCAN_INTERVAL
+        self._update()
+        try:
+            while not self._stop_event.is_set():
+                ready, _, _ = select.select(fds, [], [], interval)
+                relevant = self._refresh_event.is_set() or not ready
+                self._refresh_event.clear()
+                if self._wake_r in ready:
+                    self._wake_r.recv(64)
+                if inotify_fd in ready:
+                    time.sleep(SETTLE_TIME)
+                    relevant |= self._read_events(inotify_fd, watches)
+                    # by-id only exists once the first USB serial device shows up
+                    watches = add_watches()
+                if relevant and not self._stop_event.is_set():
+                    self._update()
+        finally:
+            if inotify_fd is not None:
+                os.close(inotify_fd)
+
+    @staticmethod
+    def _read_events(inotify_fd: int, watches: dict) -> bool:
+        relevant = False
+        while True:
+            try:
+                buf = os.read(inotify_fd, 4096)
+            except BlockingIOError:
+                return relevant
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, pos)
+                name = buf[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b'\0')
+                pos += INOTIFY_EVENT.size + length
+                if watches.get(wd) != '/dev' or name.startswith(DEVICE_PREFIXES):
+                    relevant = True
@@ -0,0 +1,225 @@
+import struct
+
+from sermon_core import DEFAULT_ENCODING, DEFAULT_DECODE_ERRORS, TX, format_bytes
+
+SLIP_END = b'\xc0'
+SLIP_ESC = b'\xdb'
+FRAMERS = ('line', 'slip', 'cobs', 'fixed', 'length')
+# A delimited frame longer than this is passed on as is, and a longer length field
+# is taken for garbage, so a stream that never contains the delimiter or a valid
+# header doesn't accumulate without bound. max_frame_size in the framing section
+# changes it for protocols with bigger frames
+DEFAULT_MAX_FRAME_SIZE = 64 * 1024
+
+
+class LineFramer:
+    """Frames separated by a delimiter, newline by default."""
+
+    def __init__(self, delimiter: bytes = b'\n', max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        self.delimiter = delimiter
+        self.max_frame_size = max_frame_size
+        self.reset()
+
+    def reset(self):
+        self._pending = b''
+
+    def feed(self, data: bytes) -> list:
+        frames = (self._pending + data).split(self.delimiter)
+        self._pending = frames.pop()
+        if len(self._pending) > self.max_frame_size:
+            frames.append(self._pending)
+            self._pending = b''
+        return frames
+
+
+class SlipFramer(LineFramer):
+    """RFC 1055 SLIP, frames end with 0xC0 and 0xC0/0xDB in the payload are escaped."""
+
+    def __init__(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        super(SlipFramer, self).__init__(SLIP_END, max_frame_size)
+
+    def feed(self, data: bytes) -> list:
+        # Empty frames come from the END sent before each frame to flush line noise
+        return [frame.replace(b'\xdb\xdc', SLIP_END).replace(b'\xdb\xdd', SLIP_ESC)
+                for frame in super(SlipFramer, self).feed(data) if frame]
+
+
+class CobsFramer(LineFramer):
+    """Consistent Overhead Byte Stuffing, frames are zero terminated and contain no other zero."""
+
+    def __init__(self, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        super(CobsFramer, self).__init__(b'\x00', max_frame_size)
+        # Frames whose code bytes run past their end, usually the first one after connecting mid-stream
+        self.dropped = 0
+
+    def feed(self, data: bytes) -> list:
+        frames = []
+        for frame in super(CobsFramer, self).feed(data):
+            if frame:
+                frame = cobs_decode(frame)
+                if frame is None:
+                    self.dropped += 1
+                else:
+                    frames.append(frame)
+        return frames
+
+
+def cobs_decode(frame: bytes) -> bytes:
+    """Decode one COBS frame without its zero terminator, None if it is malformed."""
+    # Walks the code bytes, so the cost is per block of up to 254 bytes rather than per byte
+    blocks = []
+    pos = 0
+    end = len(frame)
+    while pos < end:
+        code = frame[pos]
+        if pos + code > end:
+            return None
+        blocks.append(frame[pos + 1:pos + code])
+        pos += code
+        if code < 0xff and pos < end:
+            blocks.append(b'\x00')
+    return b''.join(blocks)
+
+
+class FixedFramer:
+    """Frames of a constant size."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self._pending = b''
+
+    def feed(self, data: bytes) -> list:
+        buf = memoryview(self._pending + data)
+        end = len(buf) - len(buf) % self.size
+        self._pending = bytes(buf[end:])
+        return [bytes(buf[pos:pos + self.size]) for pos in range(0, end, self.size)]
+
+
+class LengthFramer:
+    """Frames starting with a header that holds their length.
+
+    The length field is read with length_format at length_offset in a header
+    of header_size bytes, and counts the payload after the header unless
+    length_includes_header is set. Frames are returned with their header, a
+    length making a frame bigger than max_frame_size is taken for garbage.
+    """
+
+    def __init__(self, length_format: str = '<H', length_offset: int = 0, header_size: int = None,
+                 length_includes_header: bool = False, max_frame_size: int = DEFAULT_MAX_FRAME_SIZE):
+        self.length = struct.Struct(length_format)
+        self.length_offset = length_offset
+        self.header_size = max(header_size or 0, length_offset + self.length.size)
+        self.length_includes_header = length_includes_header
+        self.max_frame_size = max_frame_size
+        self.reset()
+
+    def reset(self):
+        self._pending = b''
+
+    def feed(self, data: bytes) -> list:
+        buf = memoryview(self._pending + data)
+        frames = []
+        pos = 0
+        end = len(buf)
+        extra = 0 if self.length_includes_header else self.header_size
+        while end - pos >= self.header_size:
+            size = self.length.unpack_from(buf, pos + self.length_offset)[0] + extra
+            if size < self.header_size or size > self.max_frame_size:
+                # Garbage length, resynchronize one byte further
+                pos += 1
+                continue
+            if end - pos < size:
+                break
+            frames.append(bytes(buf[pos:pos + size]))
+            pos += size
+        self._pending = bytes(buf[pos:])
+        return frames
+
+
+def make_framer(framing: dict):
+    """Build the framer described by the framing section of a connection profile."""
+    framer = framing['framer']
+    max_frame_size = framing.get('max_frame_size', DEFAULT_MAX_FRAME_SIZE)
+    if framer == 'line':
+        return LineFramer(framing.get('delimiter', '\n').encode('latin-1'), max_frame_size)
+    if framer == 'slip':
+        return SlipFramer(max_frame_size)
+    if framer == 'cobs':
+        return CobsFramer(max_frame_size)
+    if framer == 'fixed':
+        return FixedFramer(framing['size'])
+    if framer == 'length':
+        return LengthFramer(framing.get('length_format', '<H'), framing.get('length_offset', 0),
+                            framing.get('header_size'), framing.get('length_includes_header', False),
+                            max_frame_size)
+    raise ValueError(f'unknown framer {framer}')
+
+
+class FrameLayout:
+    """struct layout of a frame, with optional names for the unpacked values."""
+
+    def __init__(self, layout: dict):
+        self.struct = struct.Struct(layout['format'])
+        self.fields = layout.get('fields', [])
+
+    def format(self, frame: bytes) -> str:
+        if len(frame) < self.struct.size:
+            return None
+        values = self.struct.unpack_from(frame)
+        names = self.fields
+        return ' '.join([f'{names[i]}={value}' if i < len(names) else str(value)
+                         for i, value in enumerate(values)])
+
+
+class FrameFormatter:
+    """Render the received stream one frame per row.
+
+    A drop-in for OutputFormatter when the connection profile has a framing
+    section: whole batches of chunks are split by the framer and each frame is
+    unpacked with the profile layout, or shown in the selected output format
+    when there is none or it doesn't fit.
+    """
+
+    def __init__(self, framing: dict, output_format: str = 'txt', encoding: str = DEFAULT_ENCODING,
+                 errors: str = DEFAULT_DECODE_ERRORS):
+        self.framing = framing
+        self.output_format = output_format
+        self.encoding = encoding
+        self.errors = errors
+        self.layout = FrameLayout(framing['layout']) if 'layout' in framing else None
+        self.framer = make_framer(framing)
+
+    def reset(self):
+        self.framer.reset()
+
+    def format_frame(self, frame: bytes) -> str:
+        if self.layout is not None:
+            out_str = self.layout.format(frame)
+            if out_str is not None:
+                return out_str
+        if self.output_format == 'hex':
+            return '0x' + frame.hex(' ').replace(' ', ' 0x') if frame else ''
+        if self.output_format == 'bytes':
+            return format_bytes(frame, 'bytes').replace('\n', '')
+        return frame.decode(self.encoding, self.errors)
+
+    def format_rx(self, data: bytes) -> str:
+        return ''.join([self.format_frame(frame) + '\n' for frame in self.framer.feed(data)])
+
+    def format_tx(self, data: bytes) -> str:
+        return '--> ' + format_bytes(data, self.output_format, self.encoding, self.errors).rstrip('\n') + '\n'
+
+    def format(self, direction: int, data: bytes, source: str = None) -> str:
+        if direction == TX:
+            return self.format_tx(data)
+        return self.format_rx(data)
+
+    def render(self, segments) -> str:
+        self.reset()
+        return ''.join([self.format(direction, data) for direction, data, _ in segments])
+
+    def copy(self):
+        return FrameFormatter(self.framing, self.output_format, self.encoding, self.errors)
@@ -0,0 +1,1466 @@
+import tkinter as tk
+from tkinter import ttk
+import tkinter.messagebox as tk_msg
+import tkinter.simpledialog as tk_dialog
+from tkinter import filedialog
+
+import enum
+import re
+import struct
+import sys
+import threading
+import time
+
+import serial
+
+from sermon_core import (ChunkQueue, OutputFormatter, MergedFormatter, Scrollback, SerialConnection, Timeline,
+                         TimestampFormatter, RX, TX, TIMESTAMP_MODES,
+                         load_preferences, save_preferences, parse_send_input, DEFAULT_CHUNK_SIZE,
+                         DEFAULT_ENCODING, DEFAULT_DECODE_ERRORS, DEFAULT_SCROLLBACK_LINES, DEFAULT_SCROLLBACK_BYTES,
+                         DEFAULT_SCROLLBACK_CHARS, DEFAULT_FRAME_RATE, DEFAULT_SEND_CHUNK_SIZE, SEND_INPUT_FORMATS,
+                         wrap_lines)
+from sermon_bridge import SerialBridge, DEFAULT_BRIDGE_ADDRESS, DEFAULT_CLIENT_BUFFER
+from sermon_capture import CaptureWriter, CAPTURE_EXTENSION
+from sermon_devices import DeviceWatcher, DEFAULT_POLL_INTERVAL, RECONNECT_RETRIES, RECONNECT_RETRY_INTERVAL
+from sermon_frames import FrameFormatter
+from sermon_plot import PlotSource, make_extractor, DEFAULT_PLOT_HISTORY, DEFAULT_PLOT_WINDOW
+from sermon_replay import ReplaySerial, REPLAY_SCHEME, REPLAY_SPEEDS
+from sermon_search import SessionHistory, compile_query
+from sermon_stats import StatsExporter, format_size, format_stats
+from sermon_triggers import TriggerEngine
+
+# How often the Tk event loop lag is probed, in ms
+LAG_PROBE_INTERVAL = 100
+# How often the progress of a file being sent is refreshed, in ms
+TRANSFER_POLL_INTERVAL = 100
+# How often the position of a replayed capture is refreshed, in ms
+REPLAY_POLL_INTERVAL = 200
+DEFAULT_PLOT_FRAME_RATE = 20
+PLOT_WINDOWS = ('1', '5', '10', '30', '60', '300')  # in s
+PLOT_MARGIN = 8  # in px
+PLOT_COLORS = ('#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f',
+               '#bcbd22', '#17becf', '#000080', '#808000')
+DEFAULT_STATS_INTERVAL = 1.0  # in s
+
+class DevState(enum.Enum):
+    NC = 0
+    CONNECTED = 1
+    # Lost, waiting for the same device to show up again
+    RECONNECTING = 2
+
+
+class OutputView(tk.Frame):
+    """Output pane of one port: its raw scrollback, connection and Text widget."""
+
+    def __init__(self, app, port: str = None):
+        super(OutputView, self).__init__(app.output_notebook)
+        self.app = app
+        self.port = port
+        self.conn_status = DevState.NC
+        self.connection = None
+        # Streams every received and sent chunk of this port to disk while set
+        self.recorder = None
+        # Everything received since connecting, searchable past the scrollback
+        self.history = None
+        # File being streamed to the port
+        self.transfer = None
+        # What the device is recognised by when it comes back after a reset
+        self.identity = None
+        # Serves the port to socket clients while set
+        self.bridge = None
+        # Sources of the open plot windows
+        self.plots = []
+        # Triggers of the connection profile, kept across reconnects with their counters
+        self.triggers = None
+        # (tag, regex) of the highlight triggers, applied to the rendered text
+        self.highlights = []
+        # (wall time, trigger name, stream offset) of the mark triggers that fired
+        self.marks = []
+
+        # Received chunks wait here until the next UI update drains them
+        self.rx_queue = ChunkQueue()
+        # Output is not rendered while hidden, scrolled up or minimized, the widget is
+        # rebuilt from the scrollback once it is visible again
+        self.output_stale = False
+        # Characters in the widget and in its last line, long lines are broken so it can be trimmed by lines
+        self.output_chars = 0
+        self.output_column = 0
+
+        # Everything received and sent is kept as raw bytes, the formatter renders it for the
+        # selected output format and the whole scrollback is re-rendered when it changes.
+        self.scrollback = Scrollback(max_lines=app.scrollback_lines, max_bytes=app.scrollback_bytes)
+        # Arrival time of every received chunk, stamped on the read thread
+        self.timeline = Timeline()
+        self.formatter = self.new_formatter()
+
+        self.output_scrollbar = tk.Scrollbar(self)
+        self.output_text = tk.Text(self, yscrollcommand=self.on_output_scroll)
+        self.output_text.configure(state="disabled", bg="#eeeeee", fg="#999999")
+        self.output_scrollbar.config(command=self.output_text.yview)
+        self.output_text.grid(row=0, column=0, sticky="nswe")
+        self.output_scrollbar.grid(row=0, column=1, sticky="nse")
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+
+    @property
+    def title(self) -> str:
+        return self.port if self.port is not None else 'No device'
+
+    def new_formatter(self):
+        # Framed protocols are shown one decoded frame per row
+        framing = self.connection.profile.get('framing') if self.connection is not None else None
+        if framing:
+            formatter = FrameFormatter(framing, self.app.output_format_var.get(),
+                                       encoding=self.app.display_settings.get('encoding', DEFAULT_ENCODING),
+                                       errors=self.app.display_settings.get('decode_errors', DEFAULT_DECODE_ERRORS))
+        else:
+            formatter = OutputFormatter(self.app.output_format_var.get(),
+                                        encoding=self.app.display_settings.get('encoding', DEFAULT_ENCODING),
+                                        errors=self.app.display_settings.get('decode_errors', DEFAULT_DECODE_ERRORS))
+        timestamps = self.app.timestamp_select.get()
+        if timestamps != 'none':
+            formatter = TimestampFormatter(formatter, self.timeline, timestamps)
+        return formatter
+
+    def reset_formatter(self):
+        self.formatter = self.new_formatter()
+        if self.output_visible():
+            self.output_refresh()
+        else:
+            self.output_stale = True
+
+    def set_connected(self, connected: bool):
+        if connected:
+            self.conn_status = DevState.CONNECTED
+            self.output_text.configure(fg='#000000', bg='#ffffff')
+        else:
+            self.conn_status = DevState.NC
+            self.output_text.configure(bg="#eeeeee", fg="#999999")
+
+    def set_reconnecting(self):
+        self.conn_status = DevState.RECONNECTING
+        self.output_text.configure(bg="#eeeeee", fg="#000000")
+
+    def on_serial_data(self, data: bytes, timestamp: int, source: str = None):
+        # Called from the read thread with the time the chunk was read,
+        # recording only queues the chunk so it never blocks here
+        self.timeline.add(len(data), timestamp)
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write(RX, data, timestamp)
+        history = self.history
+        if history is not None:
+            history.append(data)
+        for plot in self.plots:
+            plot.on_serial_data(data, timestamp)
+        # only schedule an update if none is pending
+        if self.rx_queue.put(data, source):
+            self.app.after(self.app.update_interval, self.update_text_box)
+
+    def on_serial_tx(self, data: bytes):
+        # Called from the writer thread with what was actually written
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.write(TX, data)
+
+    def update_text_box(self):
+        chunks = self.rx_queue.drain_sourced()
+        for source, data in chunks:
+            self.append(RX, data, source)
+        if chunks and self.connection is not None:
+            # From the arrival of the oldest chunk of the batch until it is in the widget
+            self.connection.stats.latency.add((time.monotonic_ns() - self.rx_queue.drained_since) / 1e6)
+
+    def append(self, direction: int, data: bytes, source: str = None):
+        self.scrollback.append(direction, data, source)
+        if self.output_visible():
+            self.output_append(self.formatter.format(direction, data, source))
+        else:
+            self.output_stale = True
+
+    def set_output_format(self, output_format: str):
+        self.formatter.output_format = output_format
+        if self.output_visible():
+            self.output_refresh()
+        else:
+            self.output_stale = True
+
+    def output_refresh(self):
+        # Rebuild the widget from the newest part of the scrollback
+        self.output_stale = False
+        self.output_text.configure(state="normal")
+        self.output_text.delete(1.0, tk.END)
+        segments = self.scrollback.segments(self.app.scrollback_lines, max_chars=self.app.scrollback_chars,
+                                            encoding=self.formatter.encoding)
+        if isinstance(self.formatter, TimestampFormatter):
+            self.formatter.offset = self.scrollback.rx_offset(len(segments))
+        out_str = self.formatter.render(segments)
+        if len(out_str) > self.app.scrollback_chars:
+            # Hex and bytes render more than a character per byte, only the newest part is inserted
+            out_str = out_str[-self.app.scrollback_chars:]
+        out_str, self.output_column = wrap_lines(out_str)
+        self.output_chars = len(out_str)
+        self.output_text.insert("end", out_str)
+        self.highlight("1.0")
+        self.output_trim()
+        self.output_text.see(tk.END)
+        self.output_text.configure(state="disabled")
+
+    def output_visible(self) -> bool:
+        return (self.app.state() != 'iconic' and self.app.current_view() is self
+                and self.output_text.yview()[1] >= 1.0)
+
+    def on_output_scroll(self, first, last):
+        self.output_scrollbar.set(first, last)
+        # Catch up once the user scrolls back to the bottom
+        if self.output_stale and float(last) >= 1.0:
+            self.output_stale = False
+            self.app.after_idle(self.output_refresh)
+
+    def output_trim(self):
+        end_line = int(self.output_text.index('end-1c').split('.')[0])
+        excess = end_line - self.app.scrollback_lines
+        if excess >= self.app.trim_batch:
+            self.output_delete(f'{excess + 1}.0')
+        excess_chars = self.output_chars - self.app.scrollback_chars
+        if excess_chars >= self.app.trim_chars_batch:
+            # Up to the start of the next line, which is at most one broken line more
+            self.output_delete(f'1.0 + {excess_chars} chars + 1 lines linestart')
+
+    def output_delete(self, end: str):
+        # Delete from the start of the widget to end, keeping count of the characters left
+        deleted = self.output_text.count(1.0, end, 'chars')
+        self.output_text.delete(1.0, end)
+        self.output_chars -= deleted[0] if deleted else 0
+
+    def output_append(self, out_str: str):
+        self.output_text.configure(state="normal")
+        start = self.output_text.index("end-1c")
+        out_str, self.output_column = wrap_lines(out_str, self.output_column)
+        self.output_chars += len(out_str)
+        self.output_text.insert("end", out_str)
+        self.highlight(start)
+        self.output_trim()
+        self.output_text.see(tk.END)
+        self.output_text.configure(state="disabled")
+
+    def set_triggers(self, triggers: TriggerEngine):
+        self.triggers = triggers
+        self.highlights = []
+        for index, trigger in enumerate(triggers.triggers if triggers is not None else []):
+            if trigger.action != 'highlight':
+                continue
+            tag = f'trigger{index}'
+            self.output_text.tag_configure(tag, background=trigger.color)
+            self.highlights.append((tag, re.compile(trigger.text_pattern, re.IGNORECASE if trigger.ignore_case else 0)))
+
+    def highlight(self, start: str):
+        # Tag the matches of the highlight triggers in the text inserted from start
+        if not self.highlights:
+            return
+        text = self.output_text.get(start, "end-1c")
+        for tag, regex in self.highlights:
+            for match in regex.finditer(text):
+                if match.end() > match.start():
+                    self.output_text.tag_add(tag, f'{start}+{match.start()}c', f'{start}+{match.end()}c')
+
+    def output_clear(self):
+        self.scrollback.clear()
+        self.formatter.reset()
+        self.output_stale = False
+        self.output_text.configure(state="normal")
+        self.output_text.delete(1.0, tk.END)
+        self.output_text.configure(state="disabled")
+        self.output_chars = 0
+        self.output_column = 0
+
+
+class MergedView(OutputView):
+    """Time ordered view of every connected port, each run of output tagged with its port."""
+
+    @property
+    def title(self) -> str:
+        return 'Merged'
+
+    def new_formatter(self):
+        return MergedFormatter(self.app.output_format_var.get(),
+                               encoding=self.app.display_settings.get('encoding', DEFAULT_ENCODING),
+                               errors=self.app.display_settings.get('decode_errors', DEFAULT_DECODE_ERRORS))
+
+
+class FilterWindow(tk.Toplevel):
+    """Lines of a port's session history matching a query, kept up to date as data arrives."""
+
+    def __init__(self, app, view: OutputView, query: str, pattern):
+        super(FilterWindow, self).__init__(app)
+        self.title(f'{view.title}: {query}')
+        self.app = app
+        self.view = view
+        self.pattern = pattern
+        self.live_filter = None
+        self.closed = False
+        self.match_count = 0
+        self.search_status = 'Searching...'
+        # Matches wait here until the next UI update, filled from the search and history threads
+        self.pending = []
+        self.pending_lock = threading.Lock()
+
+        self.output_scrollbar = tk.Scrollbar(self)
+        self.output_text = tk.Text(self, yscrollcommand=self.output_scrollbar.set)
+        self.output_text.configure(state="disabled")
+        self.output_scrollbar.config(command=self.output_text.yview)
+        self.status_label = tk.Label(self, anchor="w", text=self.search_status)
+        self.output_text.grid(row=0, column=0, sticky="nswe")
+        self.output_scrollbar.grid(row=0, column=1, sticky="nse")
+        self.status_label.grid(row=1, column=0, columnspan=2, sticky="we")
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+        threading.Thread(target=self.search, daemon=True).start()
+
+    def search(self):
+        # Search what is already indexed, then follow new lines from exactly where the search stopped
+        history = self.view.history
+        try:
+            matches, searched_lines, truncated, elapsed = history.search(self.pattern)
+            self.on_matches(matches)
+            self.live_filter = history.add_filter(self.pattern, self.on_matches, from_line=searched_lines)
+            if self.closed:
+                history.remove_filter(self.live_filter)
+            status = f'{searched_lines} lines searched in {elapsed * 1000:.0f} ms'
+            if truncated:
+                status += f', stopped after {len(matches)} matches'
+        except Exception as e:
+            # Shown instead of leaving the window searching forever
+            status = f'search failed: {e}'
+        self.search_status = status
+        self.app.after(0, self.update_status)
+
+    def on_matches(self, matches):
+        # Called from the search and history threads
+        if not matches:
+            return
+        with self.pending_lock:
+            schedule = not self.pending
+            self.pending.extend(matches)
+        if schedule:
+            self.app.after(self.app.update_interval, self.update_matches)
+
+    def update_matches(self):
+        if self.closed:
+            return
+        with self.pending_lock:
+            matches = self.pending
+            self.pending = []
+        formatter = self.view.formatter
+        self.match_count += len(matches)
+        at_bottom = self.output_text.yview()[1] >= 1.0
+        self.output_text.configure(state="normal")
+        self.output_text.insert("end", ''.join(f'{line + 1}: {text.decode(formatter.encoding, formatter.errors)}\n'
+                                               for line, text in matches))
+        end_line = int(self.output_text.index('end-1c').split('.')[0])
+        excess = end_line - self.app.scrollback_lines
+        if excess >= self.app.trim_batch:
+            self.output_text.delete(1.0, f'{excess + 1}.0')
+        if at_bottom:
+            self.output_text.see(tk.END)
+        self.output_text.configure(state="disabled")
+        self.update_status()
+
+    def update_status(self):
+        if self.closed:
+            return
+        self.status_label['text'] = f'{self.match_count} matches, {self.search_status}'
+
+    def close(self):
+        self.closed = True
+        if self.live_filter is not None:
+            self.view.history.remove_filter(self.live_filter)
+        if self in self.app.filter_windows:
+            self.app.filter_windows.remove(self)
+        self.destroy()
+
+
+class PlotWindow(tk.Toplevel):
+    """Numeric values extracted from a port, drawn as min/max per pixel column.
+
+    The samples are parsed and bucketed by a PlotSource thread, a redraw only
+    walks the columns, so it costs the same at any sample rate.
+    """
+
+    def __init__(self, app, view: OutputView):
+        settings = app.plot_settings
+        # Before the window exists, a bad pattern or layout raises here
+        extractor = make_extractor(view.connection.profile, settings, view.formatter.encoding)
+        super(PlotWindow, self).__init__(app)
+        self.title(f'{view.title}: plot')
+        self.app = app
+        self.view = view
+        self.closed = False
+        self.redraw_interval = 1000 // settings.get('frame_rate', DEFAULT_PLOT_FRAME_RATE)  # in ms
+        self.source = PlotSource(extractor, history=settings.get('history', DEFAULT_PLOT_HISTORY),
+                                 window=settings.get('window', DEFAULT_PLOT_WINDOW))
+        # Canvas items are created once per channel and only moved afterwards
+        self.lines = {}
+        self.labels = {}
+
+        self.canvas = tk.Canvas(self, width=800, height=300, bg='#ffffff', highlightthickness=0)
+        self.axis_high = self.canvas.create_text(PLOT_MARGIN, PLOT_MARGIN, anchor='nw', fill='#999999')
+        self.axis_low = self.canvas.create_text(PLOT_MARGIN, 0, anchor='sw', fill='#999999')
+        self.window_label = tk.Label(self, text='Window (s)')
+        self.window_select = ttk.Combobox(self, values=PLOT_WINDOWS, width=6)
+        self.window_select.set(f'{self.source.window:g}')
+        self.window_select.bind("<<ComboboxSelected>>", self.handle_window_change)
+        self.window_select.bind("<Return>", self.handle_window_change)
+        self.status_label = tk.Label(self, anchor="w")
+        self.canvas.grid(row=0, column=0, columnspan=3, sticky="nswe")
+        self.window_label.grid(row=1, column=0, sticky="w")
+        self.window_select.grid(row=1, column=1, sticky="w")
+        self.status_label.grid(row=1, column=2, sticky="we")
+        self.grid_columnconfigure(2, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        self.protocol("WM_DELETE_WINDOW", self.close)
+
+        self.source.start()
+        view.plots = view.plots + [self.source]
+        self.after(self.redraw_interval, self.redraw)
+
+    def handle_window_change(self, event=None):
+        try:
+            window = float(self.window_select.get())
+        except ValueError:
+            window = 0
+        if window <= 0:
+            tk_msg.showwarning(title='Plot', message=f'Invalid window: {self.window_select.get()}', parent=self)
+            return
+        self.source.set_view(self.source.columns, window)
+
+    def redraw(self):
+        if self.closed:
+            return
+        width = max(self.canvas.winfo_width() - 2 * PLOT_MARGIN, 1)
+        height = max(self.canvas.winfo_height() - 2 * PLOT_MARGIN, 1)
+        if width != self.source.columns:
+            self.source.set_view(width, self.source.window)
+        snapshot = self.source.snapshot()
+
+        # One y axis for every channel, scaled to what is on screen
+        low = min([value for mins, _, _ in snapshot.values() for value in mins if value == value], default=0.0)
+        high = max([value for _, maxs, _ in snapshot.values() for value in maxs if value == value], default=1.0)
+        if high <= low:
+            low, high = low - 0.5, low + 0.5
+        scale = height / (high - low)
+        bottom = PLOT_MARGIN + height
+
+        for index, (name, (mins, maxs, last)) in enumerate(snapshot.items()):
+            color = PLOT_COLORS[index % len(PLOT_COLORS)]
+            coords = []
+            for x, column_low in enumerate(mins):
+                if column_low == column_low:
+                    coords += (PLOT_MARGIN + x, bottom - (maxs[x] - low) * scale,
+                               PLOT_MARGIN + x, bottom - (column_low - low) * scale)
+            line = self.lines.get(name)
+            if line is None:
+                line = self.lines[name] = self.canvas.create_line(0, 0, 0, 0, fill=color)
+                self.labels[name] = self.canvas.create_text(0, 0, anchor='ne', fill=color)
+            self.canvas.coords(line, *(coords if len(coords) >= 4 else (0, 0, 0, 0)))
+            self.canvas.coords(self.labels[name], PLOT_MARGIN + width, PLOT_MARGIN + index * 14)
+            self.canvas.itemconfigure(self.labels[name], text=f'{name} {last:g}')
+
+        self.canvas.itemconfigure(self.axis_high, text=f'{high:g}')
+        self.canvas.itemconfigure(self.axis_low, text=f'{low:g}')
+        self.canvas.coords(self.axis_low, PLOT_MARGIN, bottom)
+        status = f'{len(snapshot)} channels, {self.source.samples} samples'
+        if self.source.dropped_chunks:
+            status += f', {self.source.dropped_chunks} chunks not plotted'
+        self.status_label['text'] = status
+        self.after(self.redraw_interval, self.redraw)
+
+    def close(self):
+        self.closed = True
+        self.view.plots = [plot for plot in self.view.plots if plot is not self.source]
+        self.source.stop()
+        if self in self.app.plot_windows:
+            self.app.plot_windows.remove(self)
+        self.destroy()
+
+
+class SerialMon(tk.Tk):
+
+    def __init__(self, startup_profile=None):
+        super(SerialMon, self).__init__()
+        self.startup_profile = startup_profile
+        self.mark_startup('Tk root')
+        self.title('Serial Monitor')
+        self.minsize(820, 600)
+        self.resizable(True, True)
+
+        self.preferences = load_preferences()
+        self.mark_startup('preferences')
+        self.display_settings = self.preferences.get('display', {})
+        self.capture_settings = self.preferences.get('capture', {})
+        self.stats_settings = self.preferences.get('stats', {})
+        self.device_settings = self.preferences.get('devices', {})
+        self.send_settings = self.preferences.get('send', {})
+        self.bridge_settings = self.preferences.get('bridge', {})
+        self.plot_settings = self.preferences.get('plot', {})
+
+        self.available_profiles = self.preferences['connection_profiles']
+        self.current_settings = tk.StringVar(value=self.preferences['current_settings']['connection_profile'])
+        # Create menu bar
+        self.menu_bar = tk.Menu(self)
+
+        # Create preferences menu
+        self.preferences_menu = tk.Menu(self.menu_bar, tearoff=0)
+        self.menu_bar.add_cascade(label="Preferences", menu=self.preferences_menu)
+
+        # Create serial port settings menu
+        self.serial_port_settings_menu = tk.Menu(self.preferences_menu, tearoff=0)
+        self.serial_port_settings_menu.add_command(label="Save preset", command=self.show_save_preset_pop)
+        for profile in self.available_profiles:
+            self.serial_port_settings_menu.add_radiobutton(label=profile, value=profile, variable=self.current_settings,
+                                                    command=self.handle_setting_change,
+                                                    indicatoron=1, activebackground='gray')
+
+        self.preferences_menu.add_cascade(label="Serial Port Settings", menu=self.serial_port_settings_menu)
+
+        # Create About menu
+        self.help_menu = tk.Menu(self.menu_bar, tearoff=0)
+        self.help_menu.add_command(label="About", command=self.show_about)
+        self.menu_bar.add_cascade(label="Help", menu=self.help_menu)
+        self.config(menu=self.menu_bar)
+
+        self.devices_frame = ttk.Labelframe(self, text="Devices")
+
+        # Filled in by the device watcher, enumerating can be slow so it never runs on the Tk thread
+        self.devices = []
+        self.device_select = ttk.Combobox(self.devices_frame, values=self.devices)
+        self.device_select.grid(row=0, column=0, sticky="WE", columnspan=2)
+        self.device_select.bind("<<ComboboxSelected>>", self.update_controls)
+        self.device_connect = ttk.Button(self.devices_frame, text="Connect", command=self.handle_device_connection)
+        self.device_connect.grid(row=1, column=0, sticky="E")
+        self.devices_refresh = ttk.Button(self.devices_frame, text="Refresh", command=self.refresh_devices)
+        self.devices_refresh.grid(row=1, column=1, sticky="E")
+        self.auto_reconnect_value = tk.BooleanVar(value=self.device_settings.get('auto_reconnect', False))
+        self.auto_reconnect_check = ttk.Checkbutton(self.devices_frame, text='Auto-reconnect',
+                                                    variable=self.auto_reconnect_value)
+        self.auto_reconnect_check.grid(row=2, column=0, sticky="W")
+        # Plays a capture file back as a port
+        self.replay_btn = ttk.Button(self.devices_frame, text="Replay", command=self.handle_replay)
+        self.replay_btn.grid(row=2, column=1, sticky="E")
+
+        self.devices_frame.grid(row=0, column=0, sticky="W")
+
+        self.settings_frame = ttk.Labelframe(self, text="Connection settings")
+
+        self.baudrate_select = ttk.Combobox(self.settings_frame, values=list(serial.SerialBase.BAUDRATES)[::-1], state="readonly")
+        self.baudrate_label = tk.Label(self.settings_frame, text='Baudrate')
+        self.baudrate_label.grid(row=0, column=0, sticky="WE")
+        self.baudrate_select.grid(row=0, column=1, sticky="WE")
+
+        self.parity_select = ttk.Combobox(self.settings_frame, values=list(serial.SerialBase.PARITIES), state="readonly")
+        self.parity_label = tk.Label(self.settings_frame, text='Parity')
+        self.parity_label.grid(row=1, column=0, sticky="WE")
+        self.parity_select.grid(row=1, column=1, sticky="WE")
+
+        self.bytesize_select = ttk.Combobox(self.settings_frame, values=list(serial.SerialBase.BYTESIZES)[::-1], state="readonly")
+        self.bytesize_label = tk.Label(self.settings_frame, text='Bytesize')
+        self.bytesize_label.grid(row=0, column=2, sticky="WE")
+        self.bytesize_select.grid(row=0, column=3, sticky="WE")
+
+        self.stopbits_select = ttk.Combobox(self.settings_frame, values=list(serial.SerialBase.STOPBITS), state="readonly")
+        self.stopbits_label = tk.Label(self.settings_frame, text='Stopbits')
+        self.stopbits_label.grid(row=1, column=2, sticky="WE")
+        self.stopbits_select.grid(row=1, column=3, sticky="WE")
+
+        self.settings_frame.grid(row=0, column=1, columnspan=2, sticky='NSw')
+
+        self.send_frame = tk.LabelFrame(self, text='Send')
+        self.send_entry = ttk.Entry(self.send_frame)
+        self.send_entry.grid(row=0, column=0, sticky="w")
+        self.send_btn = ttk.Button(self.send_frame, text="Send", command=self.send)
+        self.send_btn.grid(row=0, column=1, sticky="w")
+        self.send_cr_value = tk.BooleanVar()
+        self.send_cr_check = tk.Checkbutton(self.send_frame, text='CR', variable=self.send_cr_value)
+        self.send_lf_value = tk.BooleanVar()
+        self.send_lf_check = tk.Checkbutton(self.send_frame, text='LF', variable=self.send_lf_value)
+        self.send_cr_check.grid(row=0, column=2)
+        self.send_lf_check.grid(row=0, column=3)
+        # Text is sent encoded, hex as '0d 0a' and escaped as '\r\n' or '\x00'
+        self.send_format_select = ttk.Combobox(self.send_frame, values=SEND_INPUT_FORMATS, width=8, state="readonly")
+        self.send_format_select.set('text')
+        self.send_format_select.grid(row=0, column=4)
+        self.send_file_btn = ttk.Button(self.send_frame, text="Send file", command=self.handle_send_file)
+        self.send_file_btn.grid(row=0, column=5)
+        self.send_controls = [self.send_entry, self.send_btn, self.send_cr_check, self.send_lf_check,
+                              self.send_format_select, self.send_file_btn]
+        self.send_progress = ttk.Progressbar(self.send_frame, length=120, maximum=1.0)
+        self.send_progress.grid(row=1, column=0, sticky="we")
+        self.send_progress_label = tk.Label(self.send_frame, anchor="w")
+        self.send_progress_label.grid(row=1, column=1, columnspan=5, sticky="we")
+
+        self.send_entry.bind("<Return>", self.send)
+
+        self.send_frame.grid(row=1, column=0, columnspan=2, sticky="w")
+
+        self.output_frame = tk.Frame(self)
+        # One tab per port, plus the optional merged view
+        self.output_notebook = ttk.Notebook(self.output_frame)
+
+        # Widget updates are coalesced to at most one per frame
+        self.update_interval = 1000 // self.display_settings.get('frame_rate', DEFAULT_FRAME_RATE)  # in ms
+        self.read_chunk_size = DEFAULT_CHUNK_SIZE
+        self.scrollback_lines = self.display_settings.get('scrollback_lines', DEFAULT_SCROLLBACK_LINES)
+        self.scrollback_bytes = self.display_settings.get('scrollback_bytes', DEFAULT_SCROLLBACK_BYTES)
+        self.scrollback_chars = self.display_settings.get('scrollback_chars', DEFAULT_SCROLLBACK_CHARS)
+        # Old lines are deleted from the widget in batches rather than on every insert
+        self.trim_batch = max(1, self.scrollback_lines // 10)
+        self.trim_chars_batch = max(1, self.scrollback_chars // 10)
+
+        self.output_format_frame = ttk.Labelframe(self, text="Output format")
+        self.output_format_var = tk.StringVar(self.output_format_frame, 'txt')
+
+        self.output_format_txt = ttk.Radiobutton(self.output_format_frame, text='txt', variable=self.output_format_var, value='txt')
+        self.output_format_hex = ttk.Radiobutton(self.output_format_frame, text='hex', variable=self.output_format_var, value='hex')
+        self.output_format_bytes = ttk.Radiobutton(self.output_format_frame, text='bytes', variable=self.output_format_var, value='bytes')
+        self.output_format_var.trace_add('write', self.handle_format_change)
+        self.timestamp_label = tk.Label(self.output_format_frame, text='Timestamps')
+        self.timestamp_select = ttk.Combobox(self.output_format_frame, values=TIMESTAMP_MODES, width=8, state="readonly")
+        self.timestamp_select.set('none')
+        self.timestamp_select.bind("<<ComboboxSelected>>", self.handle_timestamp_change)
+        self.output_merged_value = tk.BooleanVar()
+        self.output_merged_check = ttk.Checkbutton(self.output_format_frame, text='merged', variable=self.output_merged_value,
+                                                   command=self.handle_merged_view)
+
+        self.output_btn_frame = ttk.Labelframe(self, text="Output text")
+        self.output_clear_btn = ttk.Button(self.output_btn_frame, text='Clear', command=self.output_clear)
+        self.output_copy_btn = ttk.Button(self.output_btn_frame, text='Copy to clipboard', command=self.output_copy_to_clipboard)
+        self.output_save_btn = ttk.Button(self.output_btn_frame, text='Save to file', command=self.output_save_to_file)
+        self.output_record_btn = ttk.Button(self.output_btn_frame, text='Record', command=self.handle_record)
+        self.output_share_btn = ttk.Button(self.output_btn_frame, text='Share', command=self.handle_share)
+        self.output_close_btn = ttk.Button(self.output_btn_frame, text='Close tab', command=self.output_close_tab)
+
+        # Searches the full session history of the current port, matches open in their own window
+        self.search_frame = tk.Frame(self.output_frame)
+        self.search_entry = ttk.Entry(self.search_frame)
+        self.search_regex_value = tk.BooleanVar()
+        self.search_regex_check = ttk.Checkbutton(self.search_frame, text='regex', variable=self.search_regex_value)
+        self.search_case_value = tk.BooleanVar()
+        self.search_case_check = ttk.Checkbutton(self.search_frame, text='ignore case', variable=self.search_case_value)
+        self.search_btn = ttk.Button(self.search_frame, text='Filter', command=self.handle_filter)
+        self.search_entry.bind("<Return>", self.handle_filter)
+        self.filter_windows = []
+        self.plot_btn = ttk.Button(self.search_frame, text='Plot', command=self.handle_plot)
+        self.plot_windows = []
+
+        # Position, speed and pause of the capture replayed in the current tab, only shown for replays
+        self.replay_frame = tk.Frame(self.output_frame)
+        self.replay_scale = ttk.Scale(self.replay_frame, orient=tk.HORIZONTAL, from_=0.0, to=1.0)
+        self.replay_scale.bind("<ButtonPress-1>", self.handle_replay_scrub)
+        self.replay_scale.bind("<ButtonRelease-1>", self.handle_replay_seek)
+        self.replay_scrubbing = False
+        self.replay_label = tk.Label(self.replay_frame, anchor="w", width=18)
+        self.replay_speed_select = ttk.Combobox(self.replay_frame, values=REPLAY_SPEEDS, width=6)
+        self.replay_speed_select.bind("<<ComboboxSelected>>", self.handle_replay_speed)
+        self.replay_speed_select.bind("<Return>", self.handle_replay_speed)
+        self.replay_pause_btn = ttk.Button(self.replay_frame, text='Pause', command=self.handle_replay_pause)
+        self.replay_polling = False
+
+        self.views = []
+        self.merged_view = None
+        self.add_view(OutputView(self))
+
+        for item in self.settings_frame.winfo_children():
+            item['state'] = tk.NORMAL
+
+        for item in self.send_controls:
+            item['state'] = tk.DISABLED
+
+        self.output_notebook.grid(row=0, column=0, sticky="nswe")
+        self.search_entry.grid(row=0, column=0, sticky="we")
+        self.search_regex_check.grid(row=0, column=1)
+        self.search_case_check.grid(row=0, column=2)
+        self.search_btn.grid(row=0, column=3)
+        self.plot_btn.grid(row=0, column=4)
+        self.search_frame.grid_columnconfigure(0, weight=1)
+        self.search_frame.grid(row=1, column=0, sticky="we")
+        self.replay_scale.grid(row=0, column=0, sticky="we")
+        self.replay_label.grid(row=0, column=1)
+        self.replay_speed_select.grid(row=0, column=2)
+        self.replay_pause_btn.grid(row=0, column=3)
+        self.replay_frame.grid_columnconfigure(0, weight=1)
+        self.replay_frame.grid(row=2, column=0, sticky="we")
+        self.replay_frame.grid_remove()
+        self.output_notebook.bind("<<NotebookTabChanged>>", self.on_tab_change)
+
+        self.output_format_txt.grid(row=0, column=0, sticky="e")
+        self.output_format_hex.grid(row=0, column=1, sticky="e")
+        self.output_format_bytes.grid(row=0, column=2, sticky="e")
+        self.output_merged_check.grid(row=0, column=3, sticky="e")
+        self.timestamp_label.grid(row=1, column=0, columnspan=2, sticky="e")
+        self.timestamp_select.grid(row=1, column=2, columnspan=2, sticky="w")
+
+        self.output_clear_btn.grid(row=1, column=0, sticky="e")
+        self.output_copy_btn.grid(row=1, column=1, sticky="e")
+        self.output_save_btn.grid(row=1, column=2, sticky="e")
+        self.output_record_btn.grid(row=1, column=3, sticky="e")
+        self.output_share_btn.grid(row=1, column=4, sticky="e")
+        self.output_close_btn.grid(row=1, column=5, sticky="e")
+
+        self.output_format_frame.grid(row=1, column=1, sticky="nsew")
+
+        self.output_btn_frame.grid(row=1, column=2, sticky="nse")
+
+        self.output_frame.grid(row=2, column=0, columnspan=self.grid_size()[0], sticky="nsew")
+        self.output_frame.grid_columnconfigure(0, weight=1)
+        self.output_frame.grid_rowconfigure(0, weight=1)
+
+        self.status_bar = tk.Label(self, anchor="w", text='Not connected')
+        self.status_bar.grid(row=3, column=0, columnspan=self.grid_size()[0], sticky="we")
+
+        # Periodic stats for the status bar and, when configured, a JSON lines export
+        self.stats_interval = int(self.stats_settings.get('interval', DEFAULT_STATS_INTERVAL) * 1000)  # in ms
+        export_path = self.stats_settings.get('export_path')
+        self.stats_exporter = StatsExporter(export_path) if export_path else None
+        self.loop_lag_ms = 0.0
+        self.lag_probe_time = time.monotonic()
+        self.after(LAG_PROBE_INTERVAL, self.probe_loop_lag)
+        self.after(self.stats_interval, self.update_stats)
+
+        # Make the frames follow the window size
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(2, weight=1)
+        # apply the read profile
+        self.handle_setting_change()
+        self.bind("<Map>", self.on_output_map)
+        self.update_controls()
+        # split the exit sequence so we can do some stuff before the application closes
+        self.protocol("WM_DELETE_WINDOW", self.handle_close)
+
+        self.mark_startup('widgets')
+
+        self.device_watcher = DeviceWatcher(self.on_devices_changed,
+                                            poll_interval=self.device_settings.get('poll_interval',
+                                                                                   DEFAULT_POLL_INTERVAL))
+        self.device_watcher.start()
+        if startup_profile is not None:
+            # Runs once the window has been drawn
+            self.after_idle(self.report_startup)
+
+    def mark_startup(self, name: str):
+        if self.startup_profile is not None:
+            self.startup_profile.mark(name)
+
+    def report_startup(self):
+        self.update_idletasks()
+        self.mark_startup('window shown')
+        self.startup_profile.report()
+
+    def show_about(self):
+        # Show the about dialog
+        about_popup = tk.Toplevel(self)
+        about_text = f"This is Sermon. \n\nIt is licensed under the GPL-v3 license.\n\n"
+        about_popup.title("About")
+        about_label = tk.Label(about_popup, text=about_text)
+        about_label.pack()
+        link_label = tk.Label(about_popup, text="https://github.com/picatostas", fg="blue", cursor="hand2")
+        link_label.pack()
+
+        def callback(event):
+            # Only needed here, so not paid for at startup
+            import webbrowser
+            webbrowser.open_new(event.widget.cget("text"))
+
+        link_label.bind("<Button-1>", callback)
+
+    def handle_setting_change(self):
+        profile_name = self.current_settings.get()
+        profile = self.available_profiles[profile_name]
+        print(f'Setting changed to: {profile}', file=sys.stderr)
+        self.show_profile(profile)
+
+    def show_profile(self, profile):
+        self.parity_select.set(profile['parity'])
+        self.baudrate_select.set(profile['baud_rate'])
+        self.bytesize_select.set(profile['data_bits'])
+        self.stopbits_select.set(profile['stop_bits'])
+
+    def show_save_preset_pop(self):
+
+        self.save_preset_pop = tk.Toplevel(self)
+        self.save_preset_pop.title("Save preset")
+
+        self.save_preset_label = tk.Label(self.save_preset_pop, text="Enter the name:")
+        self.save_preset_label.grid(row=0, column=0, padx=5, pady=5)
+        self.save_preset_entry = tk.Entry(self.save_preset_pop)
+        self.save_preset_entry.grid(row=1, column=0, padx=5, pady=5)
+
+        self.save_preset_ok_cancel_frame = tk.Frame(self.save_preset_pop)
+        self.ok_button = tk.Button(self.save_preset_ok_cancel_frame, text="Save", command=self.save_preset_pop_ok)
+        self.ok_button.grid(row=2, column=0, padx=5, pady=5)
+        self.cancel_button = tk.Button(self.save_preset_ok_cancel_frame, text="Cancel", command=self.save_preset_pop_cancel)
+        self.cancel_button.grid(row=2, column=1, padx=5, pady=5)
+        self.save_preset_ok_cancel_frame.grid(row=2, column=0, columnspan=2)
+        self.save_preset_entry.focus_set()
+
+        self.save_preset_pop.bind("<Return>", self.save_preset_pop_ok)
+        self.save_preset_pop.bind("<Escape>", self.save_preset_pop_cancel)
+
+
+    def save_preset_pop_ok(self, event):
+
+        user_input = self.save_preset_entry.get()
+
+        new_profile = dict()
+        new_profile['name'] = user_input
+        new_profile['parity'] = self.parity_select.get()
+        new_profile['baud_rate'] = int(self.baudrate_select.get())
+        new_profile['data_bits'] = int(self.bytesize_select.get())
+        new_profile['stop_bits'] = float(self.stopbits_select.get())
+
+        has_empty_values = False
+        for value in new_profile.values():
+            if value == "":
+                has_empty_values = True
+                break
+
+        print(new_profile, file=sys.stderr)
+
+        if user_input == "":
+            tk_msg.showwarning(title="Save preset failed", message="Name cannot be empty")
+        elif has_empty_values:
+            tk_msg.showwarning(title="Save preset failed", message="One of more values are empty")
+            self.save_preset_pop.destroy()
+        else:
+            # Save the new connection profiles to the preferences
+            self.preferences['connection_profiles'][user_input] = new_profile
+            self.serial_port_settings_menu.add_radiobutton(label=new_profile['name'], value=new_profile, variable=self.current_settings,
+                                        command=self.handle_setting_change,
+                                        indicatoron=1, activebackground='gray')
+            self.save_preset_pop.destroy()
+
+    def save_preset_pop_cancel(self,event):
+        # Close the dialog without doing anything
+        self.save_preset_pop.destroy()
+
+    def handle_close(self):
+        self.device_watcher.stop()
+        self.device_settings['auto_reconnect'] = self.auto_reconnect_value.get()
+        self.preferences['devices'] = self.device_settings
+        for filter_window in list(self.filter_windows):
+            filter_window.close()
+        for plot_window in list(self.plot_windows):
+            plot_window.close()
+        for view in self.views:
+            if view.recorder is not None:
+                self.stop_recording(view)
+            if view.bridge is not None:
+                self.stop_sharing(view)
+            if view.history is not None:
+                view.history.close()
+        if self.stats_exporter is not None:
+            self.stats_exporter.close()
+        save_preferences(self.preferences)
+        self.destroy()
+
+    def add_view(self, view: OutputView):
+        self.views.append(view)
+        self.output_notebook.add(view, text=view.title)
+
+    def current_view(self) -> OutputView:
+        selected = self.output_notebook.select()
+        if not selected:
+            return None
+        return self.nametowidget(selected)
+
+    def view_for_port(self, port: str) -> OutputView:
+        for view in self.views:
+            if view.port == port and not isinstance(view, MergedView):
+                return view
+        return None
+
+    def on_tab_change(self, event=None):
+        view = self.current_view()
+        if view is None:
+            return
+        if view.port is not None and not isinstance(view, MergedView):
+            self.device_select.set(view.port)
+        if view.output_stale:
+            view.output_refresh()
+        self.update_controls()
+
+    def update_controls(self, event=None):
+        # The connect button and settings follow the selected device, sending follows the selected tab
+        port_view = self.view_for_port(self.device_select.get())
+        connected = port_view is not None and port_view.conn_status != DevState.NC
+        self.device_connect['text'] = 'Disconnect' if connected else 'Connect'
+        if connected:
+            self.show_profile(port_view.connection.profile)
+
+        for item in self.settings_frame.winfo_children():
+            item['state'] = tk.DISABLED if connected else tk.NORMAL
+
+        view = self.current_view()
+        can_send = view is not None and view.conn_status == DevState.CONNECTED
+        for item in self.send_controls:
+            item['state'] = tk.NORMAL if can_send else tk.DISABLED
+        if can_send:
+            self.send_format_select['state'] = 'readonly'
+        self.send_file_btn['text'] = 'Cancel' if view is not None and view.transfer is not None else 'Send file'
+        self.show_transfer(view)
+
+        is_port_view = view is not None and not isinstance(view, MergedView)
+        self.output_record_btn['state'] = tk.NORMAL if is_port_view else tk.DISABLED
+        self.output_record_btn['text'] = 'Stop recording' if view is not None and view.recorder else 'Record'
+        self.output_share_btn['state'] = tk.NORMAL if is_port_view and can_send else tk.DISABLED
+        self.output_share_btn['text'] = 'Stop sharing' if view is not None and view.bridge else 'Share'
+        self.output_close_btn['state'] = tk.NORMAL if is_port_view and not can_send else tk.DISABLED
+        self.search_btn['state'] = tk.NORMAL if view is not None and view.history is not None else tk.DISABLED
+        self.plot_btn['state'] = tk.NORMAL if is_port_view and view.connection is not None else tk.DISABLED
+        self.show_replay(view)
+
+    def handle_merged_view(self):
+        if self.output_merged_value.get():
+            self.merged_view = MergedView(self)
+            self.add_view(self.merged_view)
+            self.output_notebook.select(self.merged_view)
+        elif self.merged_view is not None:
+            merged_view = self.merged_view
+            self.merged_view = None
+            self.views.remove(merged_view)
+            merged_view.destroy()
+
+    def output_close_tab(self):
+        view = self.current_view()
+        if view is None or isinstance(view, MergedView) or view.conn_status == DevState.CONNECTED:
+            return
+        # Cancels a pending reconnect as well
+        view.set_connected(False)
+        if view.recorder is not None:
+            self.stop_recording(view)
+        if view.bridge is not None:
+            self.stop_sharing(view)
+        for filter_window in list(self.filter_windows):
+            if filter_window.view is view:
+                filter_window.close()
+        for plot_window in list(self.plot_windows):
+            if plot_window.view is view:
+                plot_window.close()
+        if view.history is not None:
+            view.history.close()
+        self.views.remove(view)
+        view.destroy()
+        # Always keep a tab around to show the next connection
+        if not [view for view in self.views if not isinstance(view, MergedView)]:
+            self.add_view(OutputView(self))
+        self.update_controls()
+
+    def output_clear(self):
+        view = self.current_view()
+        if view is not None:
+            view.output_clear()
+
+    def output_copy_to_clipboard(self):
+        view = self.current_view()
+        if view is None:
+            return
+
+        # Clear the clipboard
+        self.clipboard_clear()
+
+        # Append the contents to the clipboard
+        self.clipboard_append(view.output_text.get(1.0, tk.END))
+
+    def output_save_to_file(self):
+        view = self.current_view()
+        if view is None:
+            return
+        filename = filedialog.asksaveasfilename(title="Select a log:", initialdir="./", filetypes=[("Log files", "*.log"), ("All", "*")])
+        if type(filename) is str and filename:
+            # Render from the raw scrollback on a worker thread, so lines trimmed or hidden
+            # from the widget are saved too and the UI doesn't stall on big logs
+            segments = view.scrollback.segments()
+            formatter = view.formatter.copy()
+            if isinstance(formatter, TimestampFormatter):
+                formatter.offset = view.scrollback.rx_offset(len(segments))
+
+            def write_log():
+                try:
+                    with open(filename, 'w') as out_f:
+                        for direction, data, source in segments:
+                            out_f.write(formatter.format(direction, data, source))
+                except OSError as e:
+                    # Message boxes only work from the Tk thread
+                    self.after(0, tk_msg.showerror, 'Save', f'Cannot save to {filename}: {e}')
+
+            threading.Thread(target=write_log, daemon=True).start()
+
+    def handle_filter(self, event=None):
+        view = self.current_view()
+        query = self.search_entry.get()
+        if view is None or view.history is None or query == '':
+            return
+        try:
+            pattern = compile_query(query, regex=self.search_regex_value.get(),
+                                    ignore_case=self.search_case_value.get(), encoding=view.formatter.encoding)
+        except re.error as e:
+            tk_msg.showwarning(title='Search', message=f'Invalid regular expression: {e}')
+            return
+        self.filter_windows.append(FilterWindow(self, view, query, pattern))
+
+    def handle_plot(self):
+        view = self.current_view()
+        if view is None or isinstance(view, MergedView) or view.connection is None:
+            return
+        try:
+            self.plot_windows.append(PlotWindow(self, view))
+        except (re.error, struct.error) as e:
+            tk_msg.showwarning(title='Plot', message=f'Invalid plot pattern or frame layout: {e}')
+
+    def handle_record(self):
+        view = self.current_view()
+        if view is None or isinstance(view, MergedView):
+            return
+        if view.recorder is None:
+            filename = filedialog.asksaveasfilename(title="Record to:", initialdir="./",
+                                                    filetypes=[("Sermon captures", f"*{CAPTURE_EXTENSION}"), ("All", "*")])
+            if type(filename) is str and filename:
+                self.start_recording(view, filename)
+        else:
+            self.stop_recording(view)
+        self.update_controls()
+
+    def start_recording(self, view: OutputView, filename: str):
+        recorder = CaptureWriter(filename,
+                                 max_file_bytes=self.capture_settings.get('max_file_bytes'),
+                                 max_file_seconds=self.capture_settings.get('max_file_seconds'),
+                                 compress=self.capture_settings.get('compress', False))
+        try:
+            recorder.start()
+        except OSError as e:
+            tk_msg.showerror(title='Record', message=f'Cannot record to {filename}: {e}')
+            return
+        view.recorder = recorder
+
+    def stop_recording(self, view: OutputView):
+        recorder = view.recorder
+        view.recorder = None
+        error = recorder.close()
+        print(f'Recorded {recorder.written_bytes} bytes to {recorder.file_index} file(s)', file=sys.stderr)
+        if error is not None:
+            tk_msg.showerror(title='Record',
+                             message=f'Recording to {recorder.current_path} stopped: {error}, '
+                                     f'{recorder.dropped_bytes} bytes were not recorded')
+        elif recorder.dropped_bytes:
+            tk_msg.showwarning(title='Record',
+                               message=f'The disk could not keep up, {recorder.dropped_bytes} bytes '
+                                       f'in {recorder.dropped_chunks} chunks were not recorded')
+
+    def handle_share(self):
+        view = self.current_view()
+        if view is None or isinstance(view, MergedView) or view.connection is None:
+            return
+        if view.bridge is not None:
+            self.stop_sharing(view)
+            self.update_controls()
+            return
+        address = tk_dialog.askstring('Share', 'Serve this port to other programs on HOST:PORT or unix:PATH',
+                                      initialvalue=self.bridge_settings.get('address', DEFAULT_BRIDGE_ADDRESS),
+                                      parent=self)
+        if not address:
+            return
+        bridge = SerialBridge(view.connection, address,
+                              client_buffer=self.bridge_settings.get('client_buffer', DEFAULT_CLIENT_BUFFER),
+                              slow_clients=self.bridge_settings.get('slow_clients', 'drop'),
+                              writers=self.bridge_settings.get('writers', 'none'))
+        try:
+            bridge.start()
+        except (OSError, ValueError) as e:
+            tk_msg.showerror(title='Share', message=f'Cannot serve on {address}: {e}')
+            return
+        view.bridge = bridge
+        self.update_controls()
+
+    def stop_sharing(self, view: OutputView):
+        bridge = view.bridge
+        view.bridge = None
+        bridge.stop()
+
+    def refresh_devices(self):
+        self.device_watcher.refresh()
+
+    def on_devices_changed(self, devices):
+        # Called from the watcher thread
+        self.after(0, self.update_devices, devices)
+
+    def update_devices(self, devices):
+        self.devices = devices
+        self.device_select['values'] = devices
+        for view in self.views:
+            if view.conn_status == DevState.RECONNECTING:
+                self.reconnect(view)
+
+    def reconnect(self, view: OutputView, retries: int = RECONNECT_RETRIES):
+        if view.conn_status != DevState.RECONNECTING:
+            return
+        port = self.device_watcher.find(view.identity)
+        if port is None:
+            return
+        try:
+            connection = SerialConnection(port, view.connection.profile, chunk_size=self.read_chunk_size)
+        except (serial.SerialException, OSError) as e:
+            # udev may still be setting up the new node, or the scan still lists the old one
+            if retries:
+                self.after(int(RECONNECT_RETRY_INTERVAL * 1000), self.reconnect, view, retries - 1)
+            else:
+                print(f'Reconnecting to {port} failed: {e}', file=sys.stderr)
+            return
+        print(f'Reconnected to {port}', file=sys.stderr)
+        view.port = port
+        self.output_notebook.tab(view, text=view.title)
+        self.attach_connection(view, connection)
+        self.update_controls()
+
+    def attach_connection(self, view: OutputView, connection: SerialConnection):
+        view.connection = connection
+        view.identity = self.device_watcher.identity(connection.port)
+        if view.bridge is not None:
+            # Clients stay connected while a lost device is reopened
+            view.bridge.set_connection(connection)
+        if view.triggers is None:
+            view.set_triggers(TriggerEngine.from_profile(
+                connection.profile, on_fire=lambda trigger, matched, offset, view=view: self.on_trigger(
+                    view, trigger, matched, offset), encoding=view.formatter.encoding))
+        if view.triggers is not None:
+            view.triggers.attach(connection)
+        view.reset_formatter()
+        if view.history is None:
+            view.history = SessionHistory()
+        view.set_connected(True)
+        connection.add_listener(view.on_serial_data)
+        connection.add_tx_listener(view.on_serial_tx)
+        connection.add_listener(lambda data, timestamp, port=view.port: self.on_merged_data(data, timestamp, port))
+        connection.on_error = lambda error, view=view: self.on_serial_error(view, error)
+        connection.start()
+        if isinstance(connection.ser, ReplaySerial) and not self.replay_polling:
+            self.replay_polling = True
+            self.after(REPLAY_POLL_INTERVAL, self.update_replays)
+
+    def handle_device_connection(self):
+        print('Handle Device connection', file=sys.stderr)
+        _port = self.device_select.get()
+        view = self.view_for_port(_port)
+
+        if view is None or view.conn_status == DevState.NC:
+            has_empty_values = False
+
+            active_profile = dict()
+
+            active_profile['parity'] = self.parity_select.get()
+            active_profile['baud_rate'] = self.baudrate_select.get()
+            active_profile['data_bits'] = self.bytesize_select.get()
+            active_profile['stop_bits'] = self.stopbits_select.get()
+
+            for value in active_profile.values():
+                if value == "":
+                    has_empty_values = True
+                    break
+
+            if has_empty_values:
+                self.current_settings.set('default')
+            self.handle_setting_change()
+
+            active_profile['parity'] = self.parity_select.get()
+            active_profile['baud_rate'] = int(self.baudrate_select.get())
+            active_profile['data_bits'] = int(self.bytesize_select.get())
+            active_profile['stop_bits'] = float(self.stopbits_select.get())
+            for key in ('framing', 'triggers'):
+                value = self.available_profiles[self.current_settings.get()].get(key)
+                if value:
+                    active_profile[key] = value
+
+            if _port == '':
+                tk_msg.showwarning(title='Devices', message='No device found nor selected, \nplease refresh, select or reconnect')
+            else:
+                try:
+                    TriggerEngine.from_profile(active_profile)
+                except (ValueError, re.error) as e:
+                    tk_msg.showwarning(title='Triggers', message=f'Invalid trigger in the connection profile: {e}')
+                    return
+                if 'framing' in active_profile:
+                    try:
+                        FrameFormatter(active_profile['framing'])
+                    except (ValueError, KeyError, struct.error) as e:
+                        tk_msg.showwarning(title='Framing', message=f'Invalid framing in the connection profile: {e}')
+                        return
+                try:
+                    connection = SerialConnection(_port, active_profile, chunk_size=self.read_chunk_size)
+                    print(f'Serial config:', file=sys.stderr)
+                    print(f'\tport: {_port} baudrate: {active_profile["baud_rate"]} '
+                          f'parity: {serial.PARITY_NAMES[active_profile["parity"]]}', file=sys.stderr)
+                    print(f'\tbytesize: {active_profile["data_bits"]} stopbits: {active_profile["stop_bits"]}',
+                          file=sys.stderr)
+                except:
+                    tk_msg.showerror(title='Devices', message=f'Couldn\'t connect to device {_port}, \nplease refresh or reconnect')
+                    return
+
+                if view is None:
+                    # Reuse the current tab if it never had a device, open a new one otherwise
+                    view = self.current_view()
+                    if view is None or view.port is not None or isinstance(view, MergedView):
+                        view = OutputView(self, _port)
+                        self.add_view(view)
+                    view.port = _port
+                    self.output_notebook.tab(view, text=view.title)
+
+                self.attach_connection(view, connection)
+                self.output_notebook.select(view)
+                self.update_controls()
+
+        elif view.conn_status == DevState.RECONNECTING:
+            # Stop waiting for the device
+            print(f'Stopped reconnecting to device: {view.port}', file=sys.stderr)
+            view.set_connected(False)
+            if view.bridge is not None:
+                self.stop_sharing(view)
+            self.update_controls()
+
+        elif view.conn_status == DevState.CONNECTED:
+
+            if view.connection is not None:
+                if view.connection.is_open:
+                    print(f'Disconnected from device: {view.connection.port}', file=sys.stderr)
+                    view.set_connected(False)
+                    if view.bridge is not None:
+                        self.stop_sharing(view)
+                    view.connection.close()
+                    self.update_controls()
+
+    def on_merged_data(self, data: bytes, timestamp: int, port: str):
+        # Called from the read thread
+        merged_view = self.merged_view
+        if merged_view is not None:
+            merged_view.on_serial_data(data, timestamp, port)
+
+    def on_trigger(self, view: OutputView, trigger, matched: bytes, offset: int):
+        # Called from the read thread, sending and counting are already done there
+        if trigger.action in ('mark', 'start_capture', 'stop_capture'):
+            self.after(0, self.handle_trigger, view, trigger, matched, offset)
+
+    def handle_trigger(self, view: OutputView, trigger, matched: bytes, offset: int):
+        if view not in self.views:
+            return
+        print(f'Trigger {trigger.name} ({trigger.action}) on {view.port} at byte {offset}: {matched!r}',
+              file=sys.stderr)
+        if trigger.action == 'mark':
+            view.marks.append((time.time(), trigger.name, offset))
+        elif trigger.action == 'start_capture' and view.recorder is None:
+            self.start_recording(view, time.strftime('trigger-%Y%m%d-%H%M%S'))
+            self.update_controls()
+        elif trigger.action == 'stop_capture' and view.recorder is not None:
+            self.stop_recording(view)
+            self.update_controls()
+
+    def on_serial_error(self, view: OutputView, error):
+        # Called from the read thread, tear the connection down from the Tk thread
+        self.after(0, self.handle_serial_error, view)
+
+    def handle_serial_error(self, view: OutputView):
+        if view.conn_status == DevState.CONNECTED and self.auto_reconnect_value.get():
+            # Keep the tab, its capture and history, and pick the device up again once it is back
+            print(f'Lost connection to device {view.port}, waiting for it to come back', file=sys.stderr)
+            view.connection.close()
+            view.set_reconnecting()
+            self.update_controls()
+            self.reconnect(view)
+        elif view.conn_status == DevState.CONNECTED:
+            tk_msg.showerror(title='Devices', message=f'Lost connection to device {view.port}')
+            self.device_select.set(view.port)
+            self.handle_device_connection()
+
+    def send(self, event=None):
+        view = self.current_view()
+        if view is None or view.connection is None or view.conn_status != DevState.CONNECTED:
+            return
+        send_str = str(self.send_entry.get())
+        print(f"send: {send_str}", file=sys.stderr)
+        try:
+            send_bytes = parse_send_input(send_str, self.send_format_select.get(), view.formatter.encoding)
+        except ValueError as e:
+            tk_msg.showwarning(title='Send', message=f'Invalid {self.send_format_select.get()} input: {e}')
+            return
+        # Only queued here, the writer thread does the actual write
+        if view.connection.send(send_bytes, cr=self.send_cr_value.get(), lf=self.send_lf_value.get()) is None:
+            tk_msg.showwarning(title='Send', message='The device is not keeping up, the send queue is full')
+            return
+        view.append(TX, send_bytes)
+        merged_view = self.merged_view
+        if merged_view is not None:
+            merged_view.append(TX, send_bytes, view.port)
+
+    def handle_send_file(self):
+        view = self.current_view()
+        if view is None or view.connection is None or view.conn_status != DevState.CONNECTED:
+            return
+        if view.transfer is not None:
+            view.transfer.cancel()
+            return
+        filename = filedialog.askopenfilename(title="Send file:", initialdir="./")
+        if type(filename) is str and filename:
+            transfer = view.connection.send_file(
+                filename, chunk_size=self.send_settings.get('chunk_size', DEFAULT_SEND_CHUNK_SIZE),
+                interval=self.send_settings.get('interval', 0.0),
+                flow_control=self.send_settings.get('flow_control', 'none'))
+            if transfer is None:
+                tk_msg.showwarning(title='Send', message='The device is not keeping up, the send queue is full')
+                return
+            view.transfer = transfer
+            self.after(TRANSFER_POLL_INTERVAL, self.update_transfers)
+            self.update_controls()
+
+    def update_transfers(self):
+        # Poll rather than call back from the writer thread, the progress is just two integers
+        for view in self.views:
+            transfer = view.transfer
+            if transfer is not None and transfer.done:
+                print(f'Sent {transfer.sent} of {transfer.total} bytes from {transfer.path} '
+                      f'at {transfer.throughput:.0f} B/s', file=sys.stderr)
+                if transfer.error is not None:
+                    tk_msg.showerror(title='Send', message=f'Sending {transfer.path} failed: {transfer.error}')
+                view.transfer = None
+                self.update_controls()
+                self.send_progress_label['text'] = (f'{"Cancelled" if transfer.cancelled else "Sent"} '
+                                                    f'{format_size(transfer.sent)} at '
+                                                    f'{format_size(transfer.throughput)}/s')
+        self.show_transfer(self.current_view())
+        if [view for view in self.views if view.transfer is not None]:
+            self.after(TRANSFER_POLL_INTERVAL, self.update_transfers)
+
+    def show_transfer(self, view: OutputView):
+        transfer = view.transfer if view is not None else None
+        if transfer is None:
+            self.send_progress['value'] = 0
+            return
+        self.send_progress['value'] = transfer.sent / transfer.total if transfer.total else 1.0
+        self.send_progress_label['text'] = (f'{format_size(transfer.sent)} of {format_size(transfer.total)} '
+                                            f'at {format_size(transfer.throughput)}/s')
+
+    def handle_replay(self):
+        filename = filedialog.askopenfilename(title="Replay capture:", initialdir="./",
+                                              filetypes=[('Captures', f'*{CAPTURE_EXTENSION} *{CAPTURE_EXTENSION}.gz'),
+                                                         ('All files', '*')])
+        if type(filename) is str and filename:
+            self.device_select.set(f'{REPLAY_SCHEME}{filename}')
+            self.handle_device_connection()
+
+    @staticmethod
+    def replay_of(view: OutputView) -> ReplaySerial:
+        if view is None or view.connection is None or view.conn_status != DevState.CONNECTED:
+            return None
+        ser = view.connection.ser
+        return ser if isinstance(ser, ReplaySerial) else None
+
+    def show_replay(self, view: OutputView):
+        replay = self.replay_of(view)
+        if replay is None:
+            self.replay_frame.grid_remove()
+            return
+        self.replay_frame.grid()
+        if not self.replay_scrubbing:
+            self.replay_scale.configure(to=max(replay.duration, 0.001))
+            self.replay_scale.set(replay.position)
+        self.replay_label['text'] = f'{replay.position:.1f} / {replay.duration:.1f} s'
+        if self.focus_get() is not self.replay_speed_select:
+            self.replay_speed_select.set(f'{replay.speed:g}x' if replay.speed else 'max')
+        self.replay_pause_btn['text'] = 'Play' if replay.paused else 'Pause'
+
+    def update_replays(self):
+        self.show_replay(self.current_view())
+        if [view for view in self.views if self.replay_of(view) is not None]:
+            self.after(REPLAY_POLL_INTERVAL, self.update_replays)
+        else:
+            self.replay_polling = False
+
+    def handle_replay_scrub(self, event=None):
+        self.replay_scrubbing = True
+
+    def handle_replay_seek(self, event=None):
+        self.replay_scrubbing = False
+        view = self.current_view()
+        replay = self.replay_of(view)
+        if replay is None:
+            return
+        # What was shown belongs to another part of the capture
+        view.output_clear()
+        replay.seek(self.replay_scale.get())
+        self.show_replay(view)
+
+    def handle_replay_speed(self, event=None):
+        replay = self.replay_of(self.current_view())
+        if replay is None:
+            return
+        try:
+            replay.set_speed(self.replay_speed_select.get())
+        except ValueError as e:
+            tk_msg.showwarning(title='Replay', message=f'Invalid speed: {e}')
+        self.focus_set()
+        self.show_replay(self.current_view())
+
+    def handle_replay_pause(self):
+        replay = self.replay_of(self.current_view())
+        if replay is not None:
+            replay.pause(not replay.paused)
+            self.show_replay(self.current_view())
+
+    def handle_timestamp_change(self, event=None):
+        for view in self.views:
+            if not isinstance(view, MergedView):
+                view.reset_formatter()
+
+    def handle_format_change(self, *args):
+        for view in self.views:
+            view.set_output_format(self.output_format_var.get())
+
+    def probe_loop_lag(self):
+        # How late this callback runs compared to when it was due, worst case since the last stats update
+        now = time.monotonic()
+        self.loop_lag_ms = max(self.loop_lag_ms, (now - self.lag_probe_time) * 1000 - LAG_PROBE_INTERVAL)
+        self.lag_probe_time = now
+        self.after(LAG_PROBE_INTERVAL, self.probe_loop_lag)
+
+    def update_stats(self):
+        current = self.current_view()
+        status = 'Not connected'
+        for view in self.views:
+            if view.connection is None or view.conn_status != DevState.CONNECTED:
+                continue
+            extra = view.triggers.stats() if view.triggers is not None else {}
+            if view.recorder is not None:
+                extra.update(view.recorder.stats())
+            if view.marks:
+                extra['last_mark'] = f'{view.marks[-1][1]} at {time.strftime("%H:%M:%S", time.localtime(view.marks[-1][0]))}'
+            stats = view.connection.stats.snapshot(backlog=view.rx_queue.backlog, loop_lag_ms=self.loop_lag_ms,
+                                                   bridge_clients=len(view.bridge.clients) if view.bridge else None,
+                                                   **extra)
+            if self.stats_exporter is not None:
+                self.stats_exporter.write(stats)
+            if view is current:
+                status = format_stats(stats)
+        self.status_bar['text'] = status
+        self.loop_lag_ms = 0.0
+        self.after(self.stats_interval, self.update_stats)
+
+    def on_output_map(self, event):
+        view = self.current_view()
+        if event.widget is self and view is not None and view.output_stale:
+            view.output_refresh()
+
+
+def main(startup_profile=None):
+    serial_mon = SerialMon(startup_profile)
+    serial_mon.mainloop()
+
+
+if __name__ == '__main__':
+    main()
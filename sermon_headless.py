@@ -0,0 +1,383 @@
+import argparse
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+import serial
+
+from sermon_core import (ChunkQueue, OutputFormatter, SerialConnection, Timeline, TimestampFormatter,
+                         load_preferences, list_devices, TIMESTAMP_MODES, RX, TX,
+                         parse_send_input, DEFAULT_CHUNK_SIZE, DEFAULT_ENCODING, DEFAULT_DECODE_ERRORS,
+                         DEFAULT_SEND_CHUNK_SIZE, SEND_INPUT_FORMATS, FLOW_CONTROLS)
+from sermon_bridge import SerialBridge, DEFAULT_CLIENT_BUFFER
+from sermon_capture import CaptureWriter
+from sermon_devices import DeviceWatcher, RECONNECT_RETRY_INTERVAL
+from sermon_frames import FrameFormatter
+from sermon_replay import ReplaySerial
+from sermon_stats import StatsExporter, format_stats
+from sermon_triggers import TriggerEngine
+
+# What a line read from stdin ends with when it is sent
+LINE_ENDINGS = {
+    'keep': None,
+    'none': b'',
+    'cr': b'\r',
+    'lf': b'\n',
+    'crlf': b'\r\n',
+}
+STDIN_READ_SIZE = 4096
+
+
+class HeadlessMon:
+    """Serial monitor without a GUI, streams a port to a file and stdin to the port."""
+
+    def __init__(self, connection: SerialConnection, out_f, output_format: str = 'txt',
+                 encoding: str = DEFAULT_ENCODING, errors: str = DEFAULT_DECODE_ERRORS, line_ending: str = 'keep',
+                 stats_exporter: StatsExporter = None, stats_interval: float = 1.0, input_format: str = 'text',
+                 transfer=None, timestamps: str = 'none', watcher: DeviceWatcher = None, bridge: SerialBridge = None,
+                 read_stdin: bool = True, recorder: CaptureWriter = None):
+        self.connection = connection
+        self.read_stdin = read_stdin
+        # Records every received and sent chunk to disk
+        self.recorder = recorder
+        self.stats_exporter = stats_exporter
+        self.stats_interval = stats_interval
+        self.out_f = out_f
+        self.output_format = output_format
+        framing = connection.profile.get('framing')
+        if framing:
+            # One decoded frame per line
+            self.formatter = FrameFormatter(framing, output_format, encoding, errors)
+        else:
+            self.formatter = OutputFormatter(output_format, encoding, errors)
+        self.timeline = Timeline()
+        if timestamps != 'none':
+            self.formatter = TimestampFormatter(self.formatter, self.timeline, timestamps)
+        self.line_ending = LINE_ENDINGS[line_ending]
+        self.input_format = input_format
+        # File being streamed to the port, reported on stderr once done
+        self.transfer = transfer
+        self.rx_queue = ChunkQueue()
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        # With a watcher a lost device is waited for and reopened instead of ending the run
+        self.watcher = watcher
+        self.identity = watcher.identity(connection.port) if watcher is not None else None
+        self.lost_event = threading.Event()
+        # Serves the port to socket clients, it follows the connection across reconnects
+        self.bridge = bridge
+        # A replayed capture ends the run once it has been played and written out
+        self.replay = connection.ser if isinstance(connection.ser, ReplaySerial) else None
+        # Triggers of the connection profile, kept across reconnects with their counters
+        self.triggers = TriggerEngine.from_profile(connection.profile, self.on_trigger, self.formatter.encoding)
+        if self.triggers is not None:
+            self.triggers.attach(connection)
+        self.connection.add_listener(self.on_serial_data)
+        self.connection.add_tx_listener(self.on_serial_tx)
+        self.connection.on_error = self.on_serial_error
+
+    def on_serial_data(self, data: bytes, timestamp: int):
+        # Called from the read thread, writing happens on the main thread so a slow
+        # consumer of the output never blocks the read
+        self.timeline.add(len(data), timestamp)
+        if self.recorder is not None:
+            self.recorder.write(RX, data, timestamp)
+        if self.rx_queue.put(data):
+            self.wake_event.set()
+
+    def on_serial_tx(self, data: bytes):
+        # Called from the writer thread with what was actually written
+        if self.recorder is not None:
+            self.recorder.write(TX, data)
+
+    def on_trigger(self, trigger, matched: bytes, offset: int):
+        # Called from the read thread, sending and counting are already done there
+        if trigger.action != 'count':
+            print(f'Trigger {trigger.name} ({trigger.action}) at byte {offset}: {matched!r}', file=sys.stderr)
+
+    def on_serial_error(self, error):
+        if self.watcher is not None:
+            self.lost_event.set()
+        else:
+            self.stop_event.set()
+        self.wake_event.set()
+
+    def reconnect(self):
+        lost = self.connection
+        lost.close()
+        print(f'Lost {lost.port}, waiting for it to come back', file=sys.stderr)
+        while not self.stop_event.is_set():
+            port = self.watcher.wait_for(self.identity, timeout=1.0)
+            if port is None:
+                continue
+            try:
+                connection = SerialConnection(port, lost.profile, chunk_size=lost.chunk_size)
+            except (serial.SerialException, OSError):
+                # Not openable yet, or the scan still lists the old node
+                time.sleep(RECONNECT_RETRY_INTERVAL)
+                continue
+            connection.add_listener(self.on_serial_data)
+            connection.add_tx_listener(self.on_serial_tx)
+            connection.on_error = self.on_serial_error
+            self.connection = connection
+            if self.triggers is not None:
+                self.triggers.attach(connection)
+            if self.bridge is not None:
+                self.bridge.set_connection(connection)
+            connection.start()
+            print(f'Reconnected to {port}', file=sys.stderr)
+            return
+
+    def stdin_lines(self):
+        """Lines of stdin with their line ending.
+
+        They are read from the file descriptor rather than sys.stdin.buffer, a
+        daemon thread blocked in its readline holds the reader's lock and makes
+        the interpreter abort at exit while stdin is still open.
+        """
+        fd = sys.stdin.fileno()
+        pending = b''
+        while True:
+            data = os.read(fd, STDIN_READ_SIZE)
+            if not data:
+                break
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if pending:
+            yield pending
+
+    def stdin_thread_target(self):
+        for line in self.stdin_lines():
+            if self.input_format != 'text':
+                # Hex and escaped lines are exact payloads, a line ending is only added when asked for
+                try:
+                    line = parse_send_input(line.decode(self.formatter.encoding).rstrip('\r\n'),
+                                            self.input_format, self.formatter.encoding)
+                except ValueError as e:
+                    print(f'Not sent, {e}', file=sys.stderr)
+                    continue
+                if self.line_ending is not None:
+                    line += self.line_ending
+            elif self.line_ending is not None:
+                line = line.rstrip(b'\r\n') + self.line_ending
+            # Blocking here pushes back on stdin instead of dropping lines
+            self.connection.send(line, block=True)
+
+    def run(self):
+        self.replay_started = time.monotonic()
+        self.connection.start()
+        # Writes to a replay go nowhere, so its stdin is left alone
+        if self.read_stdin and self.replay is None and sys.stdin is not None:
+            stdin_thread = threading.Thread(target=self.stdin_thread_target, name='stdin', daemon=True)
+            stdin_thread.start()
+        try:
+            next_stats = time.monotonic() + self.stats_interval
+            while not self.stop_event.is_set():
+                timeout = None
+                if self.stats_exporter is not None:
+                    timeout = max(0.0, next_stats - time.monotonic())
+                if self.transfer is not None or self.replay is not None:
+                    timeout = min(timeout, 0.1) if timeout is not None else 0.1
+                if self.wake_event.wait(timeout):
+                    self.wake_event.clear()
+                    if self.lost_event.is_set():
+                        self.lost_event.clear()
+                        self.reconnect()
+                    data = self.rx_queue.drain()
+                    self.write_output(data)
+                    if data:
+                        # From the arrival of the oldest chunk until it is written out
+                        self.connection.stats.latency.add((time.monotonic_ns() - self.rx_queue.drained_since) / 1e6)
+                if self.transfer is not None and self.transfer.done:
+                    self.report_transfer()
+                if self.replay is not None and self.replay.finished and not self.rx_queue.backlog:
+                    self.report_replay()
+                    break
+                if self.stats_exporter is not None and time.monotonic() >= next_stats:
+                    next_stats += self.stats_interval
+                    self.stats_exporter.write(self.connection.stats.snapshot(backlog=self.rx_queue.backlog,
+                                                                             **self.extra_stats()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.write_output(self.rx_queue.drain())
+            self.connection.close()
+            if self.triggers is not None or self.recorder is not None:
+                print(format_stats(self.connection.stats.snapshot(**self.extra_stats())), file=sys.stderr)
+
+    def extra_stats(self) -> dict:
+        extra = self.triggers.stats() if self.triggers is not None else {}
+        if self.recorder is not None:
+            extra.update(self.recorder.stats())
+        return extra
+
+    def report_transfer(self):
+        transfer = self.transfer
+        self.transfer = None
+        status = f'failed: {transfer.error}' if transfer.error is not None else 'done'
+        print(f'Sent {transfer.sent} of {transfer.total} bytes from {transfer.path} '
+              f'at {transfer.throughput:.0f} B/s, {status}', file=sys.stderr)
+
+    def report_replay(self):
+        rx_bytes = self.connection.stats.rx_bytes
+        elapsed = time.monotonic() - self.replay_started
+        p50, p99 = self.connection.stats.latency.percentiles(50, 99)
+        latency = f', latency p50 {p50:.2f} ms p99 {p99:.2f} ms' if p50 is not None else ''
+        print(f'Replayed {rx_bytes} bytes from {self.replay.path} in {elapsed:.3f} s '
+              f'at {rx_bytes / elapsed:.0f} B/s{latency}', file=sys.stderr)
+
+    def write_output(self, data: bytes):
+        if not data:
+            return
+        if self.output_format == 'raw':
+            self.out_f.write(data)
+        else:
+            self.out_f.write(self.formatter.format_rx(data).encode(self.formatter.encoding, 'replace'))
+        self.out_f.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='serial_mon.py --headless',
+                                     description='Stream a serial port to stdout or a file and stdin to the port')
+    parser.add_argument('port', nargs='?', help='device to open, e.g. /dev/ttyUSB0 or COM3, or replay://CAPTURE[?speed=N|max] '
+                                                  'to play a capture back')
+    parser.add_argument('--list', action='store_true', help='list the available devices and exit')
+    parser.add_argument('--profile', help='connection profile from preferences.yaml, defaults to the current one')
+    parser.add_argument('--format', choices=['txt', 'hex', 'bytes', 'raw'], default='txt',
+                        help='how received data is written out')
+    parser.add_argument('--timestamps', choices=TIMESTAMP_MODES, default='none',
+                        help='prefix every line with its arrival time, ignored for raw output')
+    parser.add_argument('--output', help='file to write received data to instead of stdout')
+    parser.add_argument('--line-ending', choices=list(LINE_ENDINGS), default='keep',
+                        help='line ending used when sending lines read from stdin, keep sends hex and '
+                             'escaped input without one')
+    parser.add_argument('--input-format', choices=SEND_INPUT_FORMATS, default='text',
+                        help='how lines read from stdin are turned into bytes')
+    parser.add_argument('--no-stdin', action='store_true', help="don't send lines read from stdin to the port")
+    parser.add_argument('--send-file', help='stream this file to the port once connected')
+    parser.add_argument('--send-chunk-size', type=int, help='block size used by --send-file, defaults to preferences')
+    parser.add_argument('--send-interval', type=float, help='seconds to wait between blocks of --send-file')
+    parser.add_argument('--flow-control', choices=FLOW_CONTROLS, help='flow control used while sending a file')
+    parser.add_argument('--reconnect', action='store_true',
+                        help='when the device goes away, wait for it by serial number or by-id path and reopen it')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='record every received and sent chunk to PATH-NNN.smcap, rotated as set in preferences')
+    parser.add_argument('--bridge', metavar='ADDRESS',
+                        help='also serve the port to socket clients on HOST:PORT or unix:PATH')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--stats-file', help='append throughput and latency counters to this file as JSON lines')
+    parser.add_argument('--stats-interval', type=float, help='seconds between stats lines, defaults to preferences')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for device in list_devices():
+            print(device)
+        return 0
+
+    if args.port is None:
+        parser.error('a port is required')
+    if args.send_file and not os.path.isfile(args.send_file):
+        parser.error(f'no such file {args.send_file}')
+
+    preferences = load_preferences()
+    display_settings = preferences.get('display', {})
+    stats_settings = preferences.get('stats', {})
+    send_settings = preferences.get('send', {})
+    bridge_settings = preferences.get('bridge', {})
+    profile_name = args.profile or preferences['current_settings']['connection_profile']
+    if profile_name not in preferences['connection_profiles']:
+        parser.error(f'unknown connection profile {profile_name}')
+    profile = preferences['connection_profiles'][profile_name]
+    try:
+        TriggerEngine.from_profile(profile)
+    except (ValueError, re.error) as e:
+        parser.error(f'invalid trigger in connection profile {profile_name}: {e}')
+    if profile.get('framing'):
+        try:
+            FrameFormatter(profile['framing'])
+        except (ValueError, KeyError, struct.error) as e:
+            parser.error(f'invalid framing in connection profile {profile_name}: {e}')
+
+    watcher = None
+    if args.reconnect or preferences.get('devices', {}).get('auto_reconnect', False):
+        watcher = DeviceWatcher(poll_interval=preferences.get('devices', {}).get('poll_interval', 1.0))
+        watcher.start()
+        # The identity of the port comes from the first scan
+        watcher.wait_for({'port': args.port}, timeout=2.0)
+
+    try:
+        connection = SerialConnection(args.port, profile, chunk_size=args.chunk_size)
+    except (serial.SerialException, OSError, ValueError) as e:
+        if watcher is not None:
+            watcher.stop()
+        parser.error(f'cannot open {args.port}: {e}')
+    print(f'Connected to {args.port} with profile {profile_name}', file=sys.stderr)
+
+    out_f = open(args.output, 'ab') if args.output else sys.stdout.buffer
+    stats_path = args.stats_file or stats_settings.get('export_path')
+    stats_exporter = StatsExporter(stats_path) if stats_path else None
+    bridge = None
+    if args.bridge:
+        bridge = SerialBridge(connection, args.bridge,
+                              client_buffer=bridge_settings.get('client_buffer', DEFAULT_CLIENT_BUFFER),
+                              slow_clients=bridge_settings.get('slow_clients', 'drop'),
+                              writers=bridge_settings.get('writers', 'none'))
+        try:
+            bridge.start()
+        except OSError as e:
+            connection.close()
+            parser.error(f'cannot serve on {args.bridge}: {e}')
+    recorder = None
+    if args.capture:
+        capture_settings = preferences.get('capture', {})
+        recorder = CaptureWriter(args.capture, max_file_bytes=capture_settings.get('max_file_bytes'),
+                                 max_file_seconds=capture_settings.get('max_file_seconds'),
+                                 compress=capture_settings.get('compress', False))
+        try:
+            recorder.start()
+        except OSError as e:
+            if bridge is not None:
+                bridge.stop()
+            connection.close()
+            parser.error(f'cannot record to {args.capture}: {e}')
+    transfer = None
+    if args.send_file:
+        transfer = connection.send_file(
+            args.send_file,
+            chunk_size=args.send_chunk_size or send_settings.get('chunk_size', DEFAULT_SEND_CHUNK_SIZE),
+            interval=args.send_interval if args.send_interval is not None else send_settings.get('interval', 0.0),
+            flow_control=args.flow_control or send_settings.get('flow_control', 'none'))
+    try:
+        mon = HeadlessMon(connection, out_f, args.format,
+                          encoding=display_settings.get('encoding', DEFAULT_ENCODING),
+                          errors=display_settings.get('decode_errors', DEFAULT_DECODE_ERRORS),
+                          line_ending=args.line_ending, stats_exporter=stats_exporter,
+                          stats_interval=args.stats_interval or stats_settings.get('interval', 1.0),
+                          input_format=args.input_format, transfer=transfer, timestamps=args.timestamps,
+                          watcher=watcher, bridge=bridge, read_stdin=not args.no_stdin, recorder=recorder)
+        mon.run()
+    finally:
+        if recorder is not None:
+            error = recorder.close()
+            print(f'Recorded {recorder.written_bytes} bytes to {recorder.file_index} file(s), '
+                  f'{recorder.dropped_bytes} bytes dropped', file=sys.stderr)
+            if error is not None:
+                print(f'Recording stopped early: {error}', file=sys.stderr)
+        if bridge is not None:
+            bridge.stop()
+        if args.output:
+            out_f.close()
+        if stats_exporter is not None:
+            stats_exporter.close()
+        if watcher is not None:
+            watcher.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
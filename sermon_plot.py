@@ -0,0 +1,316 @@
+import collections
+import re
+import threading
+import time
+from array import array
+
+from sermon_core import DEFAULT_ENCODING
+from sermon_frames import FrameLayout, make_framer
+
+# name=value or name: value pairs, e.g. temp=23.4,adc=1023
+DEFAULT_PLOT_PATTERN = r'(?P<name>[A-Za-z_][\w.]*)\s*[=:]\s*(?P<value>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+DEFAULT_PLOT_WINDOW = 10.0  # in s
+# Raw samples kept per channel, the columns are rebuilt from them when the plot is resized
+DEFAULT_PLOT_HISTORY = 100000
+DEFAULT_PLOT_COLUMNS = 800
+# Chunks waiting for the plot thread, past this they are left out of the plot (never out of the output)
+MAX_PLOT_BACKLOG = 4096
+NAN = float('nan')
+
+
+class RingBuffer:
+    """Preallocated ring of numbers in a flat array."""
+
+    def __init__(self, capacity: int, typecode: str = 'd'):
+        self.capacity = capacity
+        self.data = array(typecode, bytes(array(typecode).itemsize * capacity))
+        self.head = 0
+        self.count = 0
+
+    def append(self, value):
+        self.data[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int):
+        """The index-th oldest value."""
+        return self.data[(self.head - self.count + index) % self.capacity]
+
+    def __iter__(self):
+        """Oldest first."""
+        return self.since(0)
+
+    def since(self, index: int):
+        """Iterate from the index-th oldest value to the newest."""
+        start = (self.head - self.count + index) % self.capacity
+        count = self.count - index
+        if count <= 0:
+            return iter(())
+        if start + count <= self.capacity:
+            return iter(self.data[start:start + count])
+        return iter(self.data[start:] + self.data[:self.head])
+
+
+class Channel:
+    """Samples of one plotted value, with their min and max per pixel column.
+
+    Each column covers column_ns of arrival time. The columns are a ring of
+    the newest ones and are updated as samples come in, so drawing the
+    channel only costs one step per column whatever the sample rate.
+    """
+
+    def __init__(self, name: str, history: int = DEFAULT_PLOT_HISTORY, columns: int = DEFAULT_PLOT_COLUMNS,
+                 column_ns: int = int(DEFAULT_PLOT_WINDOW * 1e9 / DEFAULT_PLOT_COLUMNS)):
+        self.name = name
+        self.times = RingBuffer(history, 'q')
+        self.values = RingBuffer(history, 'd')
+        self.last = NAN
+        self.configure(columns, column_ns)
+
+    def configure(self, columns: int, column_ns: int):
+        """Change the column count and width, the columns are refilled from the raw samples they cover."""
+        self.columns = columns
+        self.column_ns = max(1, column_ns)
+        self.mins = array('d', [NAN]) * columns
+        self.maxs = array('d', [NAN]) * columns
+        self.last_column = None
+        times = self.times
+        if not times:
+            return
+        # Samples are in arrival order, so the first one still on screen is found by bisection and
+        # a resize costs what is visible rather than the whole history
+        first_column = times[len(times) - 1] // self.column_ns - columns + 1
+        low, high = 0, len(times)
+        while low < high:
+            middle = (low + high) // 2
+            if times[middle] // self.column_ns < first_column:
+                low = middle + 1
+            else:
+                high = middle
+        for timestamp, value in zip(times.since(low), self.values.since(low)):
+            self._bucket(timestamp, value)
+
+    def add(self, timestamp: int, value: float):
+        self.times.append(timestamp)
+        self.values.append(value)
+        self.last = value
+        self._bucket(timestamp, value)
+
+    def _bucket(self, timestamp: int, value: float):
+        column = timestamp // self.column_ns
+        last_column = self.last_column
+        if last_column is None or column - last_column >= self.columns:
+            for slot in range(self.columns):
+                self.mins[slot] = NAN
+                self.maxs[slot] = NAN
+            self.last_column = column
+        elif column > last_column:
+            # Columns without samples in between stay empty
+            for skipped in range(last_column + 1, column + 1):
+                slot = skipped % self.columns
+                self.mins[slot] = NAN
+                self.maxs[slot] = NAN
+            self.last_column = column
+        elif column <= last_column - self.columns:
+            return
+        slot = column % self.columns
+        low = self.mins[slot]
+        # NaN compares false, so an empty column takes the first value
+        if not low <= value:
+            self.mins[slot] = value
+        high = self.maxs[slot]
+        if not high >= value:
+            self.maxs[slot] = value
+
+    def column_range(self, end_column: int):
+        """(mins, maxs) of the columns up to end_column, oldest first, NaN where there was no sample."""
+        first = end_column - self.columns + 1
+        mins = array('d', [NAN]) * self.columns
+        maxs = array('d', [NAN]) * self.columns
+        if self.last_column is not None:
+            for column in range(max(first, self.last_column - self.columns + 1), min(end_column, self.last_column) + 1):
+                slot = column % self.columns
+                mins[column - first] = self.mins[slot]
+                maxs[column - first] = self.maxs[slot]
+        return mins, maxs
+
+
+class LineExtractor:
+    """Numeric values of text lines, matched by a regex.
+
+    With name and value groups every match in a line is a sample of the
+    channel it names, otherwise each named group of the first match in a line
+    is a channel.
+    """
+
+    def __init__(self, pattern: str = DEFAULT_PLOT_PATTERN, encoding: str = DEFAULT_ENCODING):
+        self.regex = re.compile(pattern.encode(encoding))
+        self.encoding = encoding
+        self.pairs = {'name', 'value'} <= set(self.regex.groupindex)
+        self.names = {}
+        self._pending = b''
+
+    def channel_name(self, name: bytes) -> str:
+        decoded = self.names.get(name)
+        if decoded is None:
+            decoded = self.names[name] = name.decode(self.encoding, 'replace')
+        return decoded
+
+    def feed(self, data: bytes) -> list:
+        """[(channel, value)] of the lines completed by data."""
+        data = self._pending + data
+        end = data.rfind(b'\n') + 1
+        self._pending = data[end:]
+        samples = []
+        if self.pairs:
+            # Pairs don't span lines, so the whole batch is matched in one pass
+            for match in self.regex.finditer(data, 0, end):
+                try:
+                    samples.append((self.channel_name(match['name']), float(match['value'])))
+                except ValueError:
+                    pass
+            return samples
+        for line in data[:end].split(b'\n'):
+            match = self.regex.search(line)
+            if match is None:
+                continue
+            for name, value in match.groupdict().items():
+                if value is not None:
+                    try:
+                        samples.append((name, float(value)))
+                    except ValueError:
+                        pass
+        return samples
+
+
+class FrameExtractor:
+    """Numeric fields of frames unpacked with the layout of a framed connection profile."""
+
+    def __init__(self, framing: dict):
+        self.framer = make_framer(framing)
+        self.layout = FrameLayout(framing['layout'])
+        self.names = list(self.layout.fields)
+
+    def feed(self, data: bytes) -> list:
+        samples = []
+        size = self.layout.struct.size
+        names = self.names
+        for frame in self.framer.feed(data):
+            if len(frame) < size:
+                continue
+            for index, value in enumerate(self.layout.struct.unpack_from(frame)):
+                if isinstance(value, (bytes, bool)):
+                    continue
+                if index >= len(names):
+                    names.append(f'field{index}')
+                samples.append((names[index], value))
+        return samples
+
+
+def make_extractor(profile: dict, plot_settings: dict, encoding: str = DEFAULT_ENCODING):
+    """Frame fields when the profile has a framing layout, the plot pattern on text lines otherwise."""
+    framing = profile.get('framing')
+    if framing and 'layout' in framing:
+        return FrameExtractor(framing)
+    return LineExtractor(plot_settings.get('pattern', DEFAULT_PLOT_PATTERN), encoding)
+
+
+class PlotSource:
+    """Turn received chunks into channel samples on a background thread.
+
+    on_serial_data only queues the chunk with its arrival time, so neither the
+    read thread nor the UI pays for the parsing. When the plot thread falls
+    behind by MAX_PLOT_BACKLOG chunks, new chunks are left out of the plot.
+    """
+
+    def __init__(self, extractor, history: int = DEFAULT_PLOT_HISTORY, window: float = DEFAULT_PLOT_WINDOW,
+                 columns: int = DEFAULT_PLOT_COLUMNS):
+        self.extractor = extractor
+        self.history = history
+        self.window = window
+        self.columns = columns
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.dropped_chunks = 0
+        self._chunks = collections.deque()
+        # (columns, window) waiting to be applied by the plot thread
+        self._view = None
+        self._view_lock = threading.Lock()
+        self._event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='plot', daemon=True)
+
+    @property
+    def column_ns(self) -> int:
+        return int(self.window * 1e9 / self.columns)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._event.set()
+        self._thread.join()
+
+    def on_serial_data(self, data: bytes, timestamp: int):
+        # Called from the read thread
+        if len(self._chunks) >= MAX_PLOT_BACKLOG:
+            self.dropped_chunks += 1
+            return
+        self._chunks.append((timestamp, data))
+        self._event.set()
+
+    def set_view(self, columns: int, window: float):
+        """Change the column count and window, the channels are rebuilt on the plot thread so a
+        resize never holds up the UI."""
+        with self._view_lock:
+            self._view = (max(1, columns), window)
+        self._event.set()
+
+    def _apply_view(self):
+        with self._view_lock:
+            view = self._view
+            self._view = None
+        if view is None:
+            return
+        with self.lock:
+            self.columns, self.window = view
+            for channel in self.channels.values():
+                channel.configure(self.columns, self.column_ns)
+
+    def snapshot(self, now_ns: int = None) -> dict:
+        """{channel: (mins, maxs, last value)} of the columns ending now."""
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        with self.lock:
+            end_column = now_ns // self.column_ns
+            return {name: channel.column_range(end_column) + (channel.last,)
+                    for name, channel in self.channels.items()}
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._event.wait()
+            self._event.clear()
+            self._apply_view()
+            while self._chunks:
+                timestamp, data = self._chunks.popleft()
+                samples = self.extractor.feed(data)
+                if not samples:
+                    continue
+                with self.lock:
+                    channels = self.channels
+                    for name, value in samples:
+                        channel = channels.get(name)
+                        if channel is None:
+                            channel = channels[name] = Channel(name, self.history, self.columns, self.column_ns)
+                        channel.add(timestamp, value)
+                    self.samples += len(samples)
@@ -0,0 +1,312 @@
+import gzip
+import mmap
+import shutil
+import tempfile
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from urllib.parse import parse_qs
+
+import serial
+
+from sermon_core import RX
+from sermon_capture import CAPTURE_HEADER, CAPTURE_MAGIC, RECORD_HEADER, open_capture
+
+REPLAY_SCHEME = 'replay://'
+REPLAY_SPEEDS = ('1x', '2x', '10x', '100x', 'max')
+# One index entry per this many bytes of capture, a seek walks at most this far
+SPARSE_INDEX_BYTES = 64 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def parse_speed(speed) -> float:
+    """Speed multiplier from 1, 2.5, 10x or max, 0 means as fast as possible."""
+    speed = str(speed).strip().lower()
+    if speed == 'max':
+        return 0.0
+    value = float(speed[:-1] if speed.endswith('x') else speed)
+    if value <= 0:
+        raise ValueError(f'speed must be positive or max, not {speed}')
+    return value
+
+
+def parse_replay_url(url: str):
+    """Split replay://PATH[?speed=N|max] into the capture path and its speed."""
+    if not url.startswith(REPLAY_SCHEME):
+        raise ValueError(f'expected {REPLAY_SCHEME}PATH[?speed=N|max], not {url}')
+    path, _, query = url[len(REPLAY_SCHEME):].partition('?')
+    options = parse_qs(query)
+    return path, parse_speed(options.get('speed', ['1'])[0])
+
+
+def map_capture(path: str):
+    """Memory-map a capture file, returns (file, mmap).
+
+    Compressed captures can't be mapped in place, they are decompressed to a
+    temporary file first.
+    """
+    f = open_capture(path)
+    if isinstance(f, gzip.GzipFile):
+        with f as compressed:
+            f = tempfile.TemporaryFile()
+            shutil.copyfileobj(compressed, f, COPY_BUFFER_SIZE)
+            f.flush()
+    try:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # Empty file
+        f.close()
+        raise ValueError(f'{path} is not a sermon capture')
+    if len(buf) < CAPTURE_HEADER.size or CAPTURE_HEADER.unpack_from(buf)[0] != CAPTURE_MAGIC:
+        buf.close()
+        f.close()
+        raise ValueError(f'{path} is not a sermon capture')
+    return f, buf
+
+
+class CaptureIndex:
+    """Sparse index of a mapped capture, the timestamp and offset of one record per SPARSE_INDEX_BYTES.
+
+    It is built on a background thread so opening a large capture never waits
+    for it, lookups use whatever has been indexed so far.
+    """
+
+    def __init__(self, buf, start: int = CAPTURE_HEADER.size):
+        self.buf = buf
+        self.start = start
+        self.offsets = array('q')
+        self.times = array('q')
+        self.first_time = None
+        self.last_time = None
+        self.records = 0
+        if start + RECORD_HEADER.size <= len(buf):
+            self.first_time = self.last_time = RECORD_HEADER.unpack_from(buf, start)[0]
+        self.complete = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='replay-index', daemon=True)
+
+    def start_indexing(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    @property
+    def duration(self) -> float:
+        """Seconds from the first to the last record indexed so far."""
+        if self.first_time is None:
+            return 0.0
+        return (self.last_time - self.first_time) / 1e9
+
+    def locate(self, timestamp: int) -> int:
+        """Offset of an indexed record at or before timestamp, the first record if there is none."""
+        # offsets is appended to before times, so it is never the shorter one
+        pos = bisect_right(self.times, timestamp) - 1
+        return self.offsets[pos] if pos >= 0 else self.start
+
+    def _run(self):
+        buf = self.buf
+        size = len(buf)
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        pos = next_entry = self.start
+        while pos + header_size <= size:
+            timestamp, _, length = unpack_from(buf, pos)
+            end = pos + header_size + length
+            if end > size:
+                # Cut short by a crash
+                break
+            if pos >= next_entry:
+                if self._stop_event.is_set():
+                    return
+                self.offsets.append(pos)
+                self.times.append(timestamp)
+                next_entry = pos + SPARSE_INDEX_BYTES
+            self.last_time = timestamp
+            self.records += 1
+            pos = end
+        self.complete.set()
+
+
+class ReplaySerial(serial.SerialBase):
+    """A capture file played back as a port, opened with replay://PATH[?speed=N|max].
+
+    The capture is memory-mapped and read in place. read() returns the received
+    chunks one recorded chunk at a time, at their original pace scaled by
+    speed, or as fast as they are read with speed 0 (max), so it goes through
+    the same read engine, listeners and views as a live port. Sent records are
+    skipped and writes are discarded.
+    """
+
+    def open(self):
+        if self.is_open:
+            raise serial.SerialException('Port is already open.')
+        if self._port is None:
+            raise serial.SerialException('Port must be configured before it can be used.')
+        try:
+            self.path, self.speed = parse_replay_url(self._port)
+            self._file, self._buf = map_capture(self.path)
+        except (OSError, ValueError) as e:
+            raise serial.SerialException(f'could not open replay {self._port}: {e}')
+        self._wakeup = threading.Condition()
+        self.index = CaptureIndex(self._buf)
+        self.index.start_indexing()
+        # Next record to read and how much of its payload was already returned
+        self._pos = CAPTURE_HEADER.size
+        self._sent = 0
+        self._paused_at = None
+        # Capture time of the last returned chunk
+        self._position = self.index.first_time or 0
+        self._restart_clock(self._position)
+        self.is_open = True
+
+    def close(self):
+        if not self.is_open:
+            return
+        with self._wakeup:
+            self.is_open = False
+            self._wakeup.notify_all()
+        self.index.stop()
+        self._buf.close()
+        self._file.close()
+
+    def _reconfigure_port(self, *args, **kwargs):
+        # Nothing to configure on a file, the profile settings are accepted as they are
+        pass
+
+    @property
+    def in_waiting(self) -> int:
+        # The rest of the next received chunk even if it isn't due yet, so a
+        # read blocks for the whole chunk rather than its first byte
+        with self._wakeup:
+            record = self._next_rx() if self.is_open else None
+            return record[2] - self._sent if record is not None else 0
+
+    def read(self, size: int = 1) -> bytes:
+        deadline = time.monotonic() + self._timeout if self._timeout is not None else None
+        with self._wakeup:
+            while True:
+                if not self.is_open:
+                    raise serial.SerialException('Attempting to use a port that is not open')
+                record = self._next_rx()
+                wait = None
+                if record is not None and self._paused_at is None:
+                    timestamp, start, length = record
+                    wait = self._due_in(timestamp)
+                    if wait <= 0:
+                        begin = start + self._sent
+                        data = self._buf[begin:min(begin + size, start + length)]
+                        self._sent += len(data)
+                        self._position = timestamp
+                        return data
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return b''
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._wakeup.wait(wait)
+
+    def write(self, data) -> int:
+        if not self.is_open:
+            raise serial.SerialException('Attempting to use a port that is not open')
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        pass
+
+    def reset_output_buffer(self):
+        pass
+
+    @property
+    def duration(self) -> float:
+        return self.index.duration
+
+    @property
+    def position(self) -> float:
+        """Seconds into the capture of the last chunk returned."""
+        return (self._position - (self.index.first_time or 0)) / 1e9
+
+    @property
+    def finished(self) -> bool:
+        with self._wakeup:
+            return self.is_open and self._next_rx() is None
+
+    @property
+    def paused(self) -> bool:
+        return self._paused_at is not None
+
+    def seek(self, seconds: float):
+        """Continue from the first chunk at or after seconds into the capture."""
+        with self._wakeup:
+            target = (self.index.first_time or 0) + int(max(seconds, 0.0) * 1e9)
+            pos = self.index.locate(target)
+            # At most SPARSE_INDEX_BYTES of records from the indexed one to the target
+            buf = self._buf
+            size = len(buf)
+            while pos + RECORD_HEADER.size <= size:
+                timestamp, _, length = RECORD_HEADER.unpack_from(buf, pos)
+                if timestamp >= target or pos + RECORD_HEADER.size + length > size:
+                    break
+                pos += RECORD_HEADER.size + length
+            self._pos = pos
+            self._sent = 0
+            self._position = target
+            if self._paused_at is not None:
+                self._paused_at = target
+            self._restart_clock(target)
+            self._wakeup.notify_all()
+
+    def set_speed(self, speed):
+        with self._wakeup:
+            now = self._playback_time()
+            self.speed = parse_speed(speed)
+            self._restart_clock(now)
+            self._wakeup.notify_all()
+
+    def pause(self, paused: bool = True):
+        with self._wakeup:
+            if paused and self._paused_at is None:
+                self._paused_at = self._playback_time()
+            elif not paused and self._paused_at is not None:
+                self._restart_clock(self._paused_at)
+                self._paused_at = None
+            self._wakeup.notify_all()
+
+    def _restart_clock(self, timestamp: int):
+        # Capture time timestamp plays now
+        self._origin = timestamp
+        self._clock = time.monotonic_ns()
+
+    def _playback_time(self) -> int:
+        if self._paused_at is not None:
+            return self._paused_at
+        if not self.speed:
+            return self._position
+        return self._origin + int((time.monotonic_ns() - self._clock) * self.speed)
+
+    def _due_in(self, timestamp: int) -> float:
+        """Seconds until the chunk recorded at timestamp is due."""
+        if not self.speed:
+            return 0.0
+        return ((timestamp - self._origin) / self.speed - (time.monotonic_ns() - self._clock)) / 1e9
+
+    def _next_rx(self):
+        """(timestamp, payload offset, length) of the next received chunk, None at the end."""
+        buf = self._buf
+        size = len(buf)
+        while self._pos + RECORD_HEADER.size <= size:
+            timestamp, direction, length = RECORD_HEADER.unpack_from(buf, self._pos)
+            start = self._pos + RECORD_HEADER.size
+            if start + length > size:
+                break
+            if direction == RX and self._sent < length:
+                return timestamp, start, length
+            self._pos = start + length
+            self._sent = 0
+        return None
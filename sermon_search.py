@@ -0,0 +1,220 @@
+import array
+import bisect
+import mmap
+import re
+import tempfile
+import threading
+import time
+
+# Matches returned by a single search, past this the search stops and reports truncated
+DEFAULT_MAX_RESULTS = 10000
+
+
+def crlf_anchors(pattern: str) -> str:
+    """Rewrite the $ anchors of a regex to also match before the \\r of a \\r\\n line end.
+
+    Escaped dollars and dollars in character sets are left alone.
+    """
+    parts = []
+    pos = 0
+    in_set = False
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\':
+            parts.append(pattern[pos:pos + 2])
+            pos += 2
+            continue
+        if in_set:
+            in_set = char != ']'
+        elif char == '[':
+            # A ] right after [ or [^ is part of the set
+            end = pos + 1
+            if pattern[end:end + 1] == '^':
+                end += 1
+            if pattern[end:end + 1] == ']':
+                end += 1
+            parts.append(pattern[pos:end])
+            pos = end
+            in_set = True
+            continue
+        elif char == '$':
+            char = r'(?=\r?$)'
+        parts.append(char)
+        pos += 1
+    return ''.join(parts)
+
+
+def compile_query(query: str, regex: bool = False, ignore_case: bool = False, encoding: str = 'utf-8'):
+    """Compile a substring or regex query to a bytes pattern, ^ and $ match at every line, \\n or \\r\\n ended."""
+    if regex:
+        pattern = crlf_anchors(query).encode(encoding)
+    else:
+        pattern = re.escape(query.encode(encoding))
+    return re.compile(pattern, re.MULTILINE | (re.IGNORECASE if ignore_case else 0))
+
+
+class LiveFilter:
+    def __init__(self, pattern, callback, next_line: int):
+        self.pattern = pattern
+        self.callback = callback
+        self.next_line = next_line
+
+
+class SessionHistory:
+    """Everything received in a session, spooled to a temporary file with a line offset index.
+
+    append() only queues the chunk, a background thread writes it out,
+    records the offset of every line start in a flat array('q') and runs the
+    live filters over the newly completed lines. Searches mmap the file and
+    run the pattern over it in one pass, so they never touch the read path.
+    """
+
+    def __init__(self, directory: str = None):
+        self._file = tempfile.TemporaryFile(dir=directory)
+        self._offsets = array.array('q', [0])
+        self._size = 0
+        self._pending = []
+        self._filters = []
+        self._lock = threading.Lock()
+        self._wake_event = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='history-indexer', daemon=True)
+        self._thread.start()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def line_count(self) -> int:
+        # The last entry is the start of the line still being received
+        return len(self._offsets) - 1
+
+    def append(self, data: bytes):
+        with self._lock:
+            self._pending.append(data)
+        self._wake_event.set()
+
+    def close(self):
+        self._closed = True
+        self._wake_event.set()
+        self._thread.join()
+        self._file.close()
+
+    def add_filter(self, pattern, callback, from_line: int = 0) -> LiveFilter:
+        """Call callback with the [(line, text)] matching pattern for every newly completed line from from_line.
+
+        The callback runs on the indexer thread and must not block.
+        """
+        live_filter = LiveFilter(pattern, callback, from_line)
+        with self._lock:
+            self._filters.append(live_filter)
+        self._wake_event.set()
+        return live_filter
+
+    def remove_filter(self, live_filter: LiveFilter):
+        with self._lock:
+            if live_filter in self._filters:
+                self._filters.remove(live_filter)
+
+    def search(self, pattern, max_results: int = DEFAULT_MAX_RESULTS):
+        """Search the completed lines received so far.
+
+        Returns (matches, searched_lines, truncated, elapsed_s) where matches is a
+        list of (line, text) and searched_lines is where a live filter should
+        pick up to continue without gaps or duplicates.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            offsets = self._offsets[:]
+        lines = len(offsets) - 1
+        end = offsets[-1]
+        if end == 0:
+            return [], lines, False, time.perf_counter() - start
+        with mmap.mmap(self._file.fileno(), end, access=mmap.ACCESS_READ) as buf:
+            matches, truncated = self._scan(pattern, buf, 0, offsets, 0, lines, max_results)
+        return matches, lines, truncated, time.perf_counter() - start
+
+    def lines(self, start: int, end: int):
+        """Return the text of lines [start, end)."""
+        with self._lock:
+            end = min(end, len(self._offsets) - 1)
+            if start >= end:
+                return []
+            first = self._offsets[start]
+            line_offsets = self._offsets[start:end + 1]
+        data = self._read(first, line_offsets[-1])
+        return [data[line_offsets[i] - first:line_offsets[i + 1] - first].rstrip(b'\r\n')
+                for i in range(len(line_offsets) - 1)]
+
+    @staticmethod
+    def _scan(pattern, buf, base: int, offsets, first_line: int, end_line: int, max_results: int = None):
+        # One result per line: after a hit, continue from the start of the next line
+        matches = []
+        pos = offsets[first_line] - base
+        endpos = offsets[end_line] - base
+        while pos < endpos:
+            match = pattern.search(buf, pos, endpos)
+            # A zero width match at the very end, such as \Z, is past the last completed line
+            if match is None or match.start() >= endpos:
+                break
+            line = bisect.bisect_right(offsets, base + match.start(), first_line, end_line + 1) - 1
+            line_start = offsets[line] - base
+            line_end = offsets[line + 1] - base
+            matches.append((line, bytes(buf[line_start:line_end]).rstrip(b'\r\n')))
+            if max_results is not None and len(matches) >= max_results:
+                return matches, True
+            pos = line_end
+        return matches, False
+
+    def _read(self, start: int, end: int) -> bytes:
+        # The indexer thread appends at the end, reads only look at what is already indexed
+        if not end:
+            return b''
+        with mmap.mmap(self._file.fileno(), end, access=mmap.ACCESS_READ) as buf:
+            return buf[start:end]
+
+    def _run(self):
+        while not self._closed:
+            self._wake_event.wait()
+            self._wake_event.clear()
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+            if pending:
+                self._index(b''.join(pending))
+            self._run_filters()
+
+    def _index(self, data: bytes):
+        self._file.write(data)
+        self._file.flush()
+        base = self._size
+        new_offsets = array.array('q')
+        pos = data.find(b'\n')
+        while pos != -1:
+            new_offsets.append(base + pos + 1)
+            pos = data.find(b'\n', pos + 1)
+        with self._lock:
+            self._offsets.extend(new_offsets)
+            self._size = base + len(data)
+
+    def _run_filters(self):
+        with self._lock:
+            filters = list(self._filters)
+            lines = len(self._offsets) - 1
+            if not filters or not lines:
+                return
+            first_line = min(live_filter.next_line for live_filter in filters)
+            if first_line >= lines:
+                return
+            offsets = self._offsets[first_line:]
+        data = self._read(offsets[0], offsets[lines - first_line])
+        for live_filter in filters:
+            if live_filter.next_line >= lines:
+                continue
+            # Line numbers in _scan are relative to the copied offsets
+            matches, _ = self._scan(live_filter.pattern, data, offsets[0], offsets,
+                                    live_filter.next_line - first_line, lines - first_line)
+            live_filter.next_line = lines
+            if matches:
+                live_filter.callback([(first_line + line, text) for line, text in matches])
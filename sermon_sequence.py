@@ -0,0 +1,421 @@
+"""Run scripted command/response sequences on many ports at once.
+
+A sequence is a YAML file of steps, run on every port given in parallel from
+one process. Each port runs in its own thread, expect steps wait on the data
+read by the shared port loop instead of polling, so the whole run takes about
+as long as the slowest board:
+
+    python sermon_sequence.py bringup.yaml /dev/ttyUSB0 /dev/ttyUSB1 --json results.json
+
+With --fake N the sequence runs against N scripted devices on pty pairs,
+answering as described by its fake_device section.
+"""
+import argparse
+import json
+import os
+import re
+import select
+import sys
+import threading
+import time
+
+import serial
+
+from sermon_core import PtyPort, SerialConnection, DEFAULT_ENCODING, load_preferences, parse_send_input
+
+STEP_KINDS = ('send', 'expect', 'sleep', 'set', 'label', 'goto', 'if', 'fail')
+DEFAULT_EXPECT_TIMEOUT = 5.0  # in s
+# Already searched data that is searched again with new data, so a match split across reads is found
+EXPECT_LOOKBACK = 4096
+# Received data kept for expect, the oldest is dropped past this
+MAX_EXPECT_BUFFER = 1024 * 1024
+# Guards against a goto loop that never ends
+MAX_EXECUTED_STEPS = 100000
+VARIABLE = re.compile(r'\{(\w+)\}')
+
+
+class SequenceError(Exception):
+    """A step failed: an expect timed out, a fail step was reached or the port went away."""
+
+
+def step_kind(step: dict) -> str:
+    kinds = [kind for kind in STEP_KINDS if kind in step]
+    # The goto of an if step is where it jumps to
+    if 'if' in kinds and 'goto' in kinds:
+        kinds.remove('goto')
+    if len(kinds) != 1:
+        raise ValueError(f'a step needs exactly one of {", ".join(STEP_KINDS)}: {step}')
+    return kinds[0]
+
+
+class Sequence:
+    """Validated steps of a sequence file, shared by the runners of every port.
+
+    Steps:
+        send: TEXT                      escapes such as \\r and {variables} are expanded
+        expect: REGEX                   wait for REGEX in the received data, its named groups become
+                                        variables, with timeout, capture: NAME (the first group, or
+                                        the whole match) and on_timeout: LABEL instead of failing
+        sleep: SECONDS
+        set: NAME, value: TEXT
+        label: NAME
+        goto: LABEL
+        if: NAME, matches: REGEX, goto: LABEL
+        fail: MESSAGE
+    """
+
+    def __init__(self, config: dict, encoding: str = DEFAULT_ENCODING):
+        self.name = config.get('name', 'sequence')
+        self.encoding = encoding
+        self.timeout = config.get('timeout', DEFAULT_EXPECT_TIMEOUT)
+        self.fake_device = config.get('fake_device', {})
+        self.steps = config.get('steps')
+        if not isinstance(self.steps, list) or not self.steps:
+            raise ValueError('a sequence needs a list of steps')
+        self.kinds = [step_kind(step) for step in self.steps]
+        self.labels = {step['label']: index for index, step in enumerate(self.steps) if 'label' in step}
+        # Expect patterns are compiled once for every port
+        self.patterns = {}
+        for index, (kind, step) in enumerate(zip(self.kinds, self.steps)):
+            if kind == 'expect':
+                self.patterns[index] = re.compile(str(step['expect']).encode(encoding))
+            elif kind == 'if':
+                self.patterns[index] = re.compile(str(step['matches']))
+            target = step.get('goto', step.get('on_timeout'))
+            if target is not None and target not in self.labels:
+                raise ValueError(f'step {index + 1} jumps to unknown label {target}')
+
+    @classmethod
+    def load(cls, path: str, encoding: str = DEFAULT_ENCODING):
+        import yaml
+        with open(path) as f:
+            return cls(yaml.safe_load(f), encoding)
+
+
+class SequenceRunner:
+    """Run a sequence on one connection and time every step.
+
+    Received data is appended to a buffer by the read thread, which wakes up
+    the expect step waiting on it. Data up to the end of a match is consumed.
+    """
+
+    def __init__(self, connection: SerialConnection, sequence: Sequence, variables: dict = None):
+        self.connection = connection
+        self.sequence = sequence
+        self.variables = dict(variables or {})
+        self.results = []
+        self.passed = None
+        self.error = None
+        self.elapsed = 0.0
+        self._buffer = bytearray()
+        self._searched = 0
+        self._data_ready = threading.Condition()
+        self._cancel_event = threading.Event()
+        self._cancel_reason = 'cancelled'
+        connection.add_listener(self.on_serial_data)
+        connection.on_error = self.on_port_error
+
+    def on_serial_data(self, data: bytes, timestamp: int):
+        # Called from the read thread
+        with self._data_ready:
+            self._buffer += data
+            excess = len(self._buffer) - MAX_EXPECT_BUFFER
+            if excess > 0:
+                del self._buffer[:excess]
+                self._searched = max(0, self._searched - excess)
+            self._data_ready.notify()
+
+    def cancel(self, reason: str = 'cancelled'):
+        """Stop the sequence, the current step fails with reason."""
+        self._cancel_reason = reason
+        self._cancel_event.set()
+        with self._data_ready:
+            self._data_ready.notify()
+
+    def on_port_error(self, error):
+        # Called from the read or writer thread when the port goes away, a waiting
+        # expect fails right away instead of running out its timeout
+        self.cancel(f'port error: {error}')
+
+    def expand(self, text) -> str:
+        """Replace {name} with the value of variable name, unknown names are left alone."""
+        return VARIABLE.sub(lambda match: str(self.variables.get(match[1], match[0])), str(text))
+
+    def run(self):
+        started = time.perf_counter()
+        index = 0
+        executed = 0
+        try:
+            while index < len(self.sequence.steps):
+                executed += 1
+                if executed > MAX_EXECUTED_STEPS:
+                    raise SequenceError(f'more than {MAX_EXECUTED_STEPS} steps run, is there a goto loop?')
+                if self._cancel_event.is_set():
+                    raise SequenceError(self._cancel_reason)
+                step = self.sequence.steps[index]
+                kind = self.sequence.kinds[index]
+                step_started = time.perf_counter()
+                try:
+                    detail, jump = getattr(self, f'step_{kind}')(index, step)
+                except SequenceError as e:
+                    self.record(index, kind, str(e), step_started, ok=False)
+                    raise
+                self.record(index, kind, detail, step_started)
+                index = self.sequence.labels[jump] if jump is not None else index + 1
+            self.passed = True
+        except SequenceError as e:
+            self.passed = False
+            self.error = str(e)
+        except (serial.SerialException, OSError) as e:
+            self.passed = False
+            self.error = f'port error: {e}'
+        self.elapsed = time.perf_counter() - started
+        return self
+
+    def record(self, index: int, kind: str, detail: str, started: float, ok: bool = True):
+        self.results.append({'step': index + 1, 'kind': kind, 'detail': detail, 'ok': ok,
+                             'elapsed_ms': (time.perf_counter() - started) * 1000})
+
+    def step_send(self, index: int, step: dict):
+        text = self.expand(step['send'])
+        # Blocking pushes back on the sequence rather than dropping a command
+        if self.connection.send(parse_send_input(text, 'escaped', self.sequence.encoding), block=True) is None:
+            raise SequenceError(f'send failed on {self.connection.port}')
+        return text, None
+
+    def step_expect(self, index: int, step: dict):
+        pattern = self.sequence.patterns[index]
+        timeout = step.get('timeout', self.sequence.timeout)
+        deadline = time.monotonic() + timeout
+        with self._data_ready:
+            while True:
+                match = pattern.search(self._buffer, max(0, self._searched - EXPECT_LOOKBACK))
+                if match is not None:
+                    break
+                self._searched = len(self._buffer)
+                if self._cancel_event.is_set():
+                    raise SequenceError(self._cancel_reason)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if 'on_timeout' in step:
+                        return f'{step["expect"]} timed out', step['on_timeout']
+                    raise SequenceError(f'timed out after {timeout} s waiting for {step["expect"]}')
+                self._data_ready.wait(remaining)
+            # The match refers to the buffer, so its groups are copied before it is consumed
+            matched = match.group()
+            groups = match.groupdict()
+            captured = match.group(1) if pattern.groups else matched
+            del self._buffer[:match.end()]
+            self._searched = 0
+        encoding = self.sequence.encoding
+        for name, value in groups.items():
+            if value is not None:
+                self.variables[name] = value.decode(encoding, 'replace')
+        if 'capture' in step and captured is not None:
+            self.variables[step['capture']] = captured.decode(encoding, 'replace')
+        return matched.decode(encoding, 'replace'), None
+
+    def step_sleep(self, index: int, step: dict):
+        self._cancel_event.wait(float(step['sleep']))
+        return f'{step["sleep"]} s', None
+
+    def step_set(self, index: int, step: dict):
+        value = self.expand(step.get('value', ''))
+        self.variables[step['set']] = value
+        return f'{step["set"]} = {value}', None
+
+    def step_label(self, index: int, step: dict):
+        return step['label'], None
+
+    def step_goto(self, index: int, step: dict):
+        return step['goto'], step['goto']
+
+    def step_if(self, index: int, step: dict):
+        value = str(self.variables.get(step['if'], ''))
+        taken = self.sequence.patterns[index].search(value) is not None
+        return f'{step["if"]} = {value!r}', step['goto'] if taken else None
+
+    def step_fail(self, index: int, step: dict):
+        raise SequenceError(self.expand(step['fail']))
+
+    def report(self) -> dict:
+        return {'port': self.connection.port, 'passed': self.passed, 'error': self.error,
+                'elapsed_s': self.elapsed, 'variables': self.variables, 'steps': self.results}
+
+
+def run_parallel(sequence: Sequence, ports: list, profile: dict, variables: dict = None,
+                 devices: list = ()) -> list:
+    """Run sequence on every port at once, returns the report of each port.
+
+    The fake devices behind the ports are greeted once every port is open.
+    """
+    runners = []
+    reports = []
+    for port in ports:
+        try:
+            connection = SerialConnection(port, profile)
+        except (serial.SerialException, OSError, ValueError) as e:
+            reports.append({'port': port, 'passed': False, 'error': f'cannot open: {e}', 'elapsed_s': 0.0,
+                            'variables': {}, 'steps': []})
+            continue
+        runners.append(SequenceRunner(connection, sequence, dict(variables or {}, port=port)))
+    for runner in runners:
+        runner.connection.start()
+    for device in devices:
+        device.greet()
+    threads = [threading.Thread(target=runner.run, name=f'sequence-{runner.connection.port}', daemon=True)
+               for runner in runners]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        for runner in runners:
+            runner.cancel()
+        for thread in threads:
+            thread.join()
+    for runner in runners:
+        runner.connection.close()
+    return reports + [runner.report() for runner in runners]
+
+
+def format_report(reports: list, wall_time: float) -> str:
+    lines = []
+    for report in reports:
+        status = 'PASS' if report['passed'] else f'FAIL {report["error"]}'
+        line = f'{report["port"]}: {status} in {report["elapsed_s"]:.3f} s, {len(report["steps"])} steps'
+        if report['steps']:
+            slowest = max(report['steps'], key=lambda step: step['elapsed_ms'])
+            line += f', slowest step {slowest["step"]} {slowest["kind"]} {slowest["elapsed_ms"]:.1f} ms'
+        lines.append(line)
+    passed = sum(1 for report in reports if report['passed'])
+    slowest_board = max([report['elapsed_s'] for report in reports], default=0.0)
+    total = sum(report['elapsed_s'] for report in reports)
+    lines.append(f'{passed} of {len(reports)} passed in {wall_time:.3f} s, slowest port {slowest_board:.3f} s, '
+                 f'{total:.3f} s of port time')
+    return '\n'.join(lines)
+
+
+class FakeDevice:
+    """A scripted device on a pty pair for trying sequences without hardware.
+
+    Every line it receives is answered by the first rule whose match regex
+    finds it, after the rule's delay. Replies may use \\r, \\n and the groups
+    of the match (\\1, \\g<name>), banner is sent by greet() once the port
+    under test is open.
+    """
+
+    def __init__(self, config: dict):
+        self.port = PtyPort()
+        self.name = self.port.name
+        self.banner = str(config.get('banner', '')).encode()
+        self.rules = [(re.compile(str(rule['match']).encode()), str(rule.get('reply', '')).encode(),
+                       float(rule.get('delay', 0.0)))
+                      for rule in config.get('rules', [])]
+        # Closing the pty under a blocked read doesn't hang it up, the thread is woken to let go of it first
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._thread = threading.Thread(target=self._run, name=f'fake-{self.name}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def greet(self):
+        """Send the banner, only once the port under test is open as opening it flushes its input."""
+        if self.banner:
+            try:
+                self.port.write(self.banner)
+            except OSError:
+                pass
+
+    def close(self):
+        """Hang up, the port under test sees the device go away."""
+        os.write(self._wakeup_w, b'\0')
+        if self._thread.is_alive():
+            self._thread.join(1)
+        self.port.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+    def _run(self):
+        pending = b''
+        while True:
+            try:
+                ready, _, _ = select.select([self.port.master, self._wakeup_r], [], [])
+                if self._wakeup_r in ready:
+                    return
+                data = os.read(self.port.master, 4096)
+            except OSError:
+                return
+            if not data:
+                return
+            lines = re.split(rb'[\r\n]+', pending + data)
+            pending = lines.pop()
+            for line in lines:
+                self.answer(line)
+
+    def answer(self, line: bytes):
+        for regex, reply, delay in self.rules:
+            match = regex.search(line)
+            if match is not None:
+                if delay:
+                    time.sleep(delay)
+                try:
+                    self.port.write(match.expand(reply))
+                except OSError:
+                    pass
+                return
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run a command/response sequence on many ports at once')
+    parser.add_argument('sequence', help='YAML sequence file')
+    parser.add_argument('ports', nargs='*', help='devices or pyserial URLs to run it on')
+    parser.add_argument('--profile', help='connection profile from preferences.yaml, defaults to the current one')
+    parser.add_argument('--var', action='append', default=[], metavar='NAME=VALUE',
+                        help='variable available to the steps as {NAME}')
+    parser.add_argument('--fake', type=int, metavar='N', help='run on N fake devices described by the sequence')
+    parser.add_argument('--json', help='write the per step reports to this file')
+    args = parser.parse_args(argv)
+
+    preferences = load_preferences()
+    encoding = preferences.get('display', {}).get('encoding', DEFAULT_ENCODING)
+    profile_name = args.profile or preferences['current_settings']['connection_profile']
+    if profile_name not in preferences['connection_profiles']:
+        parser.error(f'unknown connection profile {profile_name}')
+    profile = preferences['connection_profiles'][profile_name]
+    try:
+        sequence = Sequence.load(args.sequence, encoding)
+    except (OSError, ValueError, re.error) as e:
+        parser.error(f'cannot load {args.sequence}: {e}')
+    variables = {}
+    for assignment in args.var:
+        name, _, value = assignment.partition('=')
+        variables[name] = value
+
+    devices = []
+    ports = list(args.ports)
+    if args.fake:
+        devices = [FakeDevice(sequence.fake_device) for _ in range(args.fake)]
+        for device in devices:
+            device.start()
+        ports += [device.name for device in devices]
+    if not ports:
+        parser.error('no ports to run the sequence on')
+
+    started = time.perf_counter()
+    try:
+        reports = run_parallel(sequence, ports, profile, variables, devices)
+    finally:
+        for device in devices:
+            device.close()
+    wall_time = time.perf_counter() - started
+    print(format_report(reports, wall_time))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'sequence': sequence.name, 'wall_time_s': wall_time, 'ports': reports}, f, indent=2)
+    return 0 if all(report['passed'] for report in reports) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
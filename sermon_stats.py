@@ -0,0 +1,167 @@
+import array
+import json
+import os
+import struct
+import time
+
+# Linux ioctl returning the UART interrupt counters, struct serial_icounter_struct
+TIOCGICOUNT = 0x545D
+ICOUNTER_STRUCT = struct.Struct('20i')
+ICOUNTER_FIELDS = ('frame', 'overrun', 'parity', 'brk', 'buf_overrun')
+
+LATENCY_WINDOW = 1024
+
+
+def read_error_counters(ser) -> dict:
+    """Return the OS level line error counters of a port, or None where they aren't exposed."""
+    if not hasattr(os, 'uname') or os.uname().sysname != 'Linux':
+        return None
+    try:
+        import fcntl
+        counters = ICOUNTER_STRUCT.unpack(fcntl.ioctl(ser.fileno(), TIOCGICOUNT, bytes(ICOUNTER_STRUCT.size)))
+    except (AttributeError, NotImplementedError, OSError, ValueError):
+        # ptys, URL handlers and many USB adapters don't implement it
+        return None
+    # cts, dsr, rng, dcd, rx, tx come first
+    return dict(zip(ICOUNTER_FIELDS, counters[6:11]))
+
+
+class LatencyWindow:
+    """Last LATENCY_WINDOW latency samples in ms, kept in a flat array."""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples = array.array('d', bytes(8 * size))
+        self._size = size
+        self._count = 0
+
+    def add(self, value: float):
+        self._samples[self._count % self._size] = value
+        self._count += 1
+
+    def percentiles(self, *percents):
+        count = min(self._count, self._size)
+        if not count:
+            return [None for _ in percents]
+        samples = sorted(self._samples[:count])
+        return [samples[min(count - 1, int(count * percent / 100))] for percent in percents]
+
+
+class ConnectionStats:
+    """Throughput and latency counters of one connection.
+
+    The counters are plain integers bumped from the thread owning each
+    direction, rates are only computed when a snapshot is taken, so keeping
+    them on costs a couple of additions per chunk.
+    """
+
+    def __init__(self, name: str, ser=None):
+        self.name = name
+        self.ser = ser
+        self.rx_bytes = 0
+        self.rx_chunks = 0
+        self.tx_bytes = 0
+        self.latency = LatencyWindow()
+        # From each write to the next received chunk, in ms
+        self.response = LatencyWindow()
+        self.last_response_ms = None
+        self._tx_time = None
+        self._last_time = time.monotonic()
+        self._last_rx_bytes = 0
+        self._last_tx_bytes = 0
+
+    def on_rx(self, data: bytes, timestamp: int = None):
+        self.rx_bytes += len(data)
+        self.rx_chunks += 1
+        tx_time = self._tx_time
+        if tx_time is not None:
+            self._tx_time = None
+            response_ms = ((timestamp if timestamp is not None else time.monotonic_ns()) - tx_time) / 1e6
+            self.response.add(response_ms)
+            self.last_response_ms = response_ms
+
+    def on_tx(self, data: bytes, timestamp: int = None):
+        self.tx_bytes += len(data)
+        self._tx_time = timestamp if timestamp is not None else time.monotonic_ns()
+
+    def snapshot(self, **extra) -> dict:
+        """Counters and the rates since the previous snapshot, extra values are included as is."""
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        rx_bytes = self.rx_bytes
+        tx_bytes = self.tx_bytes
+        p50, p99 = self.latency.percentiles(50, 99)
+        response_p50, = self.response.percentiles(50)
+        stats = {
+            'time': time.time(),
+            'port': self.name,
+            'rx_bps': (rx_bytes - self._last_rx_bytes) / elapsed,
+            'tx_bps': (tx_bytes - self._last_tx_bytes) / elapsed,
+            'rx_bytes': rx_bytes,
+            'tx_bytes': tx_bytes,
+            'rx_chunks': self.rx_chunks,
+            'latency_p50_ms': p50,
+            'latency_p99_ms': p99,
+            'response_last_ms': self.last_response_ms,
+            'response_p50_ms': response_p50,
+            'errors': read_error_counters(self.ser) if self.ser is not None else None,
+        }
+        stats.update(extra)
+        self._last_time = now
+        self._last_rx_bytes = rx_bytes
+        self._last_tx_bytes = tx_bytes
+        return stats
+
+
+class StatsExporter:
+    """Append stats snapshots to a file as JSON lines."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a')
+
+    def write(self, stats: dict):
+        self._file.write(json.dumps(stats) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def format_size(value: float) -> str:
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(value) < 1000 or unit == 'GB':
+            return f'{value:.0f} {unit}' if unit == 'B' else f'{value:.1f} {unit}'
+        value /= 1000
+
+
+def format_stats(stats: dict) -> str:
+    """One line summary of a snapshot for a status bar."""
+    parts = [f"RX {format_size(stats['rx_bps'])}/s", f"TX {format_size(stats['tx_bps'])}/s",
+             f"total RX {format_size(stats['rx_bytes'])} TX {format_size(stats['tx_bytes'])}"]
+    if 'backlog' in stats:
+        parts.append(f"backlog {format_size(stats['backlog'])}")
+    if stats['latency_p50_ms'] is not None:
+        parts.append(f"latency p50 {stats['latency_p50_ms']:.1f} ms p99 {stats['latency_p99_ms']:.1f} ms")
+    if stats.get('response_last_ms') is not None:
+        parts.append(f"response {stats['response_last_ms']:.1f} ms p50 {stats['response_p50_ms']:.1f} ms")
+    if stats.get('trigger_counts'):
+        parts.append('triggers ' + ' '.join(f'{name} {count}' for name, count in stats['trigger_counts'].items()))
+    if stats.get('trigger_p50_ms') is not None:
+        parts.append(f"trigger to write p50 {stats['trigger_p50_ms']:.2f} ms p99 {stats['trigger_p99_ms']:.2f} ms")
+    if stats.get('last_mark'):
+        parts.append(f"mark {stats['last_mark']}")
+    if stats.get('capture_backlog') is not None:
+        recording = f"recording backlog {stats['capture_backlog']} chunks"
+        if stats.get('capture_dropped_bytes'):
+            recording += f", dropped {format_size(stats['capture_dropped_bytes'])}"
+        if stats.get('capture_error'):
+            recording += f", stopped: {stats['capture_error']}"
+        parts.append(recording)
+    if stats.get('bridge_clients') is not None:
+        parts.append(f"bridge {stats['bridge_clients']} clients")
+    if stats.get('loop_lag_ms') is not None:
+        parts.append(f"UI lag {stats['loop_lag_ms']:.1f} ms")
+    errors = stats.get('errors')
+    if errors:
+        parts.append(' '.join(f'{name} {count}' for name, count in errors.items()))
+    return ' | '.join(parts)
@@ -0,0 +1,216 @@
+import collections
+import re
+import sys
+import time
+
+from sermon_core import DEFAULT_ENCODING, parse_send_input
+from sermon_stats import LatencyWindow
+
+TRIGGER_ACTIONS = ('send', 'mark', 'highlight', 'start_capture', 'stop_capture', 'count')
+# Longest regex match that is still found when it is split across chunks
+REGEX_TAIL = 256
+
+
+class AhoCorasick:
+    """Find many byte strings in one pass over a stream.
+
+    The automaton is compiled to a full 256 entry transition row per state,
+    and the state carries over from one feed() to the next, so a pattern
+    split between two chunks is still found. While no pattern is partially
+    matched, bytes that can't start one are skipped by a regex search.
+    """
+
+    def __init__(self, patterns: list):
+        goto = [{}]
+        out = [[]]
+        for index, pattern in enumerate(patterns):
+            if not pattern:
+                raise ValueError('empty trigger pattern')
+            state = 0
+            for byte in pattern:
+                following = goto[state].get(byte)
+                if following is None:
+                    following = goto[state][byte] = len(goto)
+                    goto.append({})
+                    out.append([])
+                state = following
+            out[state].append(index)
+
+        # Breadth first, so the fallback of every state is complete before it is used
+        delta = [None] * len(goto)
+        fail = [0] * len(goto)
+        delta[0] = [0] * 256
+        queue = collections.deque()
+        for byte, following in goto[0].items():
+            delta[0][byte] = following
+            queue.append(following)
+        while queue:
+            state = queue.popleft()
+            row = list(delta[fail[state]])
+            for byte, following in goto[state].items():
+                row[byte] = following
+                fail[following] = delta[fail[state]][byte]
+                out[following] = out[following] + out[fail[following]]
+                queue.append(following)
+            delta[state] = row
+        self.delta = delta
+        self.out = [tuple(indices) for indices in out]
+        self.patterns = patterns
+        self.start_bytes = re.compile(b'[' + b''.join(re.escape(bytes([byte])) for byte in goto[0]) + b']')
+        self.state = 0
+
+    def reset(self):
+        self.state = 0
+
+    def feed(self, data: bytes, offset: int = 0) -> list:
+        """[(pattern index, stream offset of the end of the match)], offset being the stream offset of data."""
+        delta = self.delta
+        out = self.out
+        search = self.start_bytes.search
+        state = self.state
+        matches = []
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if not state:
+                match = search(data, pos)
+                if match is None:
+                    break
+                pos = match.start()
+            state = delta[state][data[pos]]
+            pos += 1
+            if out[state]:
+                for index in out[state]:
+                    matches.append((index, offset + pos))
+        self.state = state
+        return matches
+
+
+class Trigger:
+    """A pattern to watch for in the received stream and what to do when it shows up."""
+
+    def __init__(self, config: dict, encoding: str = DEFAULT_ENCODING):
+        self.pattern = config['pattern']
+        self.name = config.get('name', self.pattern)
+        self.action = config['action']
+        if self.action not in TRIGGER_ACTIONS:
+            raise ValueError(f'unknown trigger action {self.action}')
+        self.is_regex = config.get('regex', False)
+        self.ignore_case = config.get('ignore_case', False)
+        # Literal patterns go to the shared automaton, case insensitive ones are matched as regexes
+        self.regex = None
+        if self.is_regex or self.ignore_case:
+            self.regex = re.compile(self.text_pattern.encode(encoding), re.IGNORECASE if self.ignore_case else 0)
+        self.literal = self.pattern.encode(encoding)
+        # What the send action writes, with escapes such as \r and \x03
+        self.data = parse_send_input(config.get('data', ''), 'escaped', encoding)
+        self.color = config.get('color', 'yellow')
+        self.count = 0
+
+    @property
+    def text_pattern(self) -> str:
+        """The pattern as a regex on text."""
+        return self.pattern if self.is_regex else re.escape(self.pattern)
+
+
+class TriggerEngine:
+    """Match the triggers of a connection profile on the read thread and run their actions.
+
+    The send action is queued to the writer right away and the time from
+    reading the chunk to writing the response is kept in latency. Every other
+    action is passed to on_fire(trigger, matched bytes, stream offset), from
+    the read thread, for the front end to carry out.
+    """
+
+    def __init__(self, triggers: list, on_fire=None):
+        self.triggers = triggers
+        self.on_fire = on_fire
+        self.literals = [trigger for trigger in triggers if trigger.regex is None]
+        self.regexes = [trigger for trigger in triggers if trigger.regex is not None]
+        self.matcher = AhoCorasick([trigger.literal for trigger in self.literals]) if self.literals else None
+        self.latency = LatencyWindow()
+        self.connection = None
+        self.offset = 0
+        self._tail = b''
+        # Stream offset where the last reported match of each regex trigger ended, a match
+        # that grows into the next chunk (ERR1, then ERR12) is only reported once
+        self._regex_ends = [0] * len(self.regexes)
+        # Responses queued to the writer with the time their chunk was read
+        self._responses = collections.deque()
+
+    @classmethod
+    def from_profile(cls, profile: dict, on_fire=None, encoding: str = DEFAULT_ENCODING):
+        """The engine for the triggers of a connection profile, None if it has none."""
+        configs = profile.get('triggers')
+        if not configs:
+            return None
+        return cls([Trigger(config, encoding) for config in configs], on_fire)
+
+    def attach(self, connection):
+        """Watch connection, the counters carry over from a previous one."""
+        self.connection = connection
+        self.offset = 0
+        self._tail = b''
+        self._regex_ends = [0] * len(self.regexes)
+        self._responses.clear()
+        if self.matcher is not None:
+            self.matcher.reset()
+        connection.add_tx_listener(self.on_write)
+        connection.triggers = self
+
+    @property
+    def counts(self) -> dict:
+        return {trigger.name: trigger.count for trigger in self.triggers if trigger.count}
+
+    def feed(self, data: bytes, timestamp: int = None):
+        # Called from the read thread for every chunk, before any listener
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        fired = []
+        if self.matcher is not None:
+            for index, end in self.matcher.feed(data, self.offset):
+                trigger = self.literals[index]
+                fired.append((end, trigger, trigger.literal))
+        if self.regexes:
+            buf = self._tail + data
+            start = self.offset - len(self._tail)
+            regex_ends = self._regex_ends
+            # A match running up to the end of the data may still grow with the next chunk (ERR1, then 2\r\n),
+            # it is kept in the tail and reported once more data arrives, unless the line ended
+            line_ended = buf.endswith(b'\n')
+            for index, trigger in enumerate(self.regexes):
+                for match in trigger.regex.finditer(buf, max(0, regex_ends[index] - start)):
+                    if match.end() == len(buf) and not line_ended:
+                        break
+                    # A zero width match where the last reported one ended was reported already
+                    if start + match.end() > regex_ends[index]:
+                        fired.append((start + match.end(), trigger, match.group()))
+                        regex_ends[index] = start + match.end()
+            self._tail = buf[-REGEX_TAIL:]
+            if self.matcher is not None:
+                fired.sort(key=lambda item: item[0])
+        self.offset += len(data)
+        for end, trigger, matched in fired:
+            self.fire(trigger, matched, end, timestamp)
+
+    def fire(self, trigger: Trigger, matched: bytes, offset: int, timestamp: int):
+        trigger.count += 1
+        if trigger.action == 'send' and self.connection is not None and trigger.data:
+            # The same bytes object comes back in on_write once it is written
+            self._responses.append((trigger.data, timestamp))
+            if self.connection.send(trigger.data) is None:
+                self._responses.pop()
+                print(f'Trigger {trigger.name}: send queue full, response dropped', file=sys.stderr)
+        if self.on_fire is not None:
+            self.on_fire(trigger, matched, offset)
+
+    def on_write(self, data: bytes):
+        # Called from the writer thread
+        responses = self._responses
+        if responses and responses[0][0] is data:
+            _, timestamp = responses.popleft()
+            self.latency.add((time.monotonic_ns() - timestamp) / 1e6)
+
+    def stats(self) -> dict:
+        p50, p99 = self.latency.percentiles(50, 99)
+        return {'trigger_counts': self.counts, 'trigger_p50_ms': p50, 'trigger_p99_ms': p99}
@@ -0,0 +1,89 @@
+import errno
+import os
+import time
+
+import pytest
+
+from sermon_capture import CaptureWriter, read_capture, CAPTURE_EXTENSION
+from sermon_core import RX, TX
+
+
+class FullDisk:
+    """Stands in for a capture file on a disk that has run out of space."""
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+    flush = write
+
+    def close(self):
+        pass
+
+
+def records(path):
+    return [(direction, data) for _, direction, data in read_capture(path)]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_round_trip(tmp_path, compress):
+    recorder = CaptureWriter(str(tmp_path / f'session{CAPTURE_EXTENSION}'), compress=compress)
+    recorder.start()
+    chunks = [(RX, b'boot\r\n'), (TX, b'version\r'), (RX, bytes(range(256))), (RX, b'')]
+    for timestamp, (direction, data) in enumerate(chunks):
+        assert recorder.write(direction, data, timestamp)
+    assert recorder.close() is None
+    assert recorder.current_path.endswith(CAPTURE_EXTENSION + ('.gz' if compress else ''))
+    assert list(read_capture(recorder.current_path)) == [(timestamp, direction, data) for timestamp, (direction, data)
+                                                         in enumerate(chunks)]
+    assert recorder.written_bytes == sum(len(data) for _, data in chunks)
+    assert recorder.stats() == {'capture_backlog': 0, 'capture_dropped_bytes': 0, 'capture_error': None}
+
+
+def test_rotation_by_size(tmp_path):
+    recorder = CaptureWriter(str(tmp_path / 'session'), max_file_bytes=100)
+    recorder.start()
+    for index in range(10):
+        recorder.write(RX, bytes([index]) * 40)
+    recorder.close()
+    paths = sorted(tmp_path.iterdir())
+    assert len(paths) == recorder.file_index > 1
+    data = b''.join(data for path in paths for _, data in records(str(path)))
+    assert data == b''.join(bytes([index]) * 40 for index in range(10))
+
+
+def test_record_cut_short_is_skipped(tmp_path):
+    recorder = CaptureWriter(str(tmp_path / 'session'))
+    recorder.start()
+    recorder.write(RX, b'complete')
+    recorder.write(RX, b'cut short')
+    recorder.close()
+    with open(recorder.current_path, 'r+b') as f:
+        f.truncate(os.path.getsize(recorder.current_path) - 3)
+    assert records(recorder.current_path) == [(RX, b'complete')]
+
+
+def test_disk_error_stops_recording_and_counts_drops(tmp_path):
+    recorder = CaptureWriter(str(tmp_path / 'session'))
+    recorder.start()
+    recorder._file.close()
+    recorder._file = FullDisk()
+    recorder.write(RX, b'lost')
+    deadline = time.monotonic() + 2
+    while recorder.error is None:
+        assert time.monotonic() < deadline, 'the write error was not reported'
+        time.sleep(0.001)
+    assert not recorder.write(RX, b'after')
+    error = recorder.close()
+    assert isinstance(error, OSError) and error.errno == errno.ENOSPC
+    assert recorder.dropped_bytes == len(b'lost') + len(b'after')
+    assert recorder.written_bytes == 0
+    stats = recorder.stats()
+    assert stats['capture_dropped_bytes'] == 9
+    assert stats['capture_error'] == str(error)
+    assert not recorder._thread.is_alive()
+
+
+def test_unwritable_path_fails_on_start(tmp_path):
+    recorder = CaptureWriter(str(tmp_path / 'missing' / 'session'))
+    with pytest.raises(OSError):
+        recorder.start()
@@ -0,0 +1,83 @@
+import os
+import stat
+import threading
+import time
+
+from sermon_core import RX, Scrollback, SerialConnection, char_count, write_atomic
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_write_atomic_replaces_content(tmp_path):
+    path = tmp_path / 'preferences.yaml'
+    path.write_text('old')
+    write_atomic(str(path), 'new')
+    assert path.read_text() == 'new'
+    assert [p.name for p in tmp_path.iterdir()] == ['preferences.yaml']
+
+
+def test_write_atomic_keeps_mode(tmp_path):
+    path = tmp_path / 'preferences.yaml'
+    path.write_text('old')
+    os.chmod(path, 0o644)
+    write_atomic(str(path), 'new')
+    assert mode(path) == 0o644
+
+
+def test_write_atomic_new_file_uses_umask(tmp_path):
+    umask = os.umask(0o022)
+    try:
+        write_atomic(str(tmp_path / 'cache.json'), '{}')
+    finally:
+        os.umask(umask)
+    assert mode(tmp_path / 'cache.json') == 0o644
+
+
+def test_char_count():
+    assert char_count('héllo €😀'.encode()) == 8
+    assert char_count('héllo'.encode('latin-1'), 'latin-1') == 5
+    assert char_count('héllo'.encode('utf-16-le'), 'utf-16-le') == 5
+
+
+def test_scrollback_segments_limited_by_chars():
+    scrollback = Scrollback()
+    for _ in range(10):
+        scrollback.append(RX, '€€€€\n'.encode())
+    # 5 characters but 13 bytes per segment, 12 characters need the newest 3
+    assert len(scrollback.segments(max_chars=12)) == 3
+    assert len(scrollback.segments(max_chars=12, encoding='latin-1')) == 1
+    assert len(scrollback.segments(max_lines=3)) == 4
+    assert len(scrollback.segments()) == 10
+
+
+def test_scrollback_drops_oldest():
+    scrollback = Scrollback(max_lines=3)
+    for index in range(5):
+        scrollback.append(RX, b'%d\n' % index)
+    assert [data for _, data, _ in scrollback.segments()] == [b'2\n', b'3\n', b'4\n']
+    assert scrollback.rx_bytes == 10
+    assert scrollback.rx_offset(2) == 6
+
+
+def test_listeners_get_the_read_timestamp():
+    connection = SerialConnection('loop://', {'baud_rate': 115200, 'data_bits': 8, 'parity': 'N', 'stop_bits': 1})
+    received = []
+    done = threading.Event()
+
+    def on_data(data, timestamp):
+        received.append((data, timestamp))
+        done.set()
+
+    connection.add_listener(on_data)
+    before = time.monotonic_ns()
+    connection.start()
+    try:
+        connection.send(b'ping', block=True)
+        assert done.wait(2)
+    finally:
+        connection.close()
+    data, timestamp = received[0]
+    assert data.startswith(b'p')
+    assert before <= timestamp <= time.monotonic_ns()
@@ -0,0 +1,102 @@
+import random
+import struct
+
+import pytest
+
+from sermon_frames import (CobsFramer, FixedFramer, FrameFormatter, LengthFramer, LineFramer, SlipFramer,
+                           cobs_decode, make_framer, DEFAULT_MAX_FRAME_SIZE)
+
+PAYLOADS = [b'', b'\x00', b'hello', b'\xc0\xdb\x00\xff' * 3, bytes(range(256)), b'\x01' * 600]
+
+
+def cobs_encode(payload):
+    out = bytearray()
+    for block in payload.split(b'\x00'):
+        while len(block) >= 254:
+            out += b'\xff' + block[:254]
+            block = block[254:]
+        out += bytes([len(block) + 1]) + block
+    # A block of 254 bytes ends without the implied zero
+    return bytes(out)
+
+
+def slip_encode(payload):
+    return b'\xc0' + payload.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+def feed_in_chunks(framer, data, seed=1):
+    rng = random.Random(seed)
+    frames = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(1, 40)
+        frames += framer.feed(data[pos:pos + size])
+        pos += size
+    return frames
+
+
+def test_line_round_trip():
+    framer = LineFramer(b'\r\n')
+    assert feed_in_chunks(framer, b'one\r\ntwo\r\n\r\nthree') == [b'one', b'two', b'']
+    assert framer.feed(b'\r\n') == [b'three']
+
+
+def test_slip_round_trip():
+    payloads = [payload for payload in PAYLOADS if payload]
+    data = b''.join(slip_encode(payload) for payload in payloads)
+    assert feed_in_chunks(SlipFramer(), data) == payloads
+
+
+def test_cobs_round_trip():
+    payloads = PAYLOADS[1:]
+    data = b''.join(cobs_encode(payload) + b'\x00' for payload in payloads)
+    assert feed_in_chunks(CobsFramer(), data) == payloads
+
+
+def test_cobs_drops_malformed_frames():
+    framer = CobsFramer()
+    assert cobs_decode(b'\x05ab') is None
+    assert framer.feed(b'\x05ab\x00' + cobs_encode(b'ok') + b'\x00') == [b'ok']
+    assert framer.dropped == 1
+
+
+def test_fixed_round_trip():
+    data = bytes(range(100))
+    assert b''.join(feed_in_chunks(FixedFramer(8), data)) == data[:96]
+
+
+@pytest.mark.parametrize('length_format, includes_header', [('<H', False), ('>I', True), ('B', False)])
+def test_length_round_trip(length_format, includes_header):
+    header = struct.Struct(length_format)
+    payloads = [payload for payload in PAYLOADS if len(payload) < 256]
+    data = b''.join(header.pack(len(payload) + (header.size if includes_header else 0)) + payload
+                    for payload in payloads)
+    framer = LengthFramer(length_format, length_includes_header=includes_header)
+    assert feed_in_chunks(framer, data) == [header.pack(len(payload) + (header.size if includes_header else 0))
+                                            + payload for payload in payloads]
+
+
+def test_length_resyncs_past_an_oversized_length():
+    framer = LengthFramer('<I', max_frame_size=1024)
+    frame = struct.pack('<I', 3) + b'abc'
+    assert framer.feed(b'\xff' * 4 + frame) == [frame]
+
+
+def test_max_frame_size_from_the_profile():
+    big = struct.pack('<I', 100000) + b'x' * 100000
+    assert make_framer({'framer': 'length', 'length_format': '<I'}).feed(big) == []
+    framer = make_framer({'framer': 'length', 'length_format': '<I', 'max_frame_size': 200000})
+    assert framer.max_frame_size == 200000
+    assert framer.feed(big) == [big]
+
+
+def test_line_passes_an_oversized_frame_on():
+    framer = make_framer({'framer': 'line', 'max_frame_size': 16})
+    assert framer.feed(b'x' * 20) == [b'x' * 20]
+    assert LineFramer().max_frame_size == DEFAULT_MAX_FRAME_SIZE
+
+
+def test_frame_formatter_layout():
+    formatter = FrameFormatter({'framer': 'cobs', 'layout': {'format': '<BH', 'fields': ['type', 'id']}})
+    frame = struct.pack('<BH', 1, 513)
+    assert formatter.format_rx(cobs_encode(frame) + b'\x00' + cobs_encode(b'?') + b'\x00') == 'type=1 id=513\n?\n'
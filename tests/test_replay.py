@@ -0,0 +1,94 @@
+import time
+
+import pytest
+import serial
+
+from sermon_capture import CaptureWriter
+from sermon_core import RX, TX, open_serial
+from sermon_replay import parse_replay_url, parse_speed
+
+PROFILE = {'baud_rate': 115200, 'data_bits': 8, 'parity': 'N', 'stop_bits': 1}
+MS = 1000000  # ns
+
+
+def record(tmp_path, records, compress=False):
+    recorder = CaptureWriter(str(tmp_path / 'session'), compress=compress)
+    recorder.start()
+    for timestamp, direction, data in records:
+        recorder.write(direction, data, timestamp)
+    assert recorder.close() is None
+    return recorder.current_path
+
+
+def read_all(port, size=4096):
+    chunks = []
+    while not port.finished:
+        chunks.append(port.read(size))
+    return chunks
+
+
+RECORDS = [(0, RX, b'boot\r\n'), (1 * MS, TX, b'version\r'), (2 * MS, RX, b'fw 1.4\r\n'),
+           (3 * MS, RX, bytes(range(256)))]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_replay_returns_the_received_chunks(tmp_path, compress):
+    path = record(tmp_path, RECORDS, compress)
+    port = open_serial(f'replay://{path}?speed=max', PROFILE)
+    try:
+        assert port.index.complete.wait(2)
+        assert port.duration == pytest.approx(0.003)
+        assert read_all(port) == [data for _, direction, data in RECORDS if direction == RX]
+        assert port.position == pytest.approx(0.003)
+        # Writes to a replay go nowhere
+        assert port.write(b'ignored') == 7
+    finally:
+        port.close()
+
+
+def test_replay_reads_in_pieces(tmp_path):
+    path = record(tmp_path, RECORDS)
+    port = open_serial(f'replay://{path}?speed=max', PROFILE)
+    try:
+        assert b''.join(read_all(port, 5)) == b''.join(data for _, direction, data in RECORDS if direction == RX)
+    finally:
+        port.close()
+
+
+def test_replay_keeps_the_pace(tmp_path):
+    path = record(tmp_path, [(0, RX, b'a'), (100 * MS, RX, b'b')])
+    port = open_serial(f'replay://{path}?speed=2', PROFILE)
+    try:
+        started = time.monotonic()
+        assert read_all(port) == [b'a', b'b']
+        assert time.monotonic() - started >= 0.045
+    finally:
+        port.close()
+
+
+def test_replay_seek(tmp_path):
+    path = record(tmp_path, [(index * 10 * MS, RX, b'%d' % index) for index in range(10)])
+    port = open_serial(f'replay://{path}?speed=max', PROFILE)
+    try:
+        port.index.complete.wait(2)
+        port.seek(0.045)
+        assert read_all(port) == [b'%d' % index for index in range(5, 10)]
+        port.seek(0)
+        assert port.read(1) == b'0'
+    finally:
+        port.close()
+
+
+def test_replay_of_a_file_that_is_not_a_capture(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_bytes(b'just some text, long enough to hold a capture header')
+    with pytest.raises(serial.SerialException):
+        open_serial(f'replay://{path}', PROFILE)
+
+
+def test_replay_url_and_speed():
+    assert parse_replay_url('replay:///tmp/a.smcap?speed=10x') == ('/tmp/a.smcap', 10.0)
+    assert parse_replay_url('replay://a.smcap') == ('a.smcap', 1.0)
+    assert parse_speed('max') == 0.0
+    with pytest.raises(ValueError):
+        parse_speed('0')
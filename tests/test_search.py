@@ -0,0 +1,94 @@
+import threading
+import time
+
+import pytest
+
+from sermon_search import SessionHistory, compile_query, crlf_anchors
+
+
+@pytest.fixture
+def history():
+    history = SessionHistory()
+    yield history
+    history.close()
+
+
+def fill(history, *chunks):
+    total = history.size + sum(len(chunk) for chunk in chunks)
+    for chunk in chunks:
+        history.append(chunk)
+    deadline = time.monotonic() + 2
+    while history.size < total:
+        assert time.monotonic() < deadline, 'history was not indexed'
+        time.sleep(0.001)
+
+
+def test_substring_search(history):
+    fill(history, b'boot\r\nERR 1\r\nok\r\nerr 2\r\n')
+    matches, lines, truncated, _ = history.search(compile_query('err', ignore_case=True))
+    assert matches == [(1, b'ERR 1'), (3, b'err 2')]
+    assert lines == 4
+    assert not truncated
+
+
+def test_line_split_across_chunks(history):
+    fill(history, b'first li', b'ne\nsecond', b' line\npartial')
+    matches, lines, _, _ = history.search(compile_query('line'))
+    assert matches == [(0, b'first line'), (1, b'second line')]
+    # The line still being received is not searched
+    assert lines == 2
+    assert history.lines(0, 2) == [b'first line', b'second line']
+
+
+def test_one_result_per_line_and_max_results(history):
+    fill(history, b'a a a\n' * 10)
+    matches, _, truncated, _ = history.search(compile_query('a'), max_results=3)
+    assert [line for line, _ in matches] == [0, 1, 2]
+    assert truncated
+
+
+@pytest.mark.parametrize('query, lines', [(r'\Z', []), (r'$', [0, 1]), (r'^', [0, 1]), (r'x?\Z', [])])
+def test_zero_width_match_at_the_end(history, query, lines):
+    fill(history, b'one\ntwo\n')
+    matches, _, _, _ = history.search(compile_query(query, regex=True))
+    assert [line for line, _ in matches] == lines
+
+
+def test_live_filter_continues_where_the_search_stopped(history):
+    fill(history, b'ERR 1\nok\n')
+    pattern = compile_query('ERR')
+    matches, lines, _, _ = history.search(pattern)
+    found = []
+    done = threading.Event()
+
+    def on_matches(new):
+        found.extend(new)
+        if len(found) >= 2:
+            done.set()
+
+    history.add_filter(pattern, on_matches, from_line=lines)
+    fill(history, b'ERR 2\nok\n', b'ERR 3\n')
+    assert done.wait(2)
+    assert matches == [(0, b'ERR 1')]
+    assert found == [(2, b'ERR 2'), (4, b'ERR 3')]
+
+
+@pytest.mark.parametrize('query, lines', [
+    (r'ok$', [1, 2]),
+    (r'^ok$', [1, 2]),
+    (r'\d$', [0, 3]),
+    (r'cost \$', [3]),
+    (r'[$]5', [3]),
+    (r'[]$]5', [3]),
+])
+def test_dollar_matches_before_crlf(history, query, lines):
+    fill(history, b'ERR 1\r\nok\r\nok\nis cost $5\r\n')
+    matches, _, _, _ = history.search(compile_query(query, regex=True))
+    assert [line for line, _ in matches] == lines
+
+
+def test_crlf_anchors_leave_literals_alone():
+    assert crlf_anchors(r'a$') == r'a(?=\r?$)'
+    assert crlf_anchors(r'a\$') == r'a\$'
+    assert crlf_anchors(r'[$^]$') == r'[$^](?=\r?$)'
+    assert crlf_anchors(r'[]$]') == r'[]$]'
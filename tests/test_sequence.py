@@ -0,0 +1,90 @@
+import sys
+
+import pytest
+
+from sermon_core import SerialConnection
+from sermon_sequence import FakeDevice, Sequence, SequenceRunner, run_parallel
+
+pytestmark = pytest.mark.skipif(sys.platform == 'win32', reason='fake devices run on pty pairs')
+
+PROFILE = {'name': 'test', 'baud_rate': 115200, 'data_bits': 8, 'parity': 'N', 'stop_bits': 1}
+FAKE_DEVICE = {
+    'banner': 'boot v2\r\n',
+    'rules': [
+        {'match': '^version', 'reply': 'fw 1.4\r\n'},
+        {'match': r'^read (\d+)', 'reply': r'reg \1 = 0x\1\r\n'},
+    ],
+}
+
+
+def run(steps, count=1, fake_device=FAKE_DEVICE, variables=None):
+    sequence = Sequence({'timeout': 2, 'steps': steps, 'fake_device': fake_device})
+    devices = [FakeDevice(sequence.fake_device) for _ in range(count)]
+    for device in devices:
+        device.start()
+    try:
+        return run_parallel(sequence, [device.name for device in devices], PROFILE, variables, devices)
+    finally:
+        for device in devices:
+            device.close()
+
+
+def test_banner_is_received():
+    [report] = run([{'expect': r'boot v(?P<boot>\d+)'}])
+    assert report['passed'], report['error']
+    assert report['variables']['boot'] == '2'
+
+
+def test_send_expect_capture_on_many_ports():
+    steps = [
+        {'send': 'version\\r'},
+        {'expect': r'fw (?P<fw>\d+\.\d+)'},
+        {'send': 'read {reg}\\r'},
+        {'expect': r'reg \d+ = (\w+)', 'capture': 'value'},
+    ]
+    reports = run(steps, count=3, variables={'reg': '7'})
+    assert [report['passed'] for report in reports] == [True] * 3
+    for report in reports:
+        assert report['variables']['fw'] == '1.4'
+        assert report['variables']['value'] == '0x7'
+
+
+def test_if_goto_and_fail():
+    steps = [
+        {'send': 'version\\r'},
+        {'expect': r'fw (?P<fw>\d+\.\d+)'},
+        {'if': 'fw', 'matches': r'^1\.', 'goto': 'old'},
+        {'goto': 'done'},
+        {'label': 'old'},
+        {'fail': 'firmware {fw} is too old'},
+        {'label': 'done'},
+    ]
+    [report] = run(steps)
+    assert not report['passed']
+    assert report['error'] == 'firmware 1.4 is too old'
+
+
+def test_expect_timeout_jumps_to_label():
+    steps = [
+        {'expect': 'never', 'timeout': 0.05, 'on_timeout': 'late'},
+        {'fail': 'not reached'},
+        {'label': 'late'},
+    ]
+    [report] = run(steps)
+    assert report['passed'], report['error']
+
+
+def test_unknown_label_is_rejected():
+    with pytest.raises(ValueError):
+        Sequence({'steps': [{'goto': 'nowhere'}]})
+
+
+def test_send_on_closed_port_fails_at_the_step():
+    connection = SerialConnection('loop://', PROFILE)
+    connection.start()
+    connection.close()
+    sequence = Sequence({'steps': [{'send': 'version\\r'}, {'expect': 'fw', 'timeout': 2}]})
+    runner = SequenceRunner(connection, sequence).run()
+    assert not runner.passed
+    assert runner.error == 'send failed on loop://'
+    assert [step['kind'] for step in runner.results] == ['send']
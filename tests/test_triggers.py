@@ -0,0 +1,107 @@
+import random
+import re
+
+import pytest
+
+from sermon_triggers import AhoCorasick, Trigger, TriggerEngine
+
+
+def split(data, sizes):
+    chunks = []
+    pos = 0
+    for size in sizes:
+        chunks.append(data[pos:pos + size])
+        pos += size
+    chunks.append(data[pos:])
+    return chunks
+
+
+def random_chunks(data, rng):
+    cuts = sorted(rng.sample(range(1, len(data)), rng.randint(0, min(20, len(data) - 1))))
+    return [data[start:end] for start, end in zip([0] + cuts, cuts + [len(data)])]
+
+
+def naive_matches(patterns, data):
+    found = []
+    for index, pattern in enumerate(patterns):
+        for match in re.finditer(b'(?=' + re.escape(pattern) + b')', data):
+            found.append((index, match.start() + len(pattern)))
+    return sorted(found, key=lambda item: (item[1], item[0]))
+
+
+def engine(*configs):
+    fired = []
+    triggers = [Trigger(dict(config, action=config.get('action', 'count'))) for config in configs]
+    return TriggerEngine(triggers, on_fire=lambda trigger, matched, offset: fired.append(
+        (trigger.name, matched, offset))), fired
+
+
+def test_aho_corasick_overlapping_patterns():
+    patterns = [b'he', b'she', b'his', b'hers']
+    matcher = AhoCorasick(patterns)
+    data = b'ushers and his shed'
+    assert sorted(matcher.feed(data), key=lambda item: (item[1], item[0])) == naive_matches(patterns, data)
+
+
+def test_aho_corasick_matches_across_chunks():
+    rng = random.Random(7)
+    patterns = [b'ERROR', b'RR', b'OK\r\n', b'\x00\xff', b'boot']
+    data = bytes(rng.choice(b'EROK\r\n\x00\xffbot ') for _ in range(5000))
+    expected = naive_matches(patterns, data)
+    for _ in range(20):
+        matcher = AhoCorasick(patterns)
+        found = []
+        offset = 0
+        for chunk in random_chunks(data, rng):
+            found += matcher.feed(chunk, offset)
+            offset += len(chunk)
+        assert sorted(found, key=lambda item: (item[1], item[0])) == expected
+
+
+def test_aho_corasick_rejects_empty_pattern():
+    with pytest.raises(ValueError):
+        AhoCorasick([b'ok', b''])
+
+
+def test_literal_trigger_split_across_chunks():
+    triggers, fired = engine({'pattern': 'autoboot'})
+    for chunk in split(b'Hit any key to stop auto', [10]) + [b'boot: 3\r\n']:
+        triggers.feed(chunk)
+    assert fired == [('autoboot', b'autoboot', 28)]
+
+
+def test_regex_match_split_in_the_middle():
+    triggers, fired = engine({'name': 'errors', 'pattern': r'ERR\d+', 'regex': True})
+    triggers.feed(b'ERR1')
+    assert fired == []
+    triggers.feed(b'2\r\n')
+    assert fired == [('errors', b'ERR12', 5)]
+
+
+@pytest.mark.parametrize('sizes', [[1] * 20, [3, 4], [5], [9, 1, 1], [12]])
+def test_regex_matches_are_whole_and_reported_once(sizes):
+    data = b'ERR12\r\nok ERR3\nERR456 x\n'
+    triggers, fired = engine({'name': 'errors', 'pattern': r'ERR\d+', 'regex': True})
+    for chunk in split(data, sizes):
+        triggers.feed(chunk)
+    assert [matched for _, matched, _ in fired] == [b'ERR12', b'ERR3', b'ERR456']
+    assert [offset for _, _, offset in fired] == [5, 14, 21]
+    assert triggers.counts == {'errors': 3}
+
+
+def test_regex_match_ending_a_line_fires_right_away():
+    triggers, fired = engine({'name': 'prompt', 'pattern': r'login:\s*\n', 'regex': True})
+    triggers.feed(b'board login: \n')
+    assert fired == [('prompt', b'login: \n', 14)]
+
+
+def test_ignore_case_literal_and_order_by_offset():
+    triggers, fired = engine({'pattern': 'panic', 'ignore_case': True}, {'pattern': 'OK'})
+    triggers.feed(b'OK then PANIC')
+    triggers.feed(b'!\n')
+    assert [(name, matched) for name, matched, _ in fired] == [('OK', b'OK'), ('panic', b'PANIC')]
+
+
+def test_unknown_action_is_rejected():
+    with pytest.raises(ValueError):
+        Trigger({'pattern': 'x', 'action': 'explode'})